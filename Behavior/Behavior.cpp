@@ -9,7 +9,15 @@
 #include "Behavior.h"
 
 
-Behavior::Behavior() {}
+Behavior::Behavior() {
+  _format = FORMAT_ASCII;
+
+#ifdef __AVR__
+  // Watchdog can stay on after Restart (depending on bootloader)
+  MCUSR = 0;
+  wdt_disable();
+#endif
+}
 
 
 unsigned long Behavior::UniDistro(unsigned long min_val, unsigned long max_val) {
@@ -65,10 +73,141 @@ void Behavior::Shuffle(int *arr, int n_elements) {
 }
 
 
+void Behavior::SetFormat(byte format) {
+  // Set format used by SendData. Defaults to ASCII.
+  _format = format;
+}
+
+
+void Behavior::SendFormat(Stream &stream) {
+  // Announce data format. Print with opening message (before parameters are
+  // received) so host knows how to decode data. Hosts that don't see this
+  // line assume ASCII.
+
+  stream.print("Data format: ");
+  if (_format == FORMAT_BINARY) stream.println("binary");
+  else stream.println("ascii");
+}
+
+
 void Behavior::SendData(Stream &stream, unsigned int code, unsigned long ts, long data) {
+  if (_format == FORMAT_BINARY) {
+    SendPacked(stream, code, ts, data);
+    return;
+  }
+
   stream.print(code);
   stream.print(DELIM);
   stream.print(ts);
   stream.print(DELIM);
   stream.println(data);
 }
+
+
+void Behavior::SendPacked(Stream &stream, unsigned int code, unsigned long ts, long data) {
+  // Send data as a fixed-size frame (12 bytes instead of up to ~20 for ASCII):
+  //
+  //   [0xA5, 0x5A, code, ts (4 bytes), data (4 bytes), checksum]
+  //
+  // Multi-byte values are little endian. Checksum is the sum of code, ts and
+  // data bytes modulo 256. Text (eg, from Serial.println) can still be sent
+  // between frames since ASCII never contains the first sync byte.
+
+  byte frame[FRAME_SIZE];
+  unsigned long data_bits = (unsigned long) data;
+  byte checksum = 0;
+
+  frame[0] = FRAME_SYNC0;
+  frame[1] = FRAME_SYNC1;
+  frame[2] = (byte) code;
+  for (int b = 0; b < 4; b++) {
+    frame[3 + b] = (ts >> (8 * b)) & 0xFF;
+    frame[7 + b] = (data_bits >> (8 * b)) & 0xFF;
+  }
+  for (int b = 2; b < FRAME_SIZE - 1; b++) checksum += frame[b];
+  frame[FRAME_SIZE - 1] = checksum;
+
+  stream.write(frame, FRAME_SIZE);
+}
+
+
+void Behavior::SendMaxBaud(Stream &stream, unsigned long max_baud) {
+  // Announce fastest baud rate supported. Print with opening message; hosts
+  // only try to change baud rate if this line is seen.
+  stream.print("Max baud: ");
+  stream.println(max_baud);
+}
+
+
+unsigned long Behavior::ChangeBaud(HardwareSerial &serial, unsigned long baud) {
+  // Switch to baud rate sent by host after CODEBAUD. Call when CODEBAUD is
+  // read. Returns baud rate in use afterwards.
+  //
+  // New rate is acknowledged at current rate, then serial is restarted at new
+  // rate. Host has BAUD_CHECK_TIMEOUT ms to confirm with CODEBAUDCHECK at new
+  // rate, otherwise the previous rate is restored.
+
+  unsigned long new_baud = serial.parseInt();
+  if (! new_baud) return baud;
+
+  serial.print("Baud ");
+  serial.println(new_baud);
+  serial.flush();
+  serial.begin(new_baud);
+
+  unsigned long check_start = millis();
+  while (millis() - check_start < BAUD_CHECK_TIMEOUT) {
+    if (serial.available() && serial.read() == CODEBAUDCHECK) {
+      serial.println("Baud OK");
+      return new_baud;
+    }
+  }
+
+  serial.begin(baud);
+  return baud;
+}
+
+
+void Behavior::SendParams(Stream &stream, unsigned long *params, int n_params) {
+  // Echo parameters as received, followed by their sum (modulo 2^32), so
+  // host can verify upload:
+  //
+  //   Params: 1+0+5000
+  //   Checksum: 5001
+
+  unsigned long checksum = 0;
+
+  stream.print("Params: ");
+  for (int p = 0; p < n_params; p++) {
+    if (p) stream.print("+");
+    stream.print(params[p]);
+    checksum += params[p];
+  }
+  stream.println();
+  stream.print("Checksum: ");
+  stream.println(checksum);
+}
+
+
+void Behavior::Restart() {
+  // Restart sketch without a reset from host (which would need the port to
+  // be reopened and the bootloader to time out). Sketch starts over at the
+  // initial baud rate and asks for parameters again.
+
+#if defined(__AVR__)
+  wdt_enable(WDTO_15MS);
+  while (1);
+#elif defined(__arm__)
+  NVIC_SystemReset();
+#endif
+}
+
+
+void Behavior::WaitForRestart(Stream &stream) {
+  // Wait after session ends until host asks for next session (CODEPARAMMODE).
+  // Use in place of an endless loop at the end of a session.
+
+  while (1) {
+    if (stream.available() && stream.read() == CODEPARAMMODE) Restart();
+  }
+}
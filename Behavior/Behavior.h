@@ -9,18 +9,50 @@
 #define Behavior_h
 
 #include "Arduino.h"
+#ifdef __AVR__
+#include <avr/wdt.h>
+#endif
 
 #define DELIM ","
 
+// Data formats for SendData
+#define FORMAT_ASCII 0    // "code,ts,data\n"
+#define FORMAT_BINARY 1   // Packed frame (see SendPacked)
+
+// Binary frame: sync (2), code (1), ts (4), data (4), checksum (1)
+#define FRAME_SYNC0 0xA5
+#define FRAME_SYNC1 0x5A
+#define FRAME_SIZE 12
+
+// Baud rate negotiation
+#define CODEBAUD 66               // 'B' followed by new rate
+#define CODEBAUDCHECK 67          // 'C' sent by host to confirm new rate
+#define BAUD_CHECK_TIMEOUT 1000   // Time to wait for confirmation (ms)
+
+// Parameter upload
+#define CODEPARAMMODE 80          // 'P' sent by host to restart sketch and wait for parameters
+
+// Clock synchronization
+#define CODESYNC 83               // 'S' sync ping from host, answered with current timestamp
+
 class Behavior {
   public:
     Behavior();
     unsigned long UniDistro(unsigned long min_val, unsigned long max_val);
     unsigned long ExpDistro(unsigned long mean_val, unsigned long min_val, unsigned long max_val);
     void Shuffle(int *arr, int n_elements);
+    void SetFormat(byte format);
+    void SendFormat(Stream &stream);
     void SendData(Stream &stream, unsigned int code, unsigned long ts, long data);
+    void SendPacked(Stream &stream, unsigned int code, unsigned long ts, long data);
+    void SendMaxBaud(Stream &stream, unsigned long max_baud);
+    unsigned long ChangeBaud(HardwareSerial &serial, unsigned long baud);
+    void SendParams(Stream &stream, unsigned long *params, int n_params);
+    void Restart();
+    void WaitForRestart(Stream &stream);
   private:
     int _pin;
+    byte _format;
 };
 
 #endif
@@ -17,6 +17,8 @@ Example inputs:
 #define STARTCODE 69
 #define CODETRIAL 70
 #define DELIM ","         // Delimiter used for serial communication
+#define BAUD 9600         // Initial baud rate; host can raise it (CODEBAUD)
+#define MAXBAUD 2000000   // Fastest baud rate offered to host
 
 
 // Pins
@@ -77,6 +79,7 @@ unsigned long trial_dur;
 volatile int track_change = 0;   // Rotations within tracking epochs
 volatile int lick_on = 0;        // Lick onset counter (shouldn't really exceed 1)
 volatile int lick_off = 0;       // Lick offest counter (shouldn't really exceed 1)
+unsigned long baud = BAUD;
 
 Behavior behav;
 Stream &stream = Serial;
@@ -103,6 +106,30 @@ void EndSession(unsigned long ts) {
 }
 
 
+void WaitForParams() {
+  // Handle baud rate changes from host until parameters start arriving
+  while (1) {
+    if (Serial.available() <= 0) continue;
+    switch(Serial.peek()) {
+      case CODEBAUD:
+        Serial.read();
+        baud = behav.ChangeBaud(Serial, baud);
+        break;
+      case CODEBAUDCHECK:
+        Serial.read();
+        Serial.println("Baud OK");
+        break;
+      case '\r':
+      case '\n':
+        Serial.read();
+        break;
+      default:
+        return;
+    }
+  }
+}
+
+
 void GetParams() {
   // Retrieve parameters from serial
   const int paramNum = 21;
@@ -166,7 +193,7 @@ void Tone(int pin, unsigned int freq, unsigned int dur) {
 
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD);
   randomSeed(analogRead(0));
 
   // Set pins
@@ -181,11 +208,10 @@ void setup() {
   pinMode(pin_img_stop, OUTPUT);
 
   // Wait for parameters from serial
-  Serial.println(
-    "Classical conditioning\n"
-    "Waiting for parameters..."
-  );
-  while (Serial.available() <= 0);
+  Serial.println("Classical conditioning");
+  behav.SendMaxBaud(stream, MAXBAUD);
+  Serial.println("Waiting for parameters...");
+  WaitForParams();
   GetParams();
   Serial.println("Paremeters processed");
 
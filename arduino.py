@@ -4,11 +4,25 @@
 Manage Arduino connection
 
 Paremeters are sent to Arduino when serial connection is opened. Message 
-contains parameters with prefix and specific delimiter set by code.
+contains parameters with prefix and specific delimiter set by code. Arduino 
+echoes parameters with a checksum, which is checked against what was sent.
+
+If 'Keep port open' is checked, resetting holds the port open, so the next 
+upload restarts the firmware instead of reopening the port (which resets 
+Arduino and takes seconds); pressing Reset again closes it. Otherwise, and 
+when the window is destroyed, the port is closed.
+
+Ports are listed by a `port_watch.PortWatcher` in background; the menu is 
+updated when they change. The port last used is remembered under `rig`.
 
 Will look for attributes from parent:
 - var_print_arduino
 - parameters
+
+Data format announced by Arduino in opening message is stored in 
+`data_format` to be passed to `serial_stream.make_parser`. If Arduino 
+announces a maximum baud rate, the connection is moved to the fastest rate 
+that works before parameters are sent.
 '''
 
 
@@ -17,18 +31,20 @@ import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.messagebox as tkMessageBox
 import pathlib
-import sys
 import os
-import time
+import threading
 from PIL import ImageTk
 import serial
 import serial.tools.list_ports
+import serial_stream
+import port_watch
 
 
 code_last_param = 271828
 
 class Arduino(tk.Frame):
-    def __init__(self, parent, main_window=None, verbose=False, print_arduino=False, params={'a': 1, 'b': 2}):
+    def __init__(self, parent, main_window=None, verbose=False, print_arduino=False, params={'a': 1, 'b': 2},
+                 rig='arduino'):
         super().__init__()   # https://stackoverflow.com/questions/576169/understanding-python-super-with-init-methods
         self.parent = parent
         self.main_window = main_window if main_window else self.parent
@@ -36,9 +52,13 @@ class Arduino(tk.Frame):
         self.print_arduino = '  [a]: ' if print_arduino else False
         self.verbose = verbose
         self.parameters = params
+        self.rig = rig
+        self.connector = None
+        self.data_format = serial_stream.format_ascii
         self.var_uploaded = tk.BooleanVar(name='uploaded')
+        self.var_hold_port = tk.BooleanVar(value=True)
 
-        self.ser = serial.Serial(timeout=1, write_timeout=3, baudrate=9600)
+        self.ser = serial.Serial(timeout=1, write_timeout=3, baudrate=serial_stream.base_baud)
 
         self.var_port = tk.StringVar()
 
@@ -55,11 +75,12 @@ class Arduino(tk.Frame):
         self.parent.grid_columnconfigure(0, weight=1)
 
         self.option_ports = ttk.OptionMenu(frame_arduino1, self.var_port, [])
-        self.button_update_ports = ttk.Button(frame_arduino1, text='u', command=self.update_ports)
+        self.button_update_ports = ttk.Button(frame_arduino1, text='u', command=self.refresh_ports)
         self.entry_serial_status = ttk.Entry(frame_arduino1)
         self.button_settings = ttk.Button(frame_arduino2, text='Settings', command=self.settings)
         self.button_open_port = ttk.Button(frame_arduino2, text='Upload', command=self.open_serial)
         self.button_close_port = ttk.Button(frame_arduino2, text='Reset', command=self.close_serial)
+        self.check_hold_port = ttk.Checkbutton(frame_arduino2, text='Keep port open', variable=self.var_hold_port)
         tk.Label(frame_arduino1, text='Port: ').grid(row=0, column=0, sticky='e')
         tk.Label(frame_arduino1, text='State: ').grid(row=1, column=0, sticky='e')
         self.option_ports.grid(row=0, column=1, sticky='we', padx=5)
@@ -68,6 +89,7 @@ class Arduino(tk.Frame):
         self.button_settings.grid(row=0, column=0, columnspan=2, pady=py, sticky='we')
         self.button_open_port.grid(row=1, column=0, pady=py, sticky='we')
         self.button_close_port.grid(row=1, column=1, pady=py, sticky='we')
+        self.check_hold_port.grid(row=2, column=0, columnspan=2, sticky='w')
 
         update_icon_file = os.path.join(pathlib.Path(__file__).parent.absolute(), 'graphics/refresh.png')
         if os.path.isfile(update_icon_file):
@@ -78,7 +100,16 @@ class Arduino(tk.Frame):
         self.button_close_port['state'] = 'disabled'
         self.entry_serial_status.insert(0, 'Waiting for parameters')
         self.entry_serial_status['state'] = 'readonly'
-        self.update_ports()
+
+        # Tk is not thread-safe, so watcher only flags changes, which are 
+        # checked from main loop
+        self.button_open_port['state'] = 'disabled'
+        self.var_port.set('Searching for ports...')
+        self.ports_changed = threading.Event()
+        self.port_watcher = port_watch.PortWatcher(on_change=lambda watcher: self.ports_changed.set())
+        self.parent.bind('<Destroy>', self.on_destroy, add='+')
+        self.parent.after_idle(self.port_watcher.start)
+        self.parent.after_idle(self.check_ports)
 
         # if self.ser.isOpen():
         #     self.var_port.set(self.ser.port)
@@ -92,6 +123,7 @@ class Arduino(tk.Frame):
             label['state'] = 'readonly'
         if opt == 'upload':
             self.button_open_port['state'] = 'disabled'
+            self.button_close_port['state'] = 'disabled'
             relabel(self.entry_serial_status, 'Uploading...')
         elif opt == 'uploaded':
             self.button_open_port['state'] = 'disabled'
@@ -102,21 +134,43 @@ class Arduino(tk.Frame):
             self.button_close_port['state'] = 'disabled'
             relabel(self.entry_serial_status, 'Resetting connection...')
         elif opt == 'reset':
+            if self.ser.is_open: self.button_close_port['state'] = 'normal'    # Closes held port
             relabel(self.entry_serial_status, 'Waiting for parameters')
-            self.update_ports()
             self.var_uploaded.set(False)
+            self.update_ports()     # From cache
         else:
             print('Unknown utility option')
         self.parent.update_idletasks()
 
 
+    def refresh_ports(self):
+        '''List ports again (menu updates if they changed)'''
+        self.port_watcher.refresh()
+
+    def check_ports(self, poll=250):
+        '''Update menu if port watcher found changes; polled from main loop'''
+        if self.ports_changed.is_set():
+            self.ports_changed.clear()
+            self.update_ports()
+        self.parent.after(poll, self.check_ports)
+
+    def on_destroy(self, event):
+        if event.widget is self.parent:
+            self.port_watcher.stop()
+            if self.ser.is_open:
+                self.ser.close()    # Release port held open
+
     def update_ports(self):
-        '''Update available ports'''
+        '''Update available ports from port watcher
+        Selected port is kept if still available, otherwise the port last used 
+        (found by stable ID) is selected.
+        '''
 
         # Get available ports
-        ports_info = list(serial.tools.list_ports.comports())
-        ports = [port.device for port in ports_info]
-        ports_description = [port.description for port in ports_info]
+        ports_info = self.port_watcher.ports     # Includes virtual Arduinos
+        ports = [port for port, _ in ports_info]
+        ports_description = [description for _, description in ports_info]
+        busy = self.var_uploaded.get() or (self.connector is not None and not self.connector.finished)
 
         # Update GUI
         menu = self.option_ports['menu']
@@ -124,8 +178,10 @@ class Arduino(tk.Frame):
         if ports:
             for port, description in zip(ports, ports_description):
                 menu.add_command(label=description, command=lambda com=port: self.var_port.set(com))
-            self.var_port.set(ports[0])
-            self.button_open_port['state'] = 'normal'
+            if self.var_port.get() not in ports:
+                last_port = self.port_watcher.find(port_watch.last_used(self.rig))
+                self.var_port.set(last_port or ports[0])
+            if not busy: self.button_open_port['state'] = 'normal'
         else:
             self.var_port.set('No ports found')
             self.button_open_port['state'] = 'disabled'
@@ -141,79 +197,73 @@ class Arduino(tk.Frame):
         Executes when 'Open' is pressed
 
         Opens connection via serial. Parameters are sent when connection is 
-        opened with prefix `code_params` and delimited by `delim`
+        opened with prefix `code_params` and delimited by `delim`. Connecting 
+        runs in a `serial_stream.Connector` thread so the GUI stays responsive; 
+        `check_upload` follows its progress. `delay` is skipped if the port 
+        was held open.
         '''
 
         self.gui_util('upload')
 
-        # Open serial
-        self.ser.port = self.var_port.get()
-        try:
-            self.ser.open()
-        except serial.SerialException as err:
-            # Error during serial.open()
-            err_msg = err.args[0]
-            tkMessageBox.showerror('Serial error', err_msg)
-            print(f'Serial error: {err_msg}')
-            self.close_serial()
-            return
-        else:
-            # Serial opened successfully
-            time.sleep(delay)
-            if self.verbose: print('Connection to Arduino opened')
-
-        # Handle opening message from serial
-        if self.print_arduino:
-            while self.ser.in_waiting:
-                sys.stdout.write(self.print_arduino + self.ser.readline().decode())
-        else:
-            self.ser.flushInput()
-
-        # Send parameters to Arduino
+        # Parameters to send to Arduino
         values = list(self.parameters.values())
         if type(values[0]) == tk.IntVar:
             values = [x.get() for x in values]
         values.append(code_last_param)
-        ser_msg = code_params + delim.join(str(s) for s in values)
-        if self.verbose: print('Sending parameters as `{}`'.format(ser_msg))
-        try:
-            self.ser.write(ser_msg.encode())
-        except serial.serialutil.SerialTimeoutException:
-            # Write timeout
-            print('Error uploading parameters: write timeout')
-            self.close_serial()
+        ser_msg = serial_stream.params_message(values, code_params, delim)
+
+        # Arduino echoes parameters with checksum, then waits for start signal 
+        # unless they could not be parsed
+        def ack(line):
+            if line.startswith('Error'): return line.strip()
+            return True if 'Waiting for start signal' in line else None
+
+        self.connector = serial_stream.Connector(
+            self.ser, self.var_port.get(), ser_msg, delay=delay, timeout=timeout, ack=ack, values=values,
+            verbose=self.verbose, print_head=self.print_arduino or None,
+        )
+        self.connector.start()
+        self.check_upload()
+
+    def check_upload(self, poll=50):
+        '''Follow connection to Arduino until parameters are uploaded'''
+
+        connector = self.connector
+        if not connector.finished:
+            self.parent.after(poll, self.check_upload)
             return
 
-        # Ensure parameters processed
-        start_time = time.time()
-        while 1:
-            if time.time() >= start_time + timeout:
-                print('Error uploading parameters: start signal not found')
-                self.close_serial()
-                return
-            if self.ser.in_waiting:
-                upload_code = self.ser.readline().decode().rstrip()
-                if self.print_arduino:
-                    # Print incoming data
-                    while self.ser.in_waiting:
-                        sys.stdout.write(self.print_arduino + self.ser.readline().decode())
-                if upload_code != '0':
-                    print(f'Error uploading parameters: exit code {upload_code}')
-                    self.close_serial()
-                    return
-                else:
-                    print('Parameters uploaded to Arduino')
-                    print('Ready to start')
-                    self.gui_util('uploaded')
-                    return
+        if connector.error:
+            if not self.ser.is_open:
+                # Error during serial.open()
+                tkMessageBox.showerror('Serial error', connector.error)
+                print(f'Serial error: {connector.error}')
+            else:
+                print(f'Error uploading parameters: {connector.error}')
+            self.close_serial(hold=False)
+            return
+
+        self.data_format = connector.data_format
+        port_watch.remember(self.rig, self.port_watcher.ids.get(connector.port, connector.port))
+        print('Parameters uploaded to Arduino')
+        print('Ready to start')
+        self.gui_util('uploaded')
     
-    def close_serial(self):
-        ''' Close serial connection to Arduino '''
-        print('Closing serial connection')
+    def close_serial(self, hold=None):
+        ''' Reset connection to Arduino
+        Port is held open if 'Keep port open' is checked (and `hold` is not 
+        False); the next upload restarts Arduino from it. Resetting again 
+        closes a held port.
+        '''
+        if hold is None: hold = self.var_hold_port.get() and self.var_uploaded.get()
         self.gui_util('resetting')
-        self.ser.close()
+        if hold and self.ser.is_open:
+            print('Serial connection held open')
+        else:
+            print('Closing serial connection')
+            self.ser.close()
+            print('Connection to Arduino closed')
         self.gui_util('reset')
-        print('Connection to Arduino closed')
 
 
 class Sample(ttk.Frame):
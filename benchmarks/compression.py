@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+'''
+Compression benchmark
+
+Compares write throughput and file size of dataset layouts on a synthetic
+go/no-go session (20 min by default). Each layout is written through
+`data_writer.DataWriter` in batches like those coming from serial, except
+'legacy', which reproduces the old layout (preallocated, (2, 1) chunks,
+uncompressed) written in the same blocks.
+
+Usage:
+    python benchmarks/compression.py [--duration 1200] [--json results.json]
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+
+# Shared modules are in parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import data_writer
+
+
+# Arduino codes and datasets (as in go-no-go.py)
+code_lick = 1
+code_lick_form = 9
+code_movement = 2
+events = {code_lick: 'lick', code_lick_form: 'lick_form', code_movement: 'movement'}
+dtypes = {'lick': 'uint32', 'lick_form': 'uint32', 'movement': 'int32'}
+
+layouts = [
+    ('legacy', None, False),
+    ('none', 'none', False),
+    ('lzf', 'lzf', False),
+    ('gzip', 'gzip', False),
+    ('lzf+delta', 'lzf', True),
+    ('gzip+delta', 'gzip', True),
+]
+
+
+def synthetic_session(duration=1200, track_period=50, lick_form_rate=1000, seed=0):
+    '''Generate (N, 3) records for a session lasting `duration` seconds
+    Licks come in bouts (~7 Hz) covering about a fifth of the session. Lick
+    waveform is sampled at `lick_form_rate` while the tongue is near the
+    spout (about half of each lick cycle). Movement is sent every
+    `track_period` ms when the wheel moved.
+    '''
+
+    rng = np.random.RandomState(seed)
+    duration_ms = int(duration * 1000)
+
+    # Movement
+    ts_move = np.arange(track_period, duration_ms, track_period)
+    move = rng.randint(-3, 4, size=ts_move.size)
+    ts_move, move = ts_move[move != 0], move[move != 0]
+
+    # Lick bouts
+    n_bouts = int(duration / 25)
+    bout_start = np.sort(rng.randint(0, duration_ms - 5000, size=n_bouts))
+    bout_len = rng.randint(1000, 5000, size=n_bouts)
+    ts_lick = np.concatenate([
+        np.arange(start, start + length, 140) + rng.randint(0, 20)
+        for start, length in zip(bout_start, bout_len)
+    ])
+    ts_lick = np.unique(ts_lick)
+
+    # Lick waveform around each lick
+    step = max(1000 // lick_form_rate, 1)
+    offsets = np.arange(-35, 35, step)
+    ts_form = np.unique((ts_lick[:, None] + offsets).ravel())
+    form = (300 + 200 * np.cos(np.linspace(0, np.pi * 2, ts_form.size) * 997) +
+            rng.randint(-20, 20, size=ts_form.size)).astype(np.int64)
+
+    records = np.concatenate([
+        np.column_stack([np.full(ts_move.size, code_movement), ts_move, move]),
+        np.column_stack([np.full(ts_lick.size, code_lick), ts_lick, np.ones(ts_lick.size)]),
+        np.column_stack([np.full(ts_form.size, code_lick_form), ts_form, form]),
+    ]).astype(np.int64)
+    return records[np.argsort(records[:, 1], kind='mergesort')]
+
+
+def write_legacy(grp, records, block=4096):
+    '''Old layout: preallocated (2, N) datasets with (2, 1) chunks'''
+
+    for code, name in events.items():
+        rows = records[records[:, 0] == code, 1:]
+        dset = grp.create_dataset(name=name, dtype=dtypes[name], shape=(2, len(rows)), chunks=(2, 1))
+        for start in range(0, len(rows), block):
+            dset[:, start:start + block] = rows[start:start + block].T
+
+
+def write_layout(grp, records, compression, delta_ts, batch=50):
+    '''Write through DataWriter in batches like those read from serial'''
+
+    rates = {name: float(np.count_nonzero(records[:, 0] == code)) / (records[-1, 1] / 1000.)
+             for code, name in events.items()}
+    streams = {name: (dtypes[name], rates[name]) for name in events.values()}
+    data_writer.create_datasets(grp, streams, compression=compression, delta_ts=delta_ts)
+    writer = data_writer.DataWriter(grp, events)
+    writer.start()
+    for start in range(0, len(records), batch):
+        writer.put(records[start:start + batch])
+    writer.close()
+
+
+def run(duration=1200, out_dir=None):
+    records = synthetic_session(duration)
+    n_bytes = sum(np.count_nonzero(records[:, 0] == code) * 8 for code in events)
+    tmp_dir = out_dir or tempfile.mkdtemp()
+
+    results = []
+    for label, compression, delta_ts in layouts:
+        filename = os.path.join(tmp_dir, 'bench-{}.h5'.format(label))
+        with h5py.File(filename, 'w') as data_file:
+            grp = data_file.create_group('behavior')
+            t0 = time.time()
+            if compression is None:
+                write_legacy(grp, records)
+            else:
+                write_layout(grp, records, compression, delta_ts)
+            data_file.flush()
+            t_write = time.time() - t0
+
+        with h5py.File(filename, 'r') as data_file:
+            t0 = time.time()
+            for name in events.values():
+                data_writer.read_events(data_file['behavior'][name])
+            t_read = time.time() - t0
+
+        results.append({
+            'layout': label,
+            'records': len(records),
+            'write_s': t_write,
+            'records_per_s': len(records) / t_write,
+            'write_mb_per_s': n_bytes / t_write / 1e6,
+            'read_s': t_read,
+            'file_bytes': os.path.getsize(filename),
+        })
+
+    if not out_dir:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=1200, help='Session length (s)')
+    parser.add_argument('--out-dir', help='Keep files in this directory')
+    parser.add_argument('--json', help='Save results to file')
+    args = parser.parse_args()
+
+    results = run(args.duration, args.out_dir)
+
+    print('{:<12}{:>10}{:>14}{:>10}{:>10}{:>14}'.format(
+        'Layout', 'Write (s)', 'Records/s', 'MB/s', 'Read (s)', 'File (kB)'))
+    for r in results:
+        print('{layout:<12}{write_s:>10.2f}{records_per_s:>14.0f}{write_mb_per_s:>10.1f}'
+              '{read_s:>10.3f}{kb:>14.0f}'.format(kb=r['file_bytes'] / 1e3, **r))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
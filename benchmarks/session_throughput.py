@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+'''
+Session throughput benchmark
+
+Drives the headless acquisition path (session.py, also used by rigs.py) end
+to end at increasing lick waveform rates: a virtual Arduino
+(virtual_arduino.py, in its own process) streams a free-licking session over
+a pseudo-terminal and `session.Session` records it, so serial is read by
+`serial_stream.scan_serial` and records are saved through `Session.save` and
+`data_writer.DataWriter` into the datasets go-no-go.py creates. The main
+thread drains the ring buffer when the reader signals data, with the same
+`drain_budget` and `drain_batch` as the GUI (`Session.process`).
+
+This is not the GUI's throughput: go-no-go.py handles records in
+`drain_serial`/`process_records`, which also update the PSTH and counters and
+run on the Tk event loop. Numbers here are an upper bound for the GUI.
+
+For each rate, reports sustained events per second, ring buffer depth over
+time, latency from Arduino timestamp to saving by `Session.save` (relative
+to when the session was started) and HDF5 write throughput. A rate is
+marked as falling behind when the reader had to wait on a full buffer or the
+99th percentile latency exceeds `max_latency`.
+
+Baud rate has no effect on a pseudo-terminal, so serial bandwidth is not
+limiting here.
+
+Usage:
+    python benchmarks/session_throughput.py [--form-rates 1000 5000 20000] [--json results.json]
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import h5py
+import numpy as np
+import serial
+
+# Shared modules are in parent directory
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, 'go-no-go'))
+import serial_stream
+import data_writer
+import session
+
+
+drain_budget = 20           # Processing time per drain (ms), as in go-no-go.py
+drain_batch = 4096          # Records taken from buffer at a time, as in go-no-go.py
+max_latency = 0.5           # Latency (s) above which session is falling behind
+n_depth_samples = 200       # Points kept of buffer depth over time
+default_form_rates = [1000, 2000, 5000, 10000, 20000, 50000]
+
+
+def start_device(link, form_rate, args):
+    '''Run virtual Arduino in separate process'''
+
+    cmd = [
+        sys.executable, os.path.join(root_dir, 'virtual_arduino.py'),
+        '--link', link, '--format', args.format, '--max-baud', '0',
+        '--lick-rate', str(args.lick_rate), '--form-rate', str(form_rate),
+        '--form-window', str(args.form_window), '--jitter', str(args.jitter), '--seed', '0',
+    ]
+    device = subprocess.Popen(cmd, stdout=open(os.devnull, 'w'))
+    while not os.path.exists(link):
+        if device.poll() is not None:
+            raise RuntimeError('Virtual Arduino exited')
+        time.sleep(0.05)
+    return device
+
+
+def connect(port, duration):
+    '''Open serial and upload free-licking session parameters
+    Returns open serial, parameters and data format.
+    '''
+
+    parameters = session.make_parameters({
+        'session_type': 2,      # Free licking
+        'session_dur': int(duration * 1000),
+        'track_period': 50,
+    })
+    ser = serial.Serial(port, serial_stream.base_baud, timeout=1)
+    try:
+        data_format = session.upload_parameters(ser, parameters)
+    except IOError:
+        ser.close()
+        raise
+    return ser, parameters, data_format
+
+
+class TimedSession(session.Session):
+    '''Session noting latency of events from Arduino timestamp to saving'''
+
+    def start(self, *args, **kwargs):
+        self.t_start = time.time()
+        self.latencies = []
+        session.Session.start(self, *args, **kwargs)
+
+    def save(self, records, read_ns=None):
+        now = time.time() - self.t_start
+        is_event = np.isin(records[:, 0], list(session.arduino_events))
+        self.latencies.append(now - records[is_event, 1] / 1000.)
+        return session.Session.save(self, records, read_ns)
+
+
+def run_session(filename, form_rate, args):
+    '''Acquire one session; returns results'''
+
+    link = filename + '.port'
+    device = start_device(link, form_rate, args)
+    try:
+        ser, parameters, data_format = connect(link, args.duration)
+        data_file = h5py.File(filename, 'w')
+        s = TimedSession(ser, data_file, parameters, data_format, subject='bench',
+                         compression=args.compression, delta_ts=args.delta_ts)
+        streams = session.session_streams(parameters)
+
+        s.start()
+        t_start = s.t_start
+
+        # Wait for signal from reader and drain buffer
+        depth = []
+        stats = {'ticks': 0, 'items': 0, 'overruns': 0}
+        ended = False
+        while not ended:
+            n_before = s.n_records
+            ended = s.process(1, drain_budget / 1000., drain_batch)
+            depth.append((time.time() - t_start, len(s.q_serial)))
+            if s.n_records > n_before:
+                stats['ticks'] += 1
+                stats['items'] += s.n_records - n_before
+                if not ended and not s.q_serial.empty():
+                    stats['overruns'] += 1
+        t_end = time.time()
+
+        t0 = time.time()
+        s.finish()
+        t_close = time.time() - t0
+        data_file.close()
+        ser.close()
+    finally:
+        device.terminate()
+        device.wait()
+
+    n_records = sum(s.counts.values())
+    n_bytes = sum(n * 2 * np.dtype(streams[name][0]).itemsize for name, n in s.writer.n_written.items())
+    latency = np.concatenate(s.latencies) if s.latencies else np.zeros(1)
+    depth = np.array(depth)
+    keep = np.linspace(0, len(depth) - 1, min(len(depth), n_depth_samples)).astype(int)
+    p50, p90, p99 = np.percentile(latency, [50, 90, 99]).tolist()
+    return {
+        'form_rate': form_rate,
+        'records': int(n_records),
+        'duration_s': t_end - t_start,
+        'events_per_s': n_records / (t_end - t_start),
+        'latency_p50_s': p50,
+        'latency_p90_s': p90,
+        'latency_p99_s': p99,
+        'latency_max_s': float(latency.max()),
+        'depth_max': int(depth[:, 1].max()),
+        'depth_mean': float(depth[:, 1].mean()),
+        'depth': depth[keep].tolist(),
+        'buffer_waits': s.q_serial.n_waits,
+        'ticks': stats['ticks'],
+        'items_per_tick': float(stats['items']) / max(stats['ticks'], 1),
+        'overruns': stats['overruns'],
+        'write_s': s.writer.write_time,
+        'write_mb_per_s': n_bytes / max(s.writer.write_time, 1e-9) / 1e6,
+        'close_s': t_close,
+        'file_bytes': os.path.getsize(filename),
+        'falling_behind': bool(s.q_serial.n_waits or p99 > max_latency),
+    }
+
+
+def version():
+    '''Commit of repository, if available'''
+
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root_dir)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def run(args):
+    tmp_dir = args.out_dir or tempfile.mkdtemp()
+    results = []
+    for form_rate in args.form_rates:
+        filename = os.path.join(tmp_dir, 'bench-{}.h5'.format(form_rate))
+        results.append(run_session(filename, form_rate, args))
+    if not args.out_dir:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--form-rates', type=float, nargs='+', default=default_form_rates,
+                        help='Lick waveform samples per second')
+    parser.add_argument('--lick-rate', type=float, default=8., help='Lick rate (Hz)')
+    parser.add_argument('--form-window', type=float, default=60, help='Lick waveform around each lick (ms)')
+    parser.add_argument('--jitter', type=float, default=0., help='Maximum extra delay of serial writes (ms)')
+    parser.add_argument('--duration', type=float, default=10, help='Session length at each rate (s)')
+    parser.add_argument('--format', choices=[serial_stream.format_ascii, serial_stream.format_binary],
+                        default=serial_stream.format_binary)
+    parser.add_argument('--compression', choices=sorted(data_writer.compression_filters), default='gzip')
+    parser.add_argument('--delta-ts', action='store_true')
+    parser.add_argument('--out-dir', help='Keep files in this directory')
+    parser.add_argument('--json', help='Save results to file')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print('{:<10}{:>12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}  {}'.format(
+        'Form rate', 'Events/s', 'p50 (ms)', 'p99 (ms)', 'Depth', 'Waits', 'Per tick', 'Overruns', 'MB/s', 'Behind'))
+    for r in results:
+        print('{form_rate:<10.0f}{events_per_s:>12.0f}{p50:>10.1f}{p99:>10.1f}{depth_max:>10}'
+              '{buffer_waits:>10}{items_per_tick:>10.0f}{overruns:>10}{write_mb_per_s:>10.1f}  {falling_behind}'.format(
+                  p50=r['latency_p50_s'] * 1000, p99=r['latency_p99_s'] * 1000, **r))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'version': version(), 'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+'''
+Arduino clock synchronization
+
+Arduino timestamps are `millis()` since session start, on a clock that
+drifts from the host's. To place events on the host clock (eg, to align them
+with imaging or video recorded on the same computer), the host sends sync
+pings (`code_sync_ping`) during a session and firmware answers each with a
+record `[code_sync, ts, n]`, `n` counting pings received. A reply is taken to
+have been sent halfway between the ping being written and the reply being
+read. Host time is fitted as a linear function of Arduino time (offset and
+rate) as replies arrive, weighting each by its round-trip time; replies that
+took much longer than the fastest one (eg, firmware busy playing a tone) are
+left out of the fit.
+
+Readers also stamp each batch of records with the host time it was read.
+Records of a batch were all sent before then, so the earliest read in every
+`receive_bin` s of a session bounds host time from above. These bounds are
+fitted instead if firmware does not answer pings.
+
+Host times are `time.monotonic_ns()` (where available, otherwise
+`time.time()`), in ns when stored and in s when fitted.
+
+Saved in the behavior group (`ClockSync.save`):
+- `clock_sync`: rows of [ts, host time ping sent, host time reply read]
+- `clock_receive`: rows of [ts, host time read]
+- attrs `clock_offset` (host s at Arduino ts 0), `clock_rate` (host s per
+  Arduino s), `clock_drift_ppm` (Arduino clock error; positive if it runs
+  fast), `clock_rms` (s), `clock_n_fit`,
+  `clock_source` ('sync', 'receive' or 'none') and `clock_wall_offset`
+  (wall clock time minus host time, s)
+
+Map Arduino timestamps (ms) of a saved session to host time:
+    host_s = clock_sync.arduino_to_host(grp_behav['lick'][0], grp_behav.attrs)
+'''
+
+import threading
+import time
+import numpy as np
+
+
+code_sync = 10              # Answer to ping (code_sync in go-no-go_arduino.ino)
+code_sync_ping = 'S'        # CODESYNC in Behavior.h
+receive_bin = 1.            # Arduino time (s) over which earliest read is kept
+min_rtt = 0.002             # Round-trip time (s) below which replies are not told apart
+
+if hasattr(time, 'monotonic_ns'):
+    now_ns = time.monotonic_ns
+else:
+    now_ns = lambda: int(time.time() * 1e9)
+
+
+class ClockModel(object):
+    '''Weighted linear fit of host time to Arduino time, updated online
+    Sums are kept relative to the first point for precision.
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.x0 = self.y0 = 0.
+        self.sw = self.swx = self.swy = self.swxx = self.swxy = self.swyy = 0.
+
+    def add(self, ts, host, weight=1.):
+        '''Add Arduino time `ts` (s) read at `host` time (s)'''
+
+        if not self.n:
+            self.x0, self.y0 = ts, host
+        x = ts - self.x0
+        y = host - self.y0
+        self.n += 1
+        self.sw += weight
+        self.swx += weight * x
+        self.swy += weight * y
+        self.swxx += weight * x * x
+        self.swxy += weight * x * y
+        self.swyy += weight * y * y
+
+    def fit(self):
+        '''`(offset, rate)` relative to first point
+        Rate is nominal (1) until points span some time.
+        '''
+
+        if not self.n:
+            return 0., 1.
+        denom = self.sw * self.swxx - self.swx ** 2
+        if denom <= 1e-12 * self.sw ** 2:
+            rate = 1.
+        else:
+            rate = (self.sw * self.swxy - self.swx * self.swy) / denom
+        return (self.swy - rate * self.swx) / self.sw, rate
+
+    @property
+    def offset(self):
+        '''Host time (s) at Arduino time 0'''
+        a, rate = self.fit()
+        return self.y0 + a - rate * self.x0
+
+    @property
+    def rate(self):
+        '''Host s per Arduino s'''
+        return self.fit()[1]
+
+    @property
+    def rms(self):
+        '''Weighted RMS residual (s)'''
+
+        if not self.n:
+            return 0.
+        a, b = self.fit()
+        ss = (self.swyy - 2 * a * self.swy - 2 * b * self.swxy + a * a * self.sw
+              + 2 * a * b * self.swx + b * b * self.swxx)
+        return np.sqrt(max(ss, 0.) / self.sw)
+
+
+class ClockSync(object):
+    '''Clock pings and receive times of one session
+    Only the thread reading serial should call `receive`. Pings can be sent
+    from another thread.
+    '''
+
+    def __init__(self, ping_interval=1., ping_timeout=1., max_rtt_factor=3.):
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.max_rtt_factor = max_rtt_factor
+
+        self.lock = threading.Lock()
+        self.model = ClockModel()
+        self.n_pings = 0
+        self.pending = {}           # Send time of pings not answered, by count
+        self.last_ping = None
+        self.fastest = None         # Shortest round trip (s)
+        self.sync = []              # [ts, sent, read]
+        self.earliest = {}          # Bin of `receive_bin` s: [ts, read]
+        self.wall_offset = time.time() - now_ns() / 1e9
+
+    def maybe_ping(self, ser):
+        '''Ping if `ping_interval` s passed and last ping was answered (or
+        timed out)
+        '''
+
+        now = now_ns()
+        with self.lock:
+            if self.last_ping is not None:
+                elapsed = (now - self.last_ping) / 1e9
+                if elapsed < self.ping_interval: return
+                if self.pending and elapsed < self.ping_timeout: return
+        self.ping(ser)
+
+    def ping(self, ser):
+        '''Send sync ping'''
+
+        with self.lock:
+            self.n_pings += 1
+            self.pending = {self.n_pings: now_ns()}     # Late answers to earlier pings are not used
+            self.last_ping = self.pending[self.n_pings]
+        ser.write(code_sync_ping.encode())
+
+    def receive(self, records, read_ns):
+        '''Take in (N, 3) records read at host time `read_ns`
+        Returns records without sync replies.
+        '''
+
+        if not len(records):
+            return records
+        is_sync = records[:, 0] == code_sync
+
+        # Last record of batch was sent before it was read
+        ts = int(records[-1, 1])
+        key = int(ts / 1000. / receive_bin)
+        if key not in self.earliest or read_ns - ts * 1e6 < self.earliest[key][1] - self.earliest[key][0] * 1e6:
+            self.earliest[key] = [ts, read_ns]
+
+        if not is_sync.any():
+            return records
+        for ts, n in records[is_sync, 1:]:
+            with self.lock:
+                sent_ns = self.pending.pop(int(n), None)
+            if sent_ns is not None:
+                self.add_sync(int(ts), sent_ns, read_ns)
+        return records[~is_sync]
+
+    def add_sync(self, ts, sent_ns, read_ns):
+        '''Add reply with Arduino time `ts` (ms) to ping sent and read at host
+        times (ns)
+        '''
+
+        self.sync.append([ts, sent_ns, read_ns])
+        rtt = max((read_ns - sent_ns) / 1e9, min_rtt)
+        if self.fastest is None or rtt < self.fastest:
+            self.fastest = rtt
+        if rtt <= self.max_rtt_factor * self.fastest:
+            self.model.add(ts / 1000., (sent_ns + read_ns) / 2e9, 1. / rtt ** 2)
+
+    def fitted(self):
+        '''Model of session and its source
+        Falls back to earliest receive times if there are too few replies.
+        '''
+
+        if self.model.n >= 2:
+            return self.model, 'sync'
+        if len(self.earliest) >= 2:
+            model = ClockModel()
+            for ts, read_ns in sorted(self.earliest.values()):
+                model.add(ts / 1000., read_ns / 1e9)
+            return model, 'receive'
+        return ClockModel(), 'none'
+
+    def attrs(self):
+        '''Model as attributes of behavior group'''
+
+        model, source = self.fitted()
+        return {
+            'clock_offset': model.offset,
+            'clock_rate': model.rate,
+            'clock_drift_ppm': (1. / model.rate - 1) * 1e6,
+            'clock_rms': model.rms,
+            'clock_n_fit': model.n,
+            'clock_source': source,
+            'clock_wall_offset': self.wall_offset,
+        }
+
+    def save(self, grp):
+        '''Store pings, receive times and model in HDF5 group `grp`'''
+
+        grp.create_dataset('clock_sync', data=np.array(self.sync, dtype=np.int64).reshape(-1, 3))
+        earliest = [self.earliest[key] for key in sorted(self.earliest)]
+        grp.create_dataset('clock_receive', data=np.array(earliest, dtype=np.int64).reshape(-1, 2))
+        for key, value in self.attrs().items():
+            grp.attrs[key] = value
+
+
+def arduino_to_host(ts, attrs, wall=False):
+    '''Host time (s) of Arduino timestamps `ts` (ms)
+    `attrs` holds the clock model (eg, attributes of behavior group). With
+    `wall`, times are wall clock times (s since epoch) instead.
+    '''
+
+    host = attrs['clock_offset'] + attrs['clock_rate'] * (np.asarray(ts, dtype=np.float64) / 1000.)
+    if wall:
+        host = host + attrs['clock_wall_offset']
+    return host
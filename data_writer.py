@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+'''
+Data writer
+
+Writes behavioral data into HDF5 file from a dedicated thread. Records are
+passed in batches from the GUI and buffered in memory for each stream
+(dataset). A stream's buffer is written as one contiguous block once it holds
+`flush_size` records or `flush_interval` seconds have passed, so the GUI never
+waits on the disk.
+
+Datasets are (2, N): timestamps in the first row, data in the second. They
+are created small with chunks sized to each stream's expected event rate, grow
+geometrically as data is written, and are trimmed to the number of records
+written when the writer is closed.
+
+Several sessions (eg, one per rig) can share one writing thread with
+`SharedWriter`, so a single thread writes all datasets. Other HDF5 access
+still happens elsewhere: sessions create their groups and write their attrs
+from the thread that finalizes them, which can run while the writer thread
+writes other sessions (h5py serializes calls across threads with its lock).
+
+Datasets can be compressed with filters that ship with h5py (see
+`compression_filters`); reading them back is transparent. Timestamps can also
+be stored as differences from the previous event, which compress much better
+but have to be decoded with `read_events`. Options are stored in each
+dataset's attrs.
+
+Writers can also add latency of records to `latency.Latency` histograms: time
+taken by HDF5 writes ('write') and, if records are put with the host time
+they were read, time from read to written ('total').
+'''
+
+import sys
+import threading
+import time
+import numpy as np
+import latency
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+
+# Dataset layout
+chunk_time = 10.     # Seconds of data per chunk at expected event rate
+chunk_min = 64       # Records per chunk
+chunk_max = 16384
+growth = 2           # Factor to grow datasets by when full
+
+# Compression options for `create_datasets`
+compression_filters = {
+    'none': {},
+    'gzip': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+}
+ts_absolute = 'absolute'
+ts_delta = 'delta'
+
+
+def chunk_length(rate):
+    '''Records per chunk for stream with `rate` expected events per second'''
+    return int(np.clip(rate * chunk_time, chunk_min, chunk_max))
+
+
+def create_datasets(grp, streams, compression='none', delta_ts=False):
+    '''Create growable datasets in `grp`
+    `streams` maps dataset names to `(dtype, rate)`, where `rate` is the 
+    expected number of events per second. Each dataset starts with one chunk.
+
+    `compression` is a key of `compression_filters` and `delta_ts` sets 
+    whether timestamps are stored as differences. Either can be a dict to set 
+    them per dataset (missing datasets are not compressed).
+    '''
+
+    for name, (dtype, rate) in streams.items():
+        comp = compression.get(name, 'none') if isinstance(compression, dict) else compression
+        delta = delta_ts.get(name, False) if isinstance(delta_ts, dict) else delta_ts
+        n = chunk_length(rate)
+        dset = grp.create_dataset(
+            name=name, dtype=dtype, shape=(2, n), maxshape=(2, None), chunks=(2, n),
+            **compression_filters[comp]
+        )
+        dset.attrs['compression'] = comp
+        dset.attrs['ts_encoding'] = ts_delta if delta else ts_absolute
+
+
+def read_events(dset):
+    '''Read (2, N) dataset with absolute timestamps'''
+
+    events = dset[()]
+    if dset.attrs.get('ts_encoding') == ts_delta:
+        events[0] = np.cumsum(events[0], dtype=events.dtype)
+    return events
+
+
+class DataWriter(threading.Thread):
+    '''Thread writing records into datasets in `grp`
+    `events` maps Arduino codes to dataset names; records with other codes
+    (eg, end of session) are not written. Datasets should be created with 
+    `create_datasets`. Latency of records is added to `latency` (a 
+    `latency.Latency`, if given).
+    '''
+
+    def __init__(self, grp, events, flush_size=4096, flush_interval=1.0, latency=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.grp = grp
+        self.events = events
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.latency = latency
+
+        self.q_records = Queue()
+        self.buffers = {name: [] for name in events.values()}
+        self.read_times = {name: [] for name in events.values()}   # [count, read_ns] of buffered batches
+        self.n_buffered = {name: 0 for name in events.values()}
+        self.n_written = {name: 0 for name in events.values()}
+        self.write_time = 0.        # Time spent writing to file (s)
+        self.error = None
+
+        # Streams with timestamps stored as differences
+        self.delta_ts = {
+            name: grp[name].attrs.get('ts_encoding') == ts_delta
+            for name in events.values()
+        }
+        self.last_ts = {name: 0 for name in events.values()}
+
+    def put(self, records, read_ns=None):
+        '''Add (N, 3) array of records to be written
+        `read_ns` is the host time records were read (for latency).
+        '''
+        self.q_records.put((records, read_ns))
+
+    def close(self):
+        '''Write remaining records, trim datasets and stop thread'''
+        self.q_records.put(None)
+        self.join()
+        if self.error:
+            print('Error writing data: {}'.format(self.error))
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.q_records.get(timeout=self.flush_interval)
+            except Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self.add(*item)
+
+            now = time.time()
+            timed_out = now - last_flush >= self.flush_interval
+            for name, n in self.n_buffered.items():
+                if n >= self.flush_size or (timed_out and n):
+                    self.flush(name)
+            if timed_out: last_flush = now
+
+        for name, n in self.n_buffered.items():
+            if n: self.flush(name)
+        try:
+            self.trim()
+        except Exception as err:
+            self.error = self.error or err
+
+    def add(self, records, read_ns=None):
+        '''Sort records into buffers by code'''
+
+        codes = records[:, 0]
+        for code, name in self.events.items():
+            rows = records[codes == code, 1:]
+            if len(rows):
+                self.buffers[name].append(rows)
+                self.n_buffered[name] += len(rows)
+                if self.latency is not None and read_ns is not None:
+                    self.read_times[name].append((len(rows), read_ns))
+
+    def flush(self, name):
+        '''Write buffer for stream `name` as one block'''
+
+        block = np.concatenate(self.buffers[name])
+        if self.delta_ts[name]:
+            # Differences are from last timestamp stored, so only advance it
+            # once block is written
+            last_ts = block[-1, 0]
+            block[:, 0] = np.diff(block[:, 0], prepend=self.last_ts[name])
+        start = self.n_written[name]
+        end = start + len(block)
+        t0 = time.time()
+        t0_ns = latency.now_ns()
+        try:
+            dset = self.grp[name]
+            if end > dset.shape[1]:
+                dset.resize((2, max(end, dset.shape[1] * growth)))
+            dset[:, start:end] = block.T
+        except Exception as err:
+            # Keep thread alive so other streams are still written
+            self.error = err
+        else:
+            self.n_written[name] += len(block)
+            if self.delta_ts[name]: self.last_ts[name] = last_ts
+            if self.latency is not None:
+                done_ns = latency.now_ns()
+                self.latency.add('write', done_ns - t0_ns, len(block))
+                for count, read_ns in self.read_times[name]:
+                    self.latency.add('total', done_ns - read_ns, count)
+        self.write_time += time.time() - t0
+        self.buffers[name] = []
+        self.read_times[name] = []
+        self.n_buffered[name] = 0
+
+    def trim(self):
+        '''Resize datasets to number of records written'''
+
+        for name, n in self.n_written.items():
+            self.grp[name].resize((2, n))
+
+
+class SharedWriter(threading.Thread):
+    '''Thread writing records of several sessions
+    Each session gets a writer from `add`, which is used like a `DataWriter` 
+    (`put` and `close`) without starting a thread of its own. Buffers of all 
+    sessions are flushed by this thread as in `DataWriter`.
+    '''
+
+    def __init__(self, flush_size=4096, flush_interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.q_records = Queue()
+        self.writers = []
+
+    def add(self, grp, events, latency=None):
+        '''Writer for datasets in `grp` (see `DataWriter`)'''
+        return SessionWriter(self, DataWriter(grp, events, self.flush_size, self.flush_interval, latency))
+
+    def close(self):
+        '''Stop thread once sessions are closed'''
+        self.q_records.put(None)
+        self.join()
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.q_records.get(timeout=self.flush_interval)
+            except Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                session, records, read_ns = item
+                if records is None:
+                    self.finish(session)
+                else:
+                    if session.writer not in self.writers:
+                        self.writers.append(session.writer)
+                    session.writer.add(records, read_ns)
+
+            now = time.time()
+            timed_out = now - last_flush >= self.flush_interval
+            for writer in self.writers:
+                for name, n in writer.n_buffered.items():
+                    if n >= self.flush_size or (timed_out and n):
+                        writer.flush(name)
+            if timed_out: last_flush = now
+
+    def finish(self, session):
+        '''Write remaining records of session and trim its datasets'''
+
+        writer = session.writer
+        for name, n in writer.n_buffered.items():
+            if n: writer.flush(name)
+        try:
+            writer.trim()
+        except Exception as err:
+            writer.error = writer.error or err
+        if writer in self.writers:
+            self.writers.remove(writer)
+        session.closed.set()
+
+
+class SessionWriter(object):
+    '''Writer of one session in `SharedWriter`'''
+
+    def __init__(self, shared, writer):
+        self.shared = shared
+        self.writer = writer
+        self.closed = threading.Event()
+
+    @property
+    def error(self):
+        return self.writer.error
+
+    @property
+    def n_written(self):
+        return self.writer.n_written
+
+    @property
+    def write_time(self):
+        return self.writer.write_time
+
+    def put(self, records, read_ns=None):
+        '''Add (N, 3) array of records to be written'''
+        self.shared.q_records.put((self, records, read_ns))
+
+    def close(self):
+        '''Write remaining records and trim datasets'''
+        self.shared.q_records.put((self, None, None))
+        self.closed.wait()
+        if self.error:
+            print('Error writing data: {}'.format(self.error))
@@ -3,21 +3,53 @@ Free licking
 
 Opens solenoid with every lick. Data is not recorded.
 
+Host can raise baud rate before starting (see Behavior::ChangeBaud); any
+other byte starts the session.
+
  */
 
+#include <Behavior.h>
+
+#define BAUD 9600         // Initial baud rate; host can raise it (CODEBAUD)
+#define MAXBAUD 2000000   // Fastest baud rate offered to host
+
 const int lick_pin = 3;
 const int sol_pin = 13;
 
 const int sol_dur = 20;  // Duration solenoid is open
 unsigned long ts_sol_on;
+unsigned long baud = BAUD;
+
+Behavior behav;
+
+void WaitForStart() {
+  // Handle baud rate changes from host until any other byte arrives
+  while (1) {
+    if (Serial.available() <= 0) continue;
+    switch(Serial.read()) {
+      case CODEBAUD:
+        baud = behav.ChangeBaud(Serial, baud);
+        break;
+      case CODEBAUDCHECK:
+        Serial.println("Baud OK");
+        break;
+      case '\r':
+      case '\n':
+        break;
+      default:
+        return;
+    }
+  }
+}
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD);
   pinMode(lick_pin, INPUT);
   pinMode(sol_pin, OUTPUT);
 
+  behav.SendMaxBaud(Serial, MAXBAUD);
   Serial.println("Waiting for signal...");
-  while (Serial.available() <= 0);
+  WaitForStart();
   Serial.println("Start!");
 }
 
@@ -25,7 +57,7 @@ void loop() {
   static const unsigned long start_time = millis();
   static boolean lick_state_prev;
 
-  unsigned long ts = millis() - start;
+  unsigned long ts = millis() - start_time;
   if (ts >= ts_sol_on + sol_dur) digitalWrite(sol_pin, LOW);
   
   boolean lick_state_now = digitalRead(lick_pin);
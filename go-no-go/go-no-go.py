@@ -39,7 +39,6 @@ if is_py2:
     import tkMessageBox
     import tkFileDialog
     from ScrolledText import ScrolledText
-    from Queue import Queue
 else:
     import tkinter as tk
     import tkinter.ttk as ttk
@@ -47,8 +46,8 @@ else:
     import tkinter.messagebox as tkMessageBox
     import tkinter.filedialog as tkFileDialog
     from tkinter.scrolledtext import ScrolledText
-    from queue import Queue
 from PIL import ImageTk
+import argparse
 import collections
 import serial
 import serial.tools.list_ports
@@ -67,6 +66,16 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolb
 from slackclient import SlackClient
 import pdb
 
+# Shared modules are in parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import serial_stream
+import data_writer
+import journal
+import live_data_view
+import port_watch
+import clock_sync
+import latency
+
 
 # Setup Slack
 try:
@@ -98,17 +107,13 @@ opts_frame0 = {'pady': 15, }
 opts_frame1 = {'padx': 15, 'pady': 5, }
 opts_frame2 = {'padx': 5, }
 
-# Serial input codes
-code_end = 0;
-code_lick = 1;
-code_lick_form = 9;
-code_movement = 2;
-code_trial_start = 3;
-code_trial_signal = 4;
-code_cs_start = 5;
-code_us_start = 6;
-code_response = 7;
-code_next_trial = 8;
+# Serial input codes and datasets are shared with headless sessions
+from session import (
+    code_end, code_lick, code_lick_form, code_movement, code_trial_start,
+    code_trial_signal, code_cs_start, code_us_start, code_response,
+    code_next_trial, events, compressed_events, arduino_events,
+)
+import session
 
 # Serial output codes
 # Should do following as byte in decimal form...
@@ -129,17 +134,17 @@ code_cs0 = '='          # bytes([61])
 code_cs1 = '>'          # bytes([62])
 code_cs2 = '?'          # bytes([63])
 
-# Events to record
-events = [
-    'lick', 'lick_form', 'movement',
-    'trial_start', 'trial_signal', 'cs', 'us',
-    'response',
-]
+# Processing of incoming data on GUI thread
+drain_budget = 20       # ms of processing before yielding to Tk
+drain_batch = 4096      # Records taken from buffer at a time
+poll_rate = 5           # ms between checks for data from reader
+display_rate = 200      # ms between updates of counters and plots
+ports_poll_rate = 250   # ms between checks for changed ports
 
 
 class InputManager(ttk.Frame):
 
-    def __init__(self, parent):
+    def __init__(self, parent, rig='go-no-go'):
         ttk.Frame.__init__(self, parent)
 
         # GUI layout
@@ -162,6 +167,7 @@ class InputManager(ttk.Frame):
         #   + slack_frame
         # - frame_monitor
         #   + frame_solenoid
+        #   + frame_psth
         # 
         # parameters
         # - frame_gonogo
@@ -171,6 +177,7 @@ class InputManager(ttk.Frame):
         # - frame_misc
 
         self.parent = parent
+        self.rig = rig      # Name under which port last used is remembered
         parent.columnconfigure(0, weight=1)   # centers frame (also fills col, but that's automatic being the only row)
 
         # Variables
@@ -214,10 +221,17 @@ class InputManager(ttk.Frame):
         self.var_image_all = tk.IntVar()
         self.var_image_ttl_dur = tk.IntVar()
         self.var_track_period = tk.IntVar()
+        self.var_compression = tk.StringVar()
+        self.var_delta_ts = tk.BooleanVar()
         self.var_use_cam = tk.BooleanVar()
         self.var_serial_status = tk.StringVar()
         self.var_verbose = tk.BooleanVar()
         self.var_print_arduino = tk.BooleanVar()
+        self.var_hold_port = tk.BooleanVar()
+        self.var_buffer_fill = tk.StringVar()
+        self.var_drain_stats = tk.StringVar()
+        self.var_measure_latency = tk.BooleanVar()
+        self.var_latency = collections.OrderedDict((stage, tk.StringVar()) for stage in latency.stages)
         self.var_suppress_print_lick_form = tk.BooleanVar()
         self.var_suppress_print_movement = tk.BooleanVar()
         self.var_subject = tk.StringVar()
@@ -282,6 +296,10 @@ class InputManager(ttk.Frame):
         self.var_image_all.set(0)
         self.var_image_ttl_dur.set(100)
         self.var_track_period.set(50)
+        self.var_compression.set('gzip')
+        self.var_delta_ts.set(False)
+        self.var_hold_port.set(True)
+        for var in self.var_latency.values(): var.set('-')
         self.var_serial_status.set('Closed')
         self.var_next_trial_time.set('--')
         self.var_next_trial_type.set('--')
@@ -400,6 +418,11 @@ class InputManager(ttk.Frame):
         frame_count_row0.grid(row=0, column=0, sticky='we', pady=5)
         frame_count_row1.grid(row=1, column=0, sticky='we', pady=5)
 
+        ### Lick raster and PSTH
+        frame_psth = ttk.Frame(frame_monitor)
+        frame_psth.grid(row=1, column=0, columnspan=3, sticky='we', **opts_frame1)
+        frame_psth.grid_columnconfigure(0, weight=1)
+
         # Add GUI components
 
         ## frame_params
@@ -452,6 +475,12 @@ class InputManager(ttk.Frame):
         self.check_image_all.grid(row=0, column=1, sticky='w')
         self.entry_image_ttl_dur.grid(row=1, column=1, sticky='w')
         self.entry_track_period.grid(row=2, column=1, sticky='w')
+        self.option_compression = ttk.OptionMenu(frame_misc, self.var_compression, self.var_compression.get(), *sorted(data_writer.compression_filters))
+        self.check_delta_ts = ttk.Checkbutton(frame_misc, variable=self.var_delta_ts)
+        ttk.Label(frame_misc, text='Compression: ', anchor='e').grid(row=3, column=0, sticky='e')
+        ttk.Label(frame_misc, text='Delta timestamps: ', anchor='e').grid(row=4, column=0, sticky='e')
+        self.option_compression.grid(row=3, column=1, sticky='w')
+        self.check_delta_ts.grid(row=4, column=1, sticky='w')
 
         ## frame_cam
         self.check_use_cam = ttk.Checkbutton(frame_cam, variable=self.var_use_cam, text='Use camera')
@@ -479,9 +508,9 @@ class InputManager(ttk.Frame):
         ## Arduino setup
         self.port_var = tk.StringVar()
         self.option_ports = ttk.OptionMenu(frame_arduino1, self.port_var, [])
-        self.button_update_ports = ttk.Button(frame_arduino1, text='u', command=self.update_ports, **opts_button)
+        self.button_update_ports = ttk.Button(frame_arduino1, text='u', command=self.refresh_ports, **opts_button)
         self.button_open_port = ttk.Button(frame_arduino2, text='Open', command=self.open_serial, **opts_button)
-        self.button_close_port = ttk.Button(frame_arduino2, text='Close', command=self.close_serial, **opts_button)
+        self.button_close_port = ttk.Button(frame_arduino2, text='Close', command=lambda: self.close_serial(hold=False), **opts_button)
         tk.Label(frame_arduino1, text='Port: ').grid(row=0, column=0, sticky='e')
         tk.Label(frame_arduino1, text='State: ').grid(row=1, column=0, sticky='e')
         self.option_ports.grid(row=0, column=1, sticky='we', **opts_frame2)
@@ -500,10 +529,27 @@ class InputManager(ttk.Frame):
         self.check_print_arduino = ttk.Checkbutton(frame_debug, text='Print Arduino serial', variable=self.var_print_arduino)
         self.check_suppress_print_lick_form = ttk.Checkbutton(frame_debug, text='Suppress lick output', variable=self.var_suppress_print_lick_form)
         self.check_suppress_print_movement = ttk.Checkbutton(frame_debug, text='Suppress movement output', variable=self.var_suppress_print_movement)
+        self.check_hold_port = ttk.Checkbutton(frame_debug, text='Keep port open between sessions', variable=self.var_hold_port)
+        self.check_measure_latency = ttk.Checkbutton(frame_debug, text='Measure latency', variable=self.var_measure_latency)
         self.check_verbose.grid(row=0, column=0, sticky='w')
         self.check_print_arduino.grid(row=1, column=0, sticky='w')
         self.check_suppress_print_lick_form.grid(row=2, column=0, sticky='w')
         self.check_suppress_print_movement.grid(row=3, column=0, sticky='w')
+        self.check_hold_port.grid(row=4, column=0, sticky='w')
+        self.check_measure_latency.grid(row=5, column=0, sticky='w')
+        frame_buffer = ttk.Frame(frame_debug)
+        frame_buffer.grid(row=6, column=0, sticky='w')
+        ttk.Label(frame_buffer, text='Serial buffer: ').grid(row=0, column=0, sticky='e')
+        ttk.Entry(frame_buffer, textvariable=self.var_buffer_fill, state='readonly', **opts_entry10).grid(row=0, column=1, sticky='w')
+        ttk.Label(frame_buffer, text='Processing: ').grid(row=1, column=0, sticky='e')
+        ttk.Entry(frame_buffer, textvariable=self.var_drain_stats, state='readonly').grid(row=1, column=1, sticky='w')
+        frame_latency = ttk.Frame(frame_debug)
+        frame_latency.grid(row=7, column=0, sticky='w')
+        ttk.Label(frame_latency, text='Latency p50/p99 (ms)').grid(row=0, column=0, columnspan=4, sticky='w')
+        for i, (stage, var) in enumerate(self.var_latency.items()):
+            row, col = 1 + i // 2, 2 * (i % 2)
+            ttk.Label(frame_latency, text=stage + ': ').grid(row=row, column=col, sticky='e')
+            ttk.Entry(frame_latency, textvariable=var, state='readonly', **opts_entry10).grid(row=row, column=col + 1, sticky='w')
 
         ## frame_info
         ## UI for session info.
@@ -640,6 +686,10 @@ class InputManager(ttk.Frame):
         ttk.Label(frame_count_row1, text='Lick count: ', anchor='e').grid(row=4, column=0, sticky='e')
         ttk.Entry(frame_count_row1, textvariable=self.var_counter_lick_onset, state='readonly', **opts_entry10).grid(row=4, column=1, sticky='e')
 
+        # frame_psth
+        # Licks aligned to CS onset by CS type
+        self.psth = live_data_view.PeriEventView(frame_psth, n_types=3, labels=['CS0', 'CS1', 'CS2'])
+
         ## Group GUI objects
         self.obj_to_disable_at_open = [
             self.radio_conditioning,
@@ -678,7 +728,10 @@ class InputManager(ttk.Frame):
         ]
         self.obj_to_disable_at_start = [
             self.button_close_port,
+            self.option_compression,
+            self.check_delta_ts,
             self.check_print_arduino,
+            self.check_measure_latency,
             self.check_suppress_print_lick_form,
             self.check_suppress_print_movement,
             self.entry_subject,
@@ -711,31 +764,40 @@ class InputManager(ttk.Frame):
         # Finalize
         self.update_param_preview()
         self.parameters = collections.OrderedDict()
-        self.ser = serial.Serial(timeout=1, baudrate=9600)
-        self.update_ports()
-        self.q_serial = Queue()
+        self.data_format = serial_stream.format_ascii
+        self.ser = serial.Serial(timeout=1, baudrate=serial_stream.base_baud)
+
+        # Ports are listed in background and menu is updated when they change.
+        # Tk is not thread-safe, so the watcher only flags changes, which are
+        # checked from the main loop.
+        self.port_var.set('Searching for ports...')
+        self.ports_changed = threading.Event()
+        self.port_watcher = port_watch.PortWatcher(on_change=lambda watcher: self.ports_changed.set())
+        parent.after_idle(self.port_watcher.start)
+        parent.after_idle(self.check_ports)
+        self.q_serial = serial_stream.RingBuffer()
+        self.in_session = False
+        self.drain_pending = None
+        self.drain_stats = {'ticks': 0, 'items': 0, 'overruns': 0}
+        self.latency = None
+
+        # Counts are kept as plain integers while acquiring and only pushed to
+        # the Tk variables for display (see `update_counters`)
+        self.counts = np.zeros(max(arduino_events) + 1, dtype=int)  # By Arduino code
+        self.counts_cs = np.zeros(3, dtype=int)
+        self.counts_responses = np.zeros(3, dtype=int)
+        self.count_lick_onset = 0
+        self.next_trial = None
         self.counter = {
-            ev: var_count
-            for ev, var_count in zip(events, [
-                self.var_counter_lick,
-                self.var_counter_lick_form,
-                self.var_counter_movement,
-                self.var_counter_trial_start,
-                self.var_counter_trial_signal,
-                self.var_counter_cs,
-                self.var_counter_response,
-                self.var_counter_us,
-            ])
+            'lick': self.var_counter_lick,
+            'lick_form': self.var_counter_lick_form,
+            'movement': self.var_counter_movement,
+            'trial_start': self.var_counter_trial_start,
+            'trial_signal': self.var_counter_trial_signal,
+            'cs': self.var_counter_cs,
+            'us': self.var_counter_us,
+            'response': self.var_counter_response,
         }
-        self.counter_gui = [
-            self.var_counter_cs0,
-            self.var_counter_cs1,
-            self.var_counter_cs2,
-            self.var_counter_cs0_responses,
-            self.var_counter_cs1_responses,
-            self.var_counter_cs2_responses,
-            self.var_counter_lick_onset,
-        ]
 
     def gui_util(self, option):
         '''Updates GUI components
@@ -749,6 +811,7 @@ class InputManager(ttk.Frame):
                 
                 # Disable object
                 obj['state'] = 'disabled'
+            self.button_close_port['state'] = 'disabled'    # Enabled if port was held open
 
             self.var_serial_status.set('Opening...')
         elif option == 'opened':
@@ -1027,37 +1090,16 @@ class InputManager(ttk.Frame):
     def open_serial(self, delay=3, timeout=5, code_params='D'):
         '''Open serial connection to Arduino
         Executes when 'Open' button is pressed. `delay` sets amount of time (in
-        seconds) to wait for the Arduino to be ready after serial is open.
+        seconds) to wait for the Arduino to be ready after serial is open. 
+        Connecting and uploading parameters run in a worker thread 
+        (`serial_stream.Connector`) and `check_open` follows progress, so the 
+        GUI is not blocked. If the port was held open after the last session, 
+        Arduino is restarted without a reset and `delay` is skipped.
         '''
         
         # Disable GUI components
         self.gui_util('open')
 
-        # Open serial
-        self.ser.port = self.port_var.get()
-        try:
-            self.ser.open()
-        except serial.SerialException as err:
-            # Error during serial.open()
-            err_msg = err.args                                           # Could be done bettter...
-            tkMessageBox.showerror('Serial error', err_msg)
-            print('Serial error: {}'.format(err_msg))
-            self.close_serial()
-            self.gui_util('close')
-            return
-        else:
-            # Serial opened successfully
-            time.sleep(delay)
-            self.gui_util('opened')
-            if self.var_verbose.get(): print('Connection to Arduino opened')
-
-        # Handle opening message from serial
-        if self.var_print_arduino.get():
-            while self.ser.in_waiting:
-                sys.stdout.write(arduino_head + ser_readline(self.ser))
-        else:
-            self.ser.flushInput()
-
         # Define parameters
         # NOTE: Order is important here since this order is preserved when 
         # sending via serial.
@@ -1103,48 +1145,107 @@ class InputManager(ttk.Frame):
         self.parameters['image_ttl_dur'] = self.var_image_ttl_dur.get()
         self.parameters['track_period'] = self.var_track_period.get()
         
-        # Send parameters and make sure it's processed
-        values = self.parameters.values()
+        # Parameters are echoed back, and processed once Arduino waits for 
+        # start signal
+        values = list(self.parameters.values())
         if self.var_verbose.get(): print('Sending parameters: {}'.format(values))
-        ser_write(self.ser, code_params + '+'.join(str(s) for s in values))
-
-        start_time = time.time()
-        while 1:
-            if self.ser.in_waiting:
-                if self.var_print_arduino.get():
-                    # Print incoming data
-                    while self.ser.in_waiting:
-                        sys.stdout.write(arduino_head + ser_readline(self.ser))
-                print('Parameters uploaded to Arduino')
-                print('Ready to start')
-                return
-            elif time.time() >= start_time + timeout:
-                print('Error sending parameters to Arduino')
-                print('Uploading timed out. Start signal not found. Make sure Arduino is configured.')
-                self.gui_util('close')
-                self.close_serial()
-                return
+        self.connector = serial_stream.Connector(
+            self.ser, self.port_var.get(), serial_stream.params_message(values, code_params),
+            delay=delay, timeout=timeout, values=values,
+            ack=lambda line: True if 'Waiting for start signal' in line else None,
+            verbose=self.var_verbose.get(),
+            print_head=arduino_head if self.var_print_arduino.get() else None,
+        )
+        self.connector.start()
+        self.check_open()
+
+    def check_open(self, poll=50):
+        '''Follow connection to Arduino until parameters are uploaded'''
+
+        connector = self.connector
+        status = {
+            'opening': 'Opening...',
+            'restarting': 'Restarting Arduino...',
+            'resetting': 'Waiting for Arduino...',
+            'handshake': 'Waiting for Arduino...',
+            'baud': 'Setting baud rate...',
+            'uploading': 'Uploading...',
+            'acknowledging': 'Uploading...',
+        }
+        if not connector.finished:
+            self.var_serial_status.set(status[connector.state])
+            self.parent.after(poll, self.check_open)
+            return
 
-    def close_serial(self):
-        '''Close serial connection to Arduino on button press'''
+        if connector.error:
+            if not self.ser.is_open:
+                # Error during serial.open()
+                tkMessageBox.showerror('Serial error', connector.error)
+                print('Serial error: {}'.format(connector.error))
+            else:
+                print('Error sending parameters to Arduino: {}'.format(connector.error))
+                print('Make sure Arduino is configured.')
+            self.close_serial(hold=False)
+            return
 
-        self.ser.close()
+        self.data_format = connector.data_format
+        self.gui_util('opened')
+        port_watch.remember(self.rig, self.port_watcher.ids.get(connector.port, connector.port))
+        print('Parameters uploaded to Arduino')
+        print('Ready to start')
+
+    def close_serial(self, hold=None):
+        '''Close serial connection to Arduino
+        The Close button always closes the port. At the end of a session, if 
+        'Keep port open between sessions' is checked (and `hold` is not 
+        False), the port is held open so the next parameters can be uploaded 
+        without resetting Arduino; Close stays enabled to release it.
+        '''
+
+        if hold is None: hold = self.var_hold_port.get()
+        if not hold: self.ser.close()
         self.gui_util('close')
-        if self.var_verbose.get(): print('Connection to Arduino closed')
+        if self.ser.is_open:
+            self.button_close_port['state'] = 'normal'
+            self.var_serial_status.set('Held open')
+            if self.var_verbose.get(): print('Connection to Arduino held open')
+        elif self.var_verbose.get():
+            print('Connection to Arduino closed')
+
+    def refresh_ports(self):
+        '''List ports again on button press (menu updates if they changed)'''
+
+        self.port_watcher.refresh()
+
+    def check_ports(self):
+        '''Update menu if port watcher found changes
+        Runs every `ports_poll_rate` ms on the main loop.
+        '''
+
+        if self.ports_changed.is_set():
+            self.ports_changed.clear()
+            self.update_ports()
+        self.parent.after(ports_poll_rate, self.check_ports)
 
     def update_ports(self):
-        '''Updates list of available ports on button press'''
+        '''Updates menu of available ports from port watcher
+        Selected port is kept if still available. Otherwise, the port this rig 
+        was last used with is selected, found by its stable ID in case its 
+        device name changed.
+        '''
 
-        ports_info = list(serial.tools.list_ports.comports())
-        ports = [port.device for port in ports_info]
-        ports_description = [port.description for port in ports_info]
+        ports_info = self.port_watcher.ports     # Includes virtual Arduinos
+        ports = [port for port, _ in ports_info]
+        ports_description = [description for _, description in ports_info]
 
         menu = self.option_ports['menu']
         menu.delete(0, 'end')
         if ports:
             for port, description in zip(ports, ports_description):
                 menu.add_command(label=description, command=lambda com=port: self.port_var.set(com))
-            self.port_var.set(ports[0])
+            if self.port_var.get() not in ports:
+                last_port = self.port_watcher.find(port_watch.last_used(self.rig))
+                self.port_var.set(last_port or ports[0])
         else:
             self.port_var.set('No ports found')
 
@@ -1181,47 +1282,21 @@ class InputManager(ttk.Frame):
             # Default file name
             if not os.path.exists('data'):
                 os.makedirs('data')
-            now = datetime.now()
-            filename = 'data/data-' + now.strftime('%y%m%d-%H%M%S') + '.h5'
-            self.data_file = h5py.File(filename, 'x')
+            self.data_file = h5py.File(session.default_filename(), 'x')
 
         # Create group for experiment
         # Append to existing file (if applicable). If group already exists, append number to name.
-        date = str(datetime.now().date())
-        subj = self.var_subject.get() or '?'
-        index = 0
-        file_index = ''
-        while True:
-            try:
-                self.grp_exp = self.data_file.create_group('{}/{}'.format(subj, date + file_index))
-            except (RuntimeError, ValueError):
-                index += 1
-                file_index = '-' + str(index)
-            else:
-                break
+        self.grp_exp = session.create_experiment_group(self.data_file, self.var_subject.get())
         self.grp_exp['weight'] = self.var_weight.get()
 
         # Initialize datasets
-        n_trials = self.parameters['cs0_num'] + self.parameters['cs1_num'] + self.parameters['cs2_num']
-        if n_trials:
-            session_time = n_trials * self.parameters['mean_iti']
-        else:
-            n_trials = 1   # in order for chunk to work dataset needs to be bigger than chunk size
-            session_time = self.var_session_dur.get()
-        n_movement_frames = 2 * (session_time + self.parameters['pre_session'] + self.parameters['post_session']
-            ) / self.parameters['track_period']
-        if not n_movement_frames: n_movement_frames = 1 # same reason for n_trial = 1 above
-        chunk_size = (2, 1)
-
+        # Datasets grow as data arrives. Expected event rates (per s) only set 
+        # chunk sizes so large blocks of each stream are stored together.
         self.grp_behav = self.grp_exp.create_group('behavior')
-        self.grp_behav.create_dataset(name='lick', dtype='uint32', shape=(2, n_movement_frames), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='lick_form', dtype='uint32', shape=(2, n_movement_frames), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='movement', dtype='int32', shape=(2, n_movement_frames), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='trial_start', dtype='uint32', shape=(2, n_trials), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='trial_signal', dtype='uint32', shape=(2, n_trials), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='cs', dtype='uint32', shape=(2, n_trials), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='us', dtype='uint32', shape=(2, n_movement_frames), chunks=chunk_size)
-        self.grp_behav.create_dataset(name='response', dtype='uint32', shape=(2, n_trials), chunks=chunk_size)
+        streams = session.session_streams(self.parameters)
+        compression = {ev: self.var_compression.get() for ev in compressed_events}
+        delta_ts = {ev: self.var_delta_ts.get() for ev in compressed_events}
+        data_writer.create_datasets(self.grp_behav, streams, compression=compression, delta_ts=delta_ts)
 
         # self.grp_cam = self.data_file.create_group('cam')
         # self.dset_ts = self.grp_cam.create_dataset('timestamps', dtype=float,
@@ -1235,28 +1310,58 @@ class InputManager(ttk.Frame):
         # self.grp_cam.attrs['hsub'] = self.var_hsub.get()
 
         # Store session parameters into behavior group
-        for key, value in self.parameters.items():
+        attrs = collections.OrderedDict(self.parameters)
+        attrs['data_format'] = self.data_format
+        attrs['baud_rate'] = self.ser.baudrate
+        for key, value in attrs.items():
             self.grp_behav.attrs[key] = value
 
+        # Time records spend in each stage from serial to file (optional)
+        self.latency = latency.Latency() if self.var_measure_latency.get() else None
+
+        # Write data to file from separate thread
+        self.writer = data_writer.DataWriter(self.grp_behav, arduino_events, latency=self.latency)
+        self.writer.start()
+
+        # Journal raw records so session can be recovered if GUI or file fails
+        self.journal = journal.Journal(
+            journal.journal_path(self.data_file.filename, self.grp_exp.name),
+            journal.session_metadata(self.grp_exp.name, arduino_events, streams, compression, delta_ts, attrs),
+        )
+
         # Setup multithreading for serial scan and recording
-        for q in [self.q_serial, ]:
-            with q.mutex:
-                q.queue.clear()
+        # Reader only fills ring buffer (Tk is not thread-safe); main loop
+        # polls it
+        self.q_serial.clear()
+
+        # Reader stamps data with host time; Arduino is pinged during session
+        # to fit its clock to the host's
+        self.clock = clock_sync.ClockSync()
 
         suppress = [
             code_lick_form if self.var_suppress_print_lick_form.get() else None,
             code_movement if self.var_suppress_print_movement.get() else None
         ]
         thread_scan = threading.Thread(
-            target=scan_serial,
-            args=(self.q_serial, self.ser, self.var_print_arduino.get(), suppress),
+            target=serial_stream.scan_serial,
+            args=(self.q_serial, self.ser, self.var_print_arduino.get(), suppress, code_end, self.data_format,
+                  self.journal, self.clock, self.latency),
         )
         thread_scan.daemon = True
 
         # Reset counters
-        # self.counter = {ev: 0 for ev in events}
-        for counter in self.counter.values(): counter.set(0)
-        for counter_gui in self.counter_gui: counter_gui.set(0)
+        self.counts[:] = 0
+        self.counts_cs[:] = 0
+        self.counts_responses[:] = 0
+        self.count_lick_onset = 0
+        self.next_trial = None
+        self.drain_stats = dict.fromkeys(self.drain_stats, 0)
+        for var in self.var_latency.values(): var.set('-')
+        self.update_counters()
+        self.psth.reset(
+            pre=self.parameters['pre_stim'] or self.psth.pre,
+            post=self.parameters['post_stim'] or self.psth.post,
+        )
 
         # Start session
         ser_write(self.ser, code_start)
@@ -1266,29 +1371,17 @@ class InputManager(ttk.Frame):
         self.grp_exp.attrs['start_time'] = str(self.start_time)
 
         # Update GUI
+        self.in_session = True
+        self.drain_pending = self.parent.after(poll_rate, self.drain_serial)
         self.update_session()
 
     def update_session(self):
-        '''Update with incoming data
-        Checks Queue for incoming data from arduino. Data arrives as comma-
-        separated values with the first element defining the type of data. Data 
-        on GUI is updated, and data is saved to HDF5 file.
+        '''Update GUI during session
+        Runs every `display_rate` ms: handles Stop button and refreshes 
+        counters and plots. Incoming data is processed by `drain_serial`.
         '''
-        
-        # Rate to update GUI; should be faster than incoming data
-        refresh_rate = 10
-
-        # Code-event dictionary
-        event = {
-            code_lick: 'lick',
-            code_lick_form: 'lick_form',
-            code_movement: 'movement',
-            code_trial_start: 'trial_start',
-            code_trial_signal: 'trial_signal',
-            code_cs_start: 'cs',
-            code_us_start: 'us',
-            code_response: 'response',
-        }
+
+        if not self.in_session: return
 
         # End on 'Stop' button (by user)
         if self.var_stop.get():
@@ -1296,50 +1389,119 @@ class InputManager(ttk.Frame):
             ser_write(self.ser, '0')
             print('User triggered stop, sending signal to Arduino...')
 
-        # Watch incoming queue
-        # Data has format: [code, ts, extra values]
-        # Empty queue before leaving. Otherwise, a backlog will grow.
+        self.clock.maybe_ping(self.ser)
+        self.var_buffer_fill.set('{:.1%}'.format(self.q_serial.fill_level))
+        self.update_counters()
+        self.psth.draw()
+        self.parent.after(display_rate, self.update_session)
+
+    def drain_serial(self):
+        '''Process data waiting in ring buffer
+        Runs every `poll_rate` ms during session and takes records from buffer 
+        until it is empty. Stops after `drain_budget` ms so Tk can handle 
+        other events, continuing on the next pass of the event loop (an 
+        overrun).
+        '''
+
+        self.drain_pending = None
+        if not self.in_session: return
+
+        deadline = time.time() + drain_budget / 1000.
+        n_items = 0
+        overrun = False
         while not self.q_serial.empty():
-            code, ts, data = self.q_serial.get()
-
-            # End session
-            if code == code_end:
-                arduino_end = ts
-                # self.q_to_thread_rec.put(0)
-                # while self.q_from_thread_rec.empty():
-                #     pass
+            records = self.q_serial.get(drain_batch)
+            n_items += len(records)
+            read_ns = self.latency.taken(self.q_serial.ix_read) if self.latency else None
+            t0 = latency.now_ns()
+            arduino_end = self.process_records(records, read_ns)
+            if self.latency: self.latency.add('dispatch', latency.now_ns() - t0, len(records))
+            if arduino_end is not None:
                 print('Arduino ended, finalizing data...')
+                self.update_counters()
+                self.psth.draw(force=True)
                 self.stop_session(arduino_end=arduino_end)
                 return
+            if time.time() >= deadline:
+                self.drain_stats['overruns'] += 1
+                overrun = True
+                break
+
+        if n_items:
+            self.drain_stats['ticks'] += 1
+            self.drain_stats['items'] += n_items
+        elif self.q_serial.error is not None:
+            # Reader stopped (eg, Arduino unplugged); data read so far is saved
+            print('Error on serial ({}), finalizing data...'.format(self.q_serial.error))
+            self.stop_session()
+            return
+        self.drain_pending = self.parent.after(1 if overrun else poll_rate, self.drain_serial)
+
+    def process_records(self, records, read_ns=None):
+        '''Handle (N, 3) array of [code, ts, data] records
+        Data is saved to HDF5 file and tallied for GUI. Returns Arduino's end 
+        time if session ended (None otherwise). `read_ns` is the host time 
+        records were read (for latency).
+        '''
 
-            # Record event
-            if code not in [code_next_trial]:
-                self.grp_behav[event[code]][:, self.counter[event[code]].get()] = [ts, data]
-                self.counter[event[code]].set(self.counter[event[code]].get() + 1)
-
-            # Update GUI
-            if code == code_lick:
-                if data == 1:
-                    self.var_counter_lick_onset.set(self.var_counter_lick_onset.get() + 1)
-            elif code == code_cs_start:
-                if data == 0:
-                    self.var_counter_cs0.set(self.var_counter_cs0.get() + 1)
-                elif data == 1:
-                    self.var_counter_cs1.set(self.var_counter_cs1.get() + 1)
-                elif data == 2:
-                    self.var_counter_cs2.set(self.var_counter_cs2.get() + 1)
-            elif code == code_response:
-                if data == 1:
-                    self.var_counter_cs0_responses.set(self.var_counter_cs0_responses.get() + 1)
-                if data == 3:
-                    self.var_counter_cs1_responses.set(self.var_counter_cs1_responses.get() + 1)
-                if data == 5:
-                    self.var_counter_cs2_responses.set(self.var_counter_cs2_responses.get() + 1)
-            elif code == code_next_trial:
-                self.var_next_trial_time.set((self.start_time + timedelta(milliseconds=ts)).strftime('%H:%M:%S'))
-                self.var_next_trial_type.set(data)
-
-        self.parent.after(refresh_rate, self.update_session)
+        self.writer.put(records, read_ns)   # Saved to HDF5 file by writer thread
+
+        # Lick onsets aligned to CS
+        codes = records[:, 0]
+        self.psth.update(
+            records[codes == code_cs_start, 1:],
+            records[(codes == code_lick) & (records[:, 2] == 1), 1],
+        )
+        self.count_records(records)
+
+        # End of session (reader stops at end code, so it is last)
+        is_end = codes == code_end
+        if is_end.any():
+            return int(records[is_end, 1][0])
+        return None
+
+    def count_records(self, records):
+        '''Tally events in (N, 3) array of records'''
+
+        codes, data = records[:, 0], records[:, 2]
+        is_known = (codes >= 0) & (codes < len(self.counts))
+        self.counts += np.bincount(codes[is_known], minlength=len(self.counts))
+
+        is_cs = codes == code_cs_start
+        is_response = codes == code_response
+        for cs in range(len(self.counts_cs)):
+            self.counts_cs[cs] += np.count_nonzero(is_cs & (data == cs))
+            self.counts_responses[cs] += np.count_nonzero(is_response & (data == cs * 2 + 1))
+        self.count_lick_onset += int(np.count_nonzero((codes == code_lick) & (data == 1)))
+
+        is_next_trial = codes == code_next_trial
+        if is_next_trial.any():
+            self.next_trial = records[is_next_trial][-1, 1:].tolist()
+
+    def update_counters(self):
+        '''Show counts on GUI
+        Tk variables are only written here, never read back while acquiring.
+        '''
+
+        for code, name in arduino_events.items():
+            self.counter[name].set(int(self.counts[code]))
+        for var, n in zip([self.var_counter_cs0, self.var_counter_cs1, self.var_counter_cs2], self.counts_cs):
+            var.set(int(n))
+        for var, n in zip([self.var_counter_cs0_responses, self.var_counter_cs1_responses,
+                           self.var_counter_cs2_responses], self.counts_responses):
+            var.set(int(n))
+        self.var_counter_lick_onset.set(self.count_lick_onset)
+        if self.next_trial is not None:
+            ts, trial_type = self.next_trial
+            self.var_next_trial_time.set((self.start_time + timedelta(milliseconds=ts)).strftime('%H:%M:%S'))
+            self.var_next_trial_type.set(trial_type)
+
+        ticks = self.drain_stats['ticks']
+        self.var_drain_stats.set('{} | {:.0f}/tick | {} over'.format(
+            ticks, float(self.drain_stats['items']) / max(ticks, 1), self.drain_stats['overruns']))
+        if self.latency:
+            for stage, var in self.var_latency.items():
+                var.set(self.latency.format(stage))
 
     def stop_session(self, arduino_end=None):
         '''Finalize session
@@ -1348,17 +1510,32 @@ class InputManager(ttk.Frame):
 
         end_time = datetime.now().strftime('%H:%M:%S')
         print('Session ended at {}'.format(end_time))
+
+        self.in_session = False
+        if self.drain_pending is not None:
+            self.parent.after_cancel(self.drain_pending)
+            self.drain_pending = None
         
         self.gui_util('stop')
         self.close_serial()
         # self.cam_close()
 
         print('Writing behavioral data into HDF5 group {}'.format(self.grp_exp.name))
+        self.writer.close()
         self.grp_behav.attrs['end_time'] = end_time
         self.grp_behav.attrs['notes'] = self.scrolled_notes.get(1.0, 'end')
         self.grp_behav.attrs['arduino_end'] = arduino_end
-        for ev in events:
-            self.grp_behav[ev].resize((2, self.counter[ev].get()))
+        self.clock.save(self.grp_behav)
+        if self.var_verbose.get():
+            print('Arduino clock: {clock_drift_ppm:+.1f} ppm, {clock_rms:.6f} s RMS from {clock_n_fit} points ({clock_source})'.format(
+                **self.clock.attrs()))
+        if self.latency:
+            self.latency.save(self.grp_behav)
+            for stage, var in self.var_latency.items():
+                var.set(self.latency.format(stage))
+            if self.var_verbose.get():
+                print('Latency p50/p99 (ms): ' + ', '.join(
+                    '{}: {}'.format(stage, self.latency.format(stage)) for stage in latency.stages))
 
         # self.grp_cam.attrs['end_time'] = end_time
         # if frame_cutoff:
@@ -1370,6 +1547,11 @@ class InputManager(ttk.Frame):
         print('Closing {}'.format(self.data_file.filename))
         self.data_file.close()
 
+        # Journal no longer needed once data is saved
+        self.journal.close(remove=not self.writer.error)
+        if self.writer.error:
+            print('Raw data kept in {}'.format(self.journal.filename))
+
         # Slack that session is done
         if self.var_slack_address.get():
             slack_msg(self.var_slack_address.get(), 'Session ended')
@@ -1413,42 +1595,18 @@ def slack_msg(slack_recipient, msg, test=False, verbose=False):
             print('Unable to send Slack message')
 
 
-# def scan_serial(q_serial, q_to_rec_thread, ser, print_arduino=False):
-def scan_serial(q_serial, ser, print_arduino=False, suppress=[]):
-    '''Check serial for data
-    Continually check serial connection for data sent from Arduino. Send data 
-    through Queue to communicate with main GUI. Stop when `code_end` is 
-    received from serial.
-    '''
-
-    while 1:
-        input_arduino = ser_readline(ser)
-        if not input_arduino: continue
-
-        try:
-            input_split = [int(x) for x in input_arduino.split(',')]
-        except ValueError:
-            # If not all comma-separated values are int castable
-            if print_arduino: sys.stdout.write(arduino_head + input_arduino)
-        else:
-            if print_arduino and input_split[0] not in suppress:
-                # Only print from serial if code is not in list of codes to suppress
-                sys.stdout.write(arduino_head + input_arduino)
-            if input_arduino: q_serial.put(input_split)
-            if input_split[0] == code_end:
-                # q_to_rec_thread.put(0)
-                if print_arduino: print('  Scan complete.')
-                return
-
-
 def main():
+    parser = argparse.ArgumentParser(description='Go/no go & classical conditioning GUI')
+    parser.add_argument('--rig', default='go-no-go', help='Rig name (port last used is remembered by name)')
+    args = parser.parse_args()
+
     # GUI
     root = tk.Tk()
     root.wm_title('Go/no go & classical conditioning')
     # default_font = tkFont.nametofont('TkDefaultFont')
     # default_font.configure(family='Arial')
     # root.option_add('*Font', default_font)
-    InputManager(root)
+    InputManager(root, rig=args.rig)
     root.grid()
     root.mainloop()
 
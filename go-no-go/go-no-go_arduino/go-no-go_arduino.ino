@@ -14,7 +14,11 @@ s. A lick ceased the auditory tone. ITI is 3 s unless a reward was given, extra
 
 Parameters for session are received via serial connection from Python GUI.  Data
 from hardware is routed directly back via serial connection to Python GUI for 
-recording and calculations.
+recording and calculations. Parameters are echoed back with a checksum (see
+Behavior::SendParams). After a session ends, 'P' from host restarts the sketch
+to wait for parameters of the next session without resetting the board.
+'S' (sync ping) is answered right away with the current timestamp so host can
+relate session time to its own clock.
 
 Outputs are coded as [type of information, timestamp, data]. Many of the trial 
 data has `data` encoded as the CS type. Response is coded with CS type and lick 
@@ -51,6 +55,9 @@ Example input:
 #define CODEPARAMS 68
 #define CODESTART 69
 #define DELIM ","         // Delimiter used for serial communication
+#define DATA_FORMAT FORMAT_BINARY  // FORMAT_ASCII for human-readable output
+#define BAUD 9600         // Initial baud rate; host can raise it (CODEBAUD)
+#define MAXBAUD 2000000   // Fastest baud rate offered to host
 #define DEBUG 1
 
 
@@ -78,6 +85,7 @@ const int code_cs_start = 5;
 const int code_us_start = 6;
 const int code_response = 7;
 const int code_next_trial = 8;
+const int code_sync = 10;         // Answer to sync ping (CODESYNC); data counts pings
 
 // Trial codes
 const int code_free_licking = 2;
@@ -131,6 +139,8 @@ unsigned long next_trial_ts;
 unsigned long trial_num;
 unsigned long trial_dur;
 volatile int track_change = 0;   // Rotations within tracking epochs
+unsigned long baud = BAUD;
+unsigned long n_sync = 0;        // Sync pings received
 
 Behavior behav;
 Stream &stream = Serial;
@@ -157,7 +167,8 @@ void EndSession(unsigned long ts) {
   delay(IMGPINDUR);
   digitalWrite(pin_img_stop, LOW);
 
-  while (1);
+  // Host can start next session without resetting Arduino
+  behav.WaitForRestart(stream);
 }
 
 
@@ -259,12 +270,24 @@ void LookForSignal(int waiting_for, unsigned long ts) {
             }
           }
           break;
+        case CODEBAUD:
+          if (waiting_for == 1) baud = behav.ChangeBaud(Serial, baud);
+          break;
+        case CODEBAUDCHECK:
+          Serial.println("Baud OK");
+          break;
         case CODEPARAMS:
           if (waiting_for == 1) return;   // GetParams
           break;
         case CODESTART:
           if (waiting_for == 2) return;   // Start session
           break;
+        case CODEPARAMMODE:
+          if (waiting_for) behav.Restart();   // Upload parameters again
+          break;
+        case CODESYNC:
+          behav.SendData(stream, code_sync, ts, ++n_sync);
+          break;
       }
     }
 
@@ -321,6 +344,7 @@ void GetParams() {
   image_all = parameters[36];
   image_ttl_dur = parameters[37];
   track_period = parameters[38];
+  behav.SendParams(stream, parameters, paramNum);
 
   if (session_type == 0) {
     trial_num = cs0_num + cs1_num + cs2_num;
@@ -331,7 +355,7 @@ void GetParams() {
 }
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD);
   randomSeed(analogRead(0));
 
   // Set pins
@@ -344,12 +368,14 @@ void setup() {
   pinMode(pin_signal, OUTPUT);
   pinMode(pin_img_start, OUTPUT);
   pinMode(pin_img_stop, OUTPUT);
+  behav.SetFormat(DATA_FORMAT);
 
   // Wait for parameters from serial
-  Serial.println(
-    "Go/no-go & Classical conditioning tasks\n"
-    "Waiting for parameters..."
-  );
+  // Data format is announced with opening message
+  Serial.println("Go/no-go & Classical conditioning tasks");
+  behav.SendFormat(stream);
+  behav.SendMaxBaud(stream, MAXBAUD);
+  Serial.println("Waiting for parameters...");
   LookForSignal(1, 0);
   
   GetParams();
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+'''
+Go/no go sessions on several rigs
+
+Runs sessions on many Arduinos from one process. Each rig has its own serial
+reader thread; the main thread saves data from all rigs as it arrives and a
+single `data_writer.SharedWriter` thread writes their datasets, each rig into
+its own `subject/date/behavior` group (same layout as go-no-go.py). Sessions
+are finalized (attrs written) from the main thread, or from an executor
+thread with `--asyncio`, while the writer may still write other rigs. Records
+per second and buffer depth of each rig are reported periodically. A rig
+whose serial fails (eg, Arduino unplugged) is finalized right away and the
+others keep running. Ctrl-C stops all rigs.
+
+With `--asyncio`, all rigs are read on one asyncio event loop instead
+(`serial_async.SerialReader`; POSIX only) and no reader threads are used.
+
+Rigs are listed in a JSON or YAML config file:
+
+    {
+        "file": "data/rigs.h5",
+        "params": {"session_type": 2, "session_dur": 1200000},
+        "rigs": [
+            {"port": "/dev/ttyACM0", "subject": "m1"},
+            {"port": "/dev/ttyACM1", "subject": "m2", "params": {"session_dur": 600000}}
+        ]
+    }
+
+`params` at the top level apply to all rigs; a rig's own `params` override
+them. A rig can also set `file` and `weight`. `port` can instead be the
+port's stable ID (see `python port_watch.py`), which does not change when
+boards are plugged in a different order. Rigs can instead be given as
+`--rig PORT SUBJECT` with parameters from `--params`.
+
+Usage:
+    python go-no-go/rigs.py --config rigs.json
+    python go-no-go/rigs.py --rig /dev/ttyACM0 m1 --rig /dev/ttyACM1 m2 --params params.json
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import h5py
+import serial
+
+# Shared modules are in parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import serial_stream
+import data_writer
+import serial_async
+import port_watch
+import session
+
+
+class Rig(object):
+    '''Arduino on `port` running session for `subject`'''
+
+    def __init__(self, port, subject, parameters, filename, weight=''):
+        self.port = port
+        self.subject = subject
+        self.parameters = parameters
+        self.filename = filename
+        self.weight = weight
+        self.ser = None
+        self.data_format = None
+        self.session = None
+        self.reader = None      # Used instead of reader thread with asyncio
+        self.error = None
+        self.ended = False
+        self.last_records = 0
+
+    @property
+    def name(self):
+        return '{} ({})'.format(self.subject or '?', self.port)
+
+    def connect(self, delay=3, verbose=False):
+        '''Open serial and upload parameters; errors are kept in `error`'''
+
+        try:
+            self.ser = serial.Serial(self.port, serial_stream.base_baud, timeout=1)
+            time.sleep(delay)
+            self.data_format = session.upload_parameters(self.ser, self.parameters, verbose=verbose)
+        except (IOError, serial.SerialException) as err:
+            self.error = err
+            if self.ser is not None: self.ser.close()
+
+
+def load_config(filename):
+    '''Read JSON or YAML config file'''
+
+    with open(filename) as f:
+        if os.path.splitext(filename)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def make_rigs(config, default_file):
+    '''Rigs described by config (see module docstring)'''
+
+    rigs = []
+    for rig in config['rigs']:
+        values = dict(config.get('params', {}))
+        values.update(rig.get('params', {}))
+        rigs.append(Rig(
+            port_watch.resolve(rig['port']), rig.get('subject', ''), session.make_parameters(values),
+            rig.get('file') or config.get('file') or default_file, rig.get('weight', ''),
+        ))
+    return rigs
+
+
+def connect(rigs, delay=3, verbose=False):
+    '''Connect to all rigs in parallel
+    Arduinos reset when the port opens, so waiting for them is the slow part.
+    '''
+
+    threads = [threading.Thread(target=rig.connect, args=(delay, verbose)) for rig in rigs]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    for rig in rigs:
+        if rig.error:
+            print('{}: could not connect ({})'.format(rig.name, rig.error))
+    return [rig for rig in rigs if not rig.error]
+
+
+def report(rigs, writer, interval):
+    '''Print throughput and buffer depth of each rig'''
+
+    print('{:<30}{:>12}{:>10}{:>10}{:>12}'.format('Rig', 'Records/s', 'Depth', 'Waits', 'Records'))
+    for rig in rigs:
+        s = rig.session
+        rate = (s.n_records - rig.last_records) / interval
+        rig.last_records = s.n_records
+        if rig.reader is not None:
+            depth, waits = rig.reader.depth, rig.reader.n_pauses
+        else:
+            depth, waits = len(s.q_serial), s.q_serial.n_waits
+        print('{:<30}{:>12.0f}{:>10}{:>10}{:>12}{}'.format(
+            rig.name, rate, depth, waits, s.n_records, '  ended' if rig.ended else ''))
+    print('Writer queue: {}'.format(writer.q_records.qsize()))
+
+
+def open_sessions(rigs, writer, compression='gzip', delta_ts=False, data_ready=None):
+    '''Create session of each rig; returns open HDF5 files by name'''
+
+    files = {}
+    for rig in rigs:
+        if rig.filename not in files:
+            directory = os.path.dirname(rig.filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            files[rig.filename] = h5py.File(rig.filename, 'a')
+        rig.session = session.Session(
+            rig.ser, files[rig.filename], rig.parameters, rig.data_format,
+            subject=rig.subject, weight=rig.weight, compression=compression, delta_ts=delta_ts,
+            writer=writer, data_ready=data_ready,
+        )
+        print('{}: saving to {} in {}'.format(rig.name, rig.filename, rig.session.grp_exp.name))
+    return files
+
+
+def run(rigs, compression='gzip', delta_ts=False, report_interval=5, stop_timeout=10, notes=''):
+    '''Run sessions on connected rigs until all have ended'''
+
+    # All rigs share one writer thread and wake the main thread on new data
+    writer = data_writer.SharedWriter()
+    data_ready = threading.Event()
+    files = open_sessions(rigs, writer, compression, delta_ts, data_ready)
+
+    # Ctrl-C only flags stop so no data is lost while saving
+    stop_requested = []
+    handler = signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.append(time.time()))
+    try:
+        writer.start()
+        for rig in rigs:
+            rig.session.start()
+        print('Sessions started')
+
+        stopped = None
+        last_report = time.time()
+        running = list(rigs)
+        while running:
+            data_ready.wait(0.5)
+            data_ready.clear()
+            for rig in list(running):
+                try:
+                    ended = rig.session.drain()
+                except IOError as err:
+                    # Reader failed, or ping could not be written
+                    print('{}: error on serial ({})'.format(rig.name, err))
+                    rig.error = err
+                    ended = True
+                else:
+                    if ended: print('{}: Arduino ended session'.format(rig.name))
+                if ended:
+                    rig.ended = True
+                    rig.session.finish(notes)
+                    running.remove(rig)
+
+            now = time.time()
+            if stop_requested and stopped is None:
+                print('User triggered stop, sending signal to Arduinos...')
+                for rig in running: rig.session.stop()
+                stopped = now
+            elif stopped is not None and now - stopped > stop_timeout:
+                for rig in running:
+                    print('{}: Arduino did not end session'.format(rig.name))
+                    rig.session.finish(notes)
+                running = []
+            if report_interval and now - last_report >= report_interval:
+                report(rigs, writer, now - last_report)
+                last_report = now
+    finally:
+        signal.signal(signal.SIGINT, handler)
+
+        # Readers still running (eg, after an error) would fail on closed
+        # ports or write to closed journals
+        for rig in rigs: rig.session.stop_reader()
+        writer.close()
+        for rig in rigs: rig.ser.close()
+        for data_file in files.values(): data_file.close()
+
+
+async def record(rig, notes=''):
+    '''Save data of rig as it arrives until session ends'''
+
+    loop = asyncio.get_event_loop()
+    rig.session.start(read=False)
+    rig.reader = serial_async.SerialReader(rig.ser, rig.data_format, code_end=session.code_end,
+                                           journal=rig.session.journal, clock=rig.session.clock)
+
+    async def ping():
+        while 1:
+            rig.session.clock.maybe_ping(rig.ser)
+            await asyncio.sleep(rig.session.clock.ping_interval)
+
+    pinger = loop.create_task(ping())
+    try:
+        async with rig.reader:
+            async for records in rig.reader:
+                if rig.session.save(records):
+                    print('{}: Arduino ended session'.format(rig.name))
+                    rig.ended = True
+                    break
+        if not rig.ended:
+            print('{}: Arduino did not end session'.format(rig.name))
+    except IOError as err:
+        print('{}: error reading serial ({})'.format(rig.name, err))
+        rig.error = err
+    finally:
+        # Reader is closed on leaving `async with`, so data can be finalized
+        # (also if task is cancelled). Waits for writer, so keep it off the
+        # event loop.
+        pinger.cancel()
+        await loop.run_in_executor(None, rig.session.finish, notes)
+
+
+async def record_all(rigs, writer, report_interval=5, stop_timeout=10, notes=''):
+    '''Record all rigs on one event loop'''
+
+    loop = asyncio.get_event_loop()
+
+    def close_readers():
+        for rig in rigs:
+            if not rig.ended: rig.reader.close()
+
+    def stop():
+        loop.remove_signal_handler(signal.SIGINT)
+        print('User triggered stop, sending signal to Arduinos...')
+        for rig in rigs:
+            if not rig.ended and rig.error is None: rig.session.stop()
+        loop.call_later(stop_timeout, close_readers)
+
+    async def report_periodically():
+        while 1:
+            await asyncio.sleep(report_interval)
+            report(rigs, writer, report_interval)
+
+    loop.add_signal_handler(signal.SIGINT, stop)
+    tasks = [loop.create_task(record(rig, notes)) for rig in rigs]
+    print('Sessions started')
+    reporter = loop.create_task(report_periodically()) if report_interval else None
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if reporter: reporter.cancel()
+        loop.remove_signal_handler(signal.SIGINT)
+
+        # If a rig failed, others are still reading; their readers have to be
+        # closed before ports are
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_async(rigs, compression='gzip', delta_ts=False, report_interval=5, stop_timeout=10, notes=''):
+    '''Run sessions like `run`, reading all rigs on one event loop'''
+
+    writer = data_writer.SharedWriter()
+    files = open_sessions(rigs, writer, compression, delta_ts)
+    try:
+        writer.start()
+        asyncio.run(record_all(rigs, writer, report_interval, stop_timeout, notes))
+    finally:
+        writer.close()
+        for rig in rigs: rig.ser.close()
+        for data_file in files.values(): data_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run go/no go sessions on several rigs')
+    parser.add_argument('--config', help='JSON or YAML file listing rigs')
+    parser.add_argument('--rig', nargs=2, action='append', default=[], metavar=('PORT', 'SUBJECT'),
+                        help='Rig to run (with parameters from --params)')
+    parser.add_argument('--params', help='JSON or YAML file of session parameters for --rig')
+    parser.add_argument('--file', help='HDF5 file to save to if not set in config (appended if it exists)')
+    parser.add_argument('--notes', default='', help='Session notes')
+    parser.add_argument('--compression', choices=sorted(data_writer.compression_filters), default='gzip',
+                        help='Compression of high-rate events')
+    parser.add_argument('--delta-ts', action='store_true', help='Store timestamps of high-rate events as differences')
+    parser.add_argument('--delay', type=float, default=3, help='Time (s) for Arduinos to reset after opening ports')
+    parser.add_argument('--report', type=float, default=5, help='Seconds between reports (0 for none)')
+    parser.add_argument('--stop-timeout', type=float, default=10,
+                        help='Time (s) to wait for Arduinos to end sessions after Ctrl-C')
+    parser.add_argument('--asyncio', action='store_true', help='Read all rigs on one event loop')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    config = load_config(args.config) if args.config else {'rigs': []}
+    if args.params:
+        config.setdefault('params', {}).update(load_config(args.params))
+    config['rigs'] = config['rigs'] + [{'port': port, 'subject': subject} for port, subject in args.rig]
+    if not config['rigs']:
+        parser.error('No rigs given (use --config or --rig)')
+
+    rigs = connect(make_rigs(config, args.file or session.default_filename()), args.delay, args.verbose)
+    if not rigs:
+        return
+    print('Parameters uploaded to {} rigs'.format(len(rigs)))
+    run_rigs = run_async if args.asyncio else run
+    run_rigs(rigs, args.compression, args.delta_ts, args.report, args.stop_timeout, args.notes)
+    print('All done!')
+
+
+if __name__ == '__main__':
+    main()
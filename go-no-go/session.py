@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+'''
+Go/no go session without GUI
+
+Runs a session from the command line: opens serial connection to Arduino,
+uploads parameters, starts session and records data into an HDF5 file with
+the same layout as go-no-go.py until Arduino ends the session. Ctrl-C sends
+the stop signal and data is still saved.
+
+Parameters are those set in the GUI (same names and order as sent to Arduino).
+They are read from a JSON or YAML file and/or set with flags; anything not
+given takes the GUI default. YAML files need PyYAML.
+
+Codes and datasets used by go-no-go.py are defined here.
+
+Usage:
+    python go-no-go/session.py PORT [--params params.json] [--session-dur 600000] [--subject m1] [--file data.h5]
+'''
+
+import argparse
+import collections
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+import h5py
+import numpy as np
+import serial
+
+# Shared modules are in parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import serial_stream
+import data_writer
+import journal
+import clock_sync
+import latency
+
+is_py2 = sys.version[0] == '2'
+arduino_head = '  [a]: '
+
+# Serial input codes
+code_end = 0
+code_lick = 1
+code_lick_form = 9
+code_movement = 2
+code_trial_start = 3
+code_trial_signal = 4
+code_cs_start = 5
+code_us_start = 6
+code_response = 7
+code_next_trial = 8
+
+# Events to record
+events = [
+    'lick', 'lick_form', 'movement',
+    'trial_start', 'trial_signal', 'cs', 'us',
+    'response',
+]
+
+# High-rate events; compressed with option chosen in GUI
+compressed_events = ['lick_form', 'movement']
+
+# Arduino code to save-file variable
+arduino_events = {
+    code_lick: 'lick',
+    code_lick_form: 'lick_form',
+    code_movement: 'movement',
+    code_trial_start: 'trial_start',
+    code_trial_signal: 'trial_signal',
+    code_cs_start: 'cs',
+    code_us_start: 'us',
+    code_response: 'response',
+}
+
+# Session parameters with GUI defaults
+# NOTE: Order is important here since this order is preserved when sending via
+# serial.
+default_parameters = collections.OrderedDict([
+    ('session_type', 1),    # 0: classical conditioning, 1: go/no go, 2: free licking
+    ('pre_session', 0),
+    ('post_session', 0),
+    ('session_dur', 1200000),
+    ('cs0_num', 200),
+    ('cs1_num', 0),
+    ('cs2_num', 0),
+    ('iti_distro', 2),      # 0: fixed, 1: uniform, 2: exponential
+    ('mean_iti', 10000),
+    ('min_iti', 8000),
+    ('max_iti', 20000),
+    ('pre_stim', 0),
+    ('post_stim', 8000),
+    ('cs0_dur', 2000),
+    ('cs0_freq', 6000),
+    ('cs0_pulse', 100),
+    ('us0_dur', 50),
+    ('us0_delay', 3000),
+    ('cs1_dur', 2000),
+    ('cs1_freq', 12000),
+    ('cs1_pulse', 0),
+    ('us1_dur', 50),
+    ('us1_delay', 3000),
+    ('cs2_dur', 2000),
+    ('cs2_freq', 12000),
+    ('cs2_pulse', 0),
+    ('us2_dur', 50),
+    ('us2_delay', 3000),
+    ('consumption_dur', 0),
+    ('vac_dur', 25),
+    ('trial_signal_offset', 0),
+    ('trial_signal_dur', 0),
+    ('trial_signal_freq', 0),
+    ('grace_dur', 500),
+    ('response_dur', 3500),
+    ('timeout_dur', 8000),
+    ('image_all', 0),
+    ('image_ttl_dur', 100),
+    ('track_period', 50),
+])
+
+
+def make_parameters(values={}):
+    '''Session parameters in upload order; `values` override defaults'''
+
+    unknown = set(values) - set(default_parameters)
+    if unknown:
+        raise ValueError('Unknown parameters: {}'.format(', '.join(sorted(unknown))))
+    parameters = collections.OrderedDict(default_parameters)
+    for key, value in values.items():
+        parameters[key] = int(value)
+    return parameters
+
+
+def load_parameters(filename):
+    '''Read parameters from JSON or YAML file (by extension)'''
+
+    with open(filename) as f:
+        if os.path.splitext(filename)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            values = yaml.safe_load(f)
+        else:
+            values = json.load(f)
+    return make_parameters(values or {})
+
+
+def session_streams(parameters):
+    '''Datasets of behavior group with expected event rates (per s)
+    Datasets grow as data arrives. Rates only set chunk sizes so large blocks
+    of each stream are stored together.
+    '''
+
+    track_rate = 1000. / max(parameters['track_period'], 1)
+    trial_rate = 1000. / max(parameters['mean_iti'], 1)
+    return collections.OrderedDict([
+        ('lick', ('uint32', 10)),
+        ('lick_form', ('uint32', 1000)),
+        ('movement', ('int32', track_rate)),
+        ('trial_start', ('uint32', trial_rate)),
+        ('trial_signal', ('uint32', trial_rate)),
+        ('cs', ('uint32', trial_rate)),
+        ('us', ('uint32', 10)),    # Delivered per lick in free licking
+        ('response', ('uint32', trial_rate)),
+    ])
+
+
+def default_filename(now=None):
+    '''Data file used when none is chosen'''
+
+    now = now or datetime.now()
+    return os.path.join('data', 'data-' + now.strftime('%y%m%d-%H%M%S') + '.h5')
+
+
+def create_experiment_group(data_file, subject):
+    '''Create `subject/date` group for session
+    If group already exists, a number is appended to name.
+    '''
+
+    date = str(datetime.now().date())
+    index = 0
+    file_index = ''
+    while True:
+        try:
+            return data_file.create_group('{}/{}'.format(subject or '?', date + file_index))
+        except (RuntimeError, ValueError):
+            index += 1
+            file_index = '-' + str(index)
+
+
+def ser_write(ser, code):
+    if not is_py2:
+        if type(code) is not bytes: code = code.encode()
+    ser.write(code)
+
+
+def read_lines(ser, until, timeout):
+    '''Read from serial until a line containing `until` arrives
+    Returns text read, or None on timeout.
+    '''
+
+    text = ''
+    deadline = time.time() + timeout
+    while until not in text:
+        if time.time() >= deadline:
+            return None
+        line = ser.readline()
+        if not is_py2: line = line.decode('utf-8', 'replace')
+        text += line
+    return text
+
+
+def upload_parameters(ser, parameters, timeout=5, code_params='D', verbose=False, print_arduino=False):
+    '''Set up Arduino on open serial `ser`
+    Reads opening message, moves to fastest baud rate Arduino supports and
+    sends `parameters`. Returns data format announced by Arduino. Raises
+    `IOError` if Arduino does not respond or echoes different parameters.
+    '''
+
+    handshake = read_lines(ser, 'Waiting for parameters', timeout)
+    if handshake is None:
+        raise IOError('No opening message from Arduino')
+    if print_arduino:
+        for line in handshake.splitlines(True):
+            sys.stdout.write(arduino_head + line)
+    data_format = serial_stream.detect_format(handshake)
+    if verbose: print('Data format: {}'.format(data_format))
+
+    max_baud = serial_stream.detect_max_baud(handshake)
+    if max_baud:
+        if serial_stream.negotiate_baud(ser, max_baud, verbose=verbose) is None:
+            raise IOError('Error changing baud rate. Arduino did not respond at any rate.')
+    if verbose: print('Baud rate: {}'.format(ser.baudrate))
+
+    values = list(parameters.values())
+    if verbose: print('Sending parameters: {}'.format(values))
+    ser_write(ser, serial_stream.params_message(values, code_params))
+    response = read_lines(ser, 'Waiting for start signal', timeout)
+    if response is None:
+        raise IOError('Uploading timed out. Start signal not found. Make sure Arduino is configured.')
+    if print_arduino:
+        for line in response.splitlines(True):
+            sys.stdout.write(arduino_head + line)
+    error = serial_stream.check_echo(response, values)
+    if error:
+        raise IOError('Parameters not uploaded correctly: {}'.format(error))
+    return data_format
+
+
+class Session(object):
+    '''Session on Arduino connected to open serial `ser`
+    `parameters` must already be uploaded (see `upload_parameters`). Data is
+    saved in `subject/date/behavior` group of open HDF5 file `data_file`.
+
+    Several sessions can share a `data_writer.SharedWriter` (`writer`) and an 
+    event set whenever any of their readers has data (`data_ready`).
+
+    Arduino is pinged while data is saved to relate its clock to the host's 
+    (`clock`, see `clock_sync`).
+
+    With `measure_latency`, time records spend in each stage from serial to
+    file is tallied (`latency`, see `latency`).
+    '''
+
+    def __init__(self, ser, data_file, parameters, data_format='ascii', subject='', weight='',
+                 compression='gzip', delta_ts=False, print_arduino=False, suppress=[],
+                 writer=None, data_ready=None, measure_latency=False):
+        self.ser = ser
+        self.data_file = data_file
+        self.parameters = parameters
+        self.data_format = data_format
+        self.print_arduino = print_arduino
+        self.suppress = suppress
+        self.counts = dict.fromkeys(events, 0)
+        self.arduino_end = None
+        self.n_records = 0
+        self.data_ready = data_ready or threading.Event()
+        self.q_serial = serial_stream.RingBuffer(notify=self.data_ready.set)
+        self.thread_scan = None
+        self.stop_reading = threading.Event()
+        self.clock = clock_sync.ClockSync()
+        self.latency = latency.Latency() if measure_latency else None
+
+        # Create file structure
+        self.grp_exp = create_experiment_group(data_file, subject)
+        self.grp_exp['weight'] = weight
+        self.grp_behav = self.grp_exp.create_group('behavior')
+        streams = session_streams(parameters)
+        compression = {ev: compression for ev in compressed_events}
+        delta_ts = {ev: delta_ts for ev in compressed_events}
+        data_writer.create_datasets(self.grp_behav, streams, compression=compression, delta_ts=delta_ts)
+
+        # Store session parameters into behavior group
+        self.attrs = collections.OrderedDict(parameters)
+        self.attrs['data_format'] = data_format
+        self.attrs['baud_rate'] = ser.baudrate
+        for key, value in self.attrs.items():
+            self.grp_behav.attrs[key] = value
+
+        self.shared_writer = writer is not None
+        if self.shared_writer:
+            self.writer = writer.add(self.grp_behav, arduino_events, self.latency)
+        else:
+            self.writer = data_writer.DataWriter(self.grp_behav, arduino_events, latency=self.latency)
+        self.journal = journal.Journal(
+            journal.journal_path(data_file.filename, self.grp_exp.name),
+            journal.session_metadata(self.grp_exp.name, arduino_events, streams, compression, delta_ts, self.attrs),
+        )
+
+    def start(self, code_start='E', read=True):
+        '''Start session and serial reader
+        With `read` False, no reader thread is started and records must be 
+        passed to `save` (eg, from `serial_async.SerialReader`).
+        '''
+
+        if not self.shared_writer: self.writer.start()
+        ser_write(self.ser, code_start)
+        if read:
+            self.thread_scan = threading.Thread(
+                target=serial_stream.scan_serial,
+                args=(self.q_serial, self.ser, self.print_arduino, self.suppress, code_end, self.data_format,
+                      self.journal, self.clock, self.latency, self.stop_reading, arduino_head),
+            )
+            self.thread_scan.daemon = True
+            self.thread_scan.start()
+        self.start_time = datetime.now()
+        self.grp_exp.attrs['start_time'] = str(self.start_time)
+
+    def stop(self):
+        '''Ask Arduino to end session'''
+        ser_write(self.ser, '0')
+
+    def stop_reader(self, timeout=5):
+        '''Stop reader thread (if still running) and wait for it to exit'''
+
+        if self.thread_scan is None or not self.thread_scan.is_alive():
+            return
+        self.stop_reading.set()
+        if hasattr(self.ser, 'cancel_read'):
+            self.ser.cancel_read()     # Wake reader waiting on serial
+        self.thread_scan.join(timeout)
+        if self.thread_scan.is_alive():
+            print('Serial reader did not stop')
+
+    def process(self, timeout=None, budget=None, batch=None):
+        '''Save data waiting from reader
+        Waits up to `timeout` s for data. Returns True once Arduino ended
+        session. See `drain` for `budget` and `batch`.
+        '''
+
+        if self.q_serial.empty():
+            self.data_ready.wait(timeout)
+        self.data_ready.clear()
+        return self.drain(budget, batch)
+
+    def drain(self, budget=None, batch=None):
+        '''Save all data waiting from reader
+        Records are taken `batch` at a time (all if None). With `budget` (s),
+        stops once that much time passed, leaving the rest waiting (as the GUI
+        does to stay responsive). Returns True once Arduino ended session.
+        Raises the reader's error once all records it read are saved.
+        '''
+
+        deadline = time.time() + budget if budget is not None else None
+        self.clock.maybe_ping(self.ser)
+        while not self.q_serial.rearm():
+            records = self.q_serial.get(batch)
+            read_ns = self.latency.taken(self.q_serial.ix_read) if self.latency else None
+            t0 = latency.now_ns()
+            ended = self.save(records, read_ns)
+            if self.latency: self.latency.add('dispatch', latency.now_ns() - t0, len(records))
+            if ended:
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+        if self.q_serial.error is not None:
+            raise self.q_serial.error
+        return False
+
+    def save(self, records, read_ns=None):
+        '''Save (N, 3) array of records
+        Returns True if it holds end of session. `read_ns` is the host time
+        records were read (for latency).
+        '''
+
+        self.n_records += len(records)
+        self.writer.put(records, read_ns)
+        codes = records[:, 0]
+        for code, name in arduino_events.items():
+            self.counts[name] += int(np.count_nonzero(codes == code))
+        is_end = codes == code_end
+        if is_end.any():
+            self.arduino_end = int(records[is_end, 1][0])
+            return True
+        return False
+
+    def finish(self, notes=''):
+        '''Finalize data once session ended'''
+
+        end_time = datetime.now().strftime('%H:%M:%S')
+
+        # Reader writes to journal, so it has to be done before writer and
+        # journal are closed. Records it read since last drain are saved too.
+        self.stop_reader()
+        while not self.q_serial.empty():
+            records = self.q_serial.get()
+            self.save(records, self.latency.taken(self.q_serial.ix_read) if self.latency else None)
+        self.writer.close()
+        self.grp_behav.attrs['end_time'] = end_time
+        self.grp_behav.attrs['notes'] = notes
+        if self.arduino_end is not None:
+            self.grp_behav.attrs['arduino_end'] = self.arduino_end
+        self.clock.save(self.grp_behav)
+        if self.latency is not None:
+            self.latency.save(self.grp_behav)
+        self.data_file.flush()
+
+        # Journal no longer needed once data is saved
+        self.journal.close(remove=not self.writer.error)
+        if self.writer.error:
+            print('Raw data kept in {}'.format(self.journal.filename))
+
+    def run(self, notes='', timeout=None, verbose=False):
+        '''Run session until Arduino ends it
+        Ctrl-C sends stop signal; session ends after Arduino confirms. If
+        nothing ends the session `timeout` s after stopping, data is finalized
+        anyway.
+        '''
+
+        # Ctrl-C only flags stop so no data is lost while saving
+        stop_requested = []
+        handler = signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.append(time.time()))
+        try:
+            self.start()
+            print('Session started at {}'.format(self.start_time))
+            stopped = None
+            last_print = time.time()
+            while not self.process(timeout=1):
+                if stop_requested and stopped is None:
+                    print('User triggered stop, sending signal to Arduino...')
+                    self.stop()
+                    stopped = time.time()
+                elif stopped is not None and timeout and time.time() - stopped > timeout:
+                    print('Arduino did not end session')
+                    break
+                if verbose and time.time() - last_print >= 1:
+                    print('  ' + ', '.join('{}: {}'.format(ev, self.counts[ev]) for ev in events))
+                    if self.latency: self.print_latency()
+                    last_print = time.time()
+        except IOError as err:
+            print('Error on serial ({})'.format(err))
+        finally:
+            signal.signal(signal.SIGINT, handler)
+        print('Session ended at {}'.format(datetime.now().strftime('%H:%M:%S')))
+        self.finish(notes)
+        if self.latency: self.print_latency()
+
+    def print_latency(self):
+        print('  Latency p50/p99 (ms): ' + ', '.join(
+            '{}: {}'.format(stage, self.latency.format(stage)) for stage in latency.stages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run go/no go session without GUI')
+    parser.add_argument('port', help='Serial port of Arduino')
+    parser.add_argument('--params', help='JSON or YAML file of session parameters')
+    for key in default_parameters:
+        parser.add_argument('--' + key.replace('_', '-'), type=int, dest=key, help='(default: {})'.format(default_parameters[key]))
+    parser.add_argument('--file', help='HDF5 file to save to (appended if it exists)')
+    parser.add_argument('--subject', default='', help='Subject name')
+    parser.add_argument('--weight', default='', help='Subject weight')
+    parser.add_argument('--notes', default='', help='Session notes')
+    parser.add_argument('--compression', choices=sorted(data_writer.compression_filters), default='gzip',
+                        help='Compression of high-rate events')
+    parser.add_argument('--delta-ts', action='store_true', help='Store timestamps of high-rate events as differences')
+    parser.add_argument('--delay', type=float, default=3, help='Time (s) for Arduino to reset after opening port')
+    parser.add_argument('--stop-timeout', type=float, default=10,
+                        help='Time (s) to wait for Arduino to end session after Ctrl-C')
+    parser.add_argument('--print-arduino', action='store_true', help='Print Arduino serial')
+    parser.add_argument('--latency', action='store_true', help='Measure latency from serial to file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    values = load_parameters(args.params) if args.params else {}
+    values.update((key, getattr(args, key)) for key in default_parameters if getattr(args, key) is not None)
+    parameters = make_parameters(values)
+
+    if args.file:
+        data_file = h5py.File(args.file, 'a')
+    else:
+        if not os.path.exists('data'):
+            os.makedirs('data')
+        data_file = h5py.File(default_filename(), 'x')
+
+    ser = serial.Serial(args.port, serial_stream.base_baud, timeout=1)
+    try:
+        time.sleep(args.delay)
+        data_format = upload_parameters(ser, parameters, verbose=args.verbose, print_arduino=args.print_arduino)
+        print('Parameters uploaded to Arduino')
+        session = Session(
+            ser, data_file, parameters, data_format,
+            subject=args.subject, weight=args.weight,
+            compression=args.compression, delta_ts=args.delta_ts,
+            print_arduino=args.print_arduino, suppress=[code_lick_form, code_movement],
+            measure_latency=args.latency,
+        )
+        print('Saving to {} in {}'.format(data_file.filename, session.grp_exp.name))
+        session.run(notes=args.notes, timeout=args.stop_timeout, verbose=args.verbose)
+    finally:
+        ser.close()
+        print('Closing {}'.format(data_file.filename))
+        data_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+'''
+Session journal
+
+Appends raw records read from Arduino to a flat binary file while a session
+runs, so data can be recovered if the GUI dies before it reaches the HDF5
+file. Appending to a log is much cheaper than writing to HDF5, and the file is
+synced to disk periodically.
+
+File layout:
+- magic bytes `journal_magic`
+- length of metadata (8-byte little-endian integer)
+- metadata as JSON (group name, events, datasets and attributes)
+- records as little-endian int64 rows of [code, ts, data]
+
+A record cut short by a crash is ignored on replay.
+
+Replay journal into HDF5 file:
+    python journal.py session.journal [--output data.h5] [--group subject/date]
+'''
+
+import argparse
+import json
+import os
+import struct
+import time
+import h5py
+import numpy as np
+import data_writer
+
+
+journal_magic = b'BEHAVJ1\n'
+record_dtype = np.dtype('<i8')
+n_fields = 3
+
+
+def journal_path(data_filename, group_name):
+    '''Journal file for session saved in `group_name` of `data_filename`'''
+
+    return '{}{}.journal'.format(data_filename, group_name.replace('/', '-'))
+
+
+class Journal(object):
+    '''Append-only record log
+    Only the thread reading serial should call `write`.
+    '''
+
+    def __init__(self, filename, metadata, fsync_interval=1.0):
+        self.filename = filename
+        self.fsync_interval = fsync_interval
+        self.file = open(filename, 'wb')
+
+        header = json.dumps(metadata).encode()
+        self.file.write(journal_magic)
+        self.file.write(struct.pack('<Q', len(header)))
+        self.file.write(header)
+        self.sync()
+
+    def write(self, records):
+        '''Append (N, 3) array of records'''
+
+        self.file.write(np.ascontiguousarray(records, dtype=record_dtype).tobytes())
+        if time.time() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        '''Force data onto disk'''
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+
+    def close(self, remove=False):
+        '''Close journal; remove file once data is safely in HDF5 file'''
+
+        if self.file.closed: return
+        self.sync()
+        self.file.close()
+        if remove:
+            os.remove(self.filename)
+
+
+def session_metadata(group_name, events, streams, compression='none', delta_ts=False, attrs={}):
+    '''Metadata needed to rebuild a session
+    Arguments match `data_writer.create_datasets`; `events` maps Arduino codes
+    to dataset names and `attrs` are stored in the behavior group.
+    '''
+
+    return {
+        'group': group_name,
+        'events': {str(code): name for code, name in events.items()},
+        'streams': {name: list(stream) for name, stream in streams.items()},
+        'compression': compression,
+        'delta_ts': delta_ts,
+        'attrs': attrs,
+    }
+
+
+def read_journal(filename):
+    '''Read journal
+    Returns `(metadata, records)`; `records` is an (N, 3) array.
+    '''
+
+    with open(filename, 'rb') as f:
+        if f.read(len(journal_magic)) != journal_magic:
+            raise IOError('{} is not a session journal'.format(filename))
+        n_header, = struct.unpack('<Q', f.read(8))
+        metadata = json.loads(f.read(n_header).decode())
+        records = np.fromfile(f, dtype=record_dtype)
+
+    # Drop incomplete last record
+    n_records = records.size // n_fields
+    records = records[:n_records * n_fields].reshape(n_records, n_fields)
+    return metadata, records
+
+
+def replay(filename, data_filename=None, group_name=None, code_end=0):
+    '''Rebuild behavior group from journal
+    Data is written into `data_filename` (default: journal name with '.h5')
+    under `group_name` (default: group of original session). Returns name of
+    behavior group created.
+    '''
+
+    metadata, records = read_journal(filename)
+    events = {int(code): name for code, name in metadata['events'].items()}
+    streams = {name: tuple(stream) for name, stream in metadata['streams'].items()}
+    data_filename = data_filename or os.path.splitext(filename)[0] + '.h5'
+    group_name = group_name or metadata['group']
+
+    with h5py.File(data_filename, 'a') as data_file:
+        grp_behav = data_file.create_group('{}/behavior'.format(group_name.rstrip('/')))
+        data_writer.create_datasets(
+            grp_behav, streams,
+            compression=metadata['compression'], delta_ts=metadata['delta_ts'],
+        )
+
+        # Write synchronously with same code as during session
+        writer = data_writer.DataWriter(grp_behav, events)
+        writer.add(records)
+        for name, n in writer.n_buffered.items():
+            if n: writer.flush(name)
+        writer.trim()
+        if writer.error:
+            raise writer.error
+
+        for key, value in metadata['attrs'].items():
+            grp_behav.attrs[key] = value
+        ended = records[records[:, 0] == code_end]
+        if len(ended):
+            grp_behav.attrs['arduino_end'] = ended[0, 1]
+        grp_behav.attrs['recovered_from'] = os.path.abspath(filename)
+        return grp_behav.name
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild session data from journal')
+    parser.add_argument('journal')
+    parser.add_argument('--output', help='HDF5 file to write (default: journal name with .h5)')
+    parser.add_argument('--group', help='Group for session (default: original group)')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    grp_name = replay(args.journal, args.output, args.group)
+    print('Recovered {} in {:.2f} s'.format(grp_name, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
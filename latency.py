@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+'''
+Latency of records from serial to disk
+
+Records pass through several stages between Arduino and the HDF5 file. With
+latency measured, the time records spend in each stage is tallied in
+histograms of fixed size (log-spaced bins, `bins_per_decade` per decade from
+`min_latency` to `max_latency` s, plus one bin below and one above), so
+memory and overhead do not grow with the session. Stamps are taken once per
+batch of records, and each record of a batch is counted, so percentiles are
+per record.
+
+Stages (`stages`):
+- read: Arduino timestamp to host read (needs fitted clock, see `clock_sync`;
+  timestamps are whole ms, so this can be up to 1 ms too long)
+- parse: read to parsed
+- queue: parsed to taken from ring buffer by GUI or session
+- dispatch: handling of batch by GUI or session
+- write: HDF5 write of block holding record
+- total: read to written (including time buffered by writer)
+
+Each stage has its own histogram and is only added to from one thread.
+
+Saved in the behavior group (`Latency.save`):
+- attr `latency_edges`: bin edges (s)
+- attr `latency_<stage>`: counts of bins, with records below first and above
+  last edge at either end
+
+Percentiles of a saved session:
+    latency.percentile(grp_behav.attrs['latency_queue'], 99)
+'''
+
+import bisect
+import collections
+import numpy as np
+import clock_sync
+
+
+stages = ['read', 'parse', 'queue', 'dispatch', 'write', 'total']
+min_latency = 1e-6      # s
+max_latency = 100.
+bins_per_decade = 10
+
+edges = np.logspace(np.log10(min_latency), np.log10(max_latency),
+                    int(round(np.log10(max_latency / min_latency) * bins_per_decade)) + 1)
+edges_ns = edges * 1e9
+_edges_ns = edges_ns.tolist()       # For bisect, faster than numpy on one value
+n_bins = len(edges) + 1             # Including below first and above last edge
+
+now_ns = clock_sync.now_ns
+
+
+def percentile(counts, q):
+    '''Latency (s) at percentile `q` of histogram `counts`
+    Latency is the geometric middle of bin; records outside edges count as
+    first or last edge. NaN if there are no records.
+    '''
+
+    counts = np.asarray(counts)
+    total = counts.sum()
+    if not total:
+        return np.nan
+    ix = int(np.searchsorted(np.cumsum(counts), q / 100. * total))
+    if ix == 0:
+        return edges[0]
+    if ix >= len(edges):
+        return edges[-1]
+    return np.sqrt(edges[ix - 1] * edges[ix])
+
+
+class Histogram(object):
+    '''Counts of latencies in fixed bins'''
+
+    def __init__(self):
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def add(self, latency_ns, count=1):
+        '''Add `count` records with latency `latency_ns`'''
+        self.counts[bisect.bisect_right(_edges_ns, latency_ns)] += count
+
+    def add_array(self, latency_ns):
+        '''Add records with array of latencies (ns)'''
+        ix = np.searchsorted(edges_ns, latency_ns, side='right')
+        self.counts += np.bincount(ix, minlength=n_bins)
+
+    def percentile(self, q):
+        return percentile(self.counts, q)
+
+
+class Latency(object):
+    '''Histograms of each stage of one session
+    Reader calls `queued` before putting a batch into ring buffer and consumer
+    calls `taken` after getting records from it.
+    '''
+
+    def __init__(self):
+        self.hists = collections.OrderedDict((stage, Histogram()) for stage in stages)
+        self.batches = collections.deque()      # [end index, count, read_ns, parsed_ns] in ring buffer
+
+    def add(self, stage, latency_ns, count=1):
+        self.hists[stage].add(latency_ns, count)
+
+    def add_read(self, ts, read_ns, clock):
+        '''Add Arduino timestamps `ts` (ms) read at host time `read_ns`
+        Needs clock fitted to sync replies (`clock`, a `clock_sync.ClockSync`)
+        and skipped until then.
+        '''
+
+        model = clock.model
+        if model.n < 2 or not len(ts):
+            return
+        sent = (model.offset + model.rate * (np.asarray(ts, dtype=np.float64) / 1000.)) * 1e9
+        self.hists['read'].add_array(read_ns - sent)
+
+    def queued(self, ix_write, count, read_ns, parsed_ns):
+        '''`count` records read and parsed at host times (ns) go into ring
+        buffer at index `ix_write`
+        '''
+        self.batches.append((ix_write + count, count, read_ns, parsed_ns))
+
+    def taken(self, ix_read):
+        '''Records up to index `ix_read` of ring buffer were taken
+        Batches are counted once all their records are taken. Returns read
+        time (ns) of first record taken (None if unknown).
+        '''
+
+        if not self.batches:
+            return None
+        now = now_ns()
+        read_ns = self.batches[0][2]
+        while self.batches and self.batches[0][0] <= ix_read:
+            _, count, _, parsed_ns = self.batches.popleft()
+            self.add('queue', now - parsed_ns, count)
+        return read_ns
+
+    def summary(self, q=(50, 99)):
+        '''Percentiles `q` (s) of each stage with records'''
+
+        return collections.OrderedDict(
+            (stage, [hist.percentile(p) for p in q]) for stage, hist in self.hists.items() if hist.n
+        )
+
+    def format(self, stage, q=(50, 99)):
+        '''Percentiles `q` of `stage` in ms, eg '0.4/2.1' ('-' if none)'''
+
+        hist = self.hists[stage]
+        if not hist.n:
+            return '-'
+        ms = [hist.percentile(p) * 1000 for p in q]
+        return '/'.join('{:.0f}'.format(x) if x >= 10 else '{:.2g}'.format(x) for x in ms)
+
+    def save(self, grp):
+        '''Store histograms as attrs of HDF5 group `grp`'''
+
+        grp.attrs['latency_edges'] = edges
+        for stage, hist in self.hists.items():
+            grp.attrs['latency_' + stage] = hist.counts
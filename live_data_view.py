@@ -2,10 +2,33 @@
 
 '''
 Sample tkinter live graph
+
+Each series is kept in a `SeriesBuffer`, a preallocated circular buffer that
+appends points in constant time and drops points older than `x_history`
+without copying. Artists are given views into the buffers. Long windows of
+line data can be reduced to a min/max envelope as data arrives (`lod`).
+
+Data is drawn on a timer at a fixed maximum frame rate, using blitting so only
+the series are redrawn until the x-axis scrolls. Producers that receive data
+in batches should pass them whole to `update_view_many`.
+
+`PeriEventView` shows a raster and histogram of events (eg, licks) aligned to
+triggers (eg, CS onsets), binned incrementally as data arrives.
+
+Demo at high point rate:
+    python live_data_view.py --rate 10000
 '''
 
-import tkinter as tk
-import tkinter.ttk as ttk
+import argparse
+import sys
+import time
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    import Tkinter as tk
+    import ttk
+else:
+    import tkinter as tk
+    import tkinter.ttk as ttk
 import matplotlib
 matplotlib.use('TKAgg')
 from matplotlib.figure import Figure
@@ -13,97 +36,492 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import numpy as np
 
 
+class SeriesBuffer(object):
+    '''Circular buffer of (x, y) points
+    Each point is written twice, `capacity` apart, so the points in the buffer
+    are always available as one contiguous view (`view`). Points are expected
+    to arrive in order of x. The buffer grows if it fills up.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.xy = np.zeros((2 * capacity, 2))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        '''(N, 2) view of points in buffer'''
+        return self.xy[self.start:self.start + self.size]
+
+    def extend(self, xy):
+        '''Append (N, 2) array of points'''
+
+        n = len(xy)
+        if self.size + n > self.capacity:
+            self.grow(self.size + n)
+
+        # Copy in up to two pieces if end of buffer is reached
+        cap = self.capacity
+        ix = (self.start + self.size) % cap
+        n_first = min(n, cap - ix)
+        self.xy[ix:ix + n_first] = xy[:n_first]
+        self.xy[ix + cap:ix + cap + n_first] = xy[:n_first]
+        n_rest = n - n_first
+        if n_rest:
+            self.xy[:n_rest] = xy[n_first:]
+            self.xy[cap:cap + n_rest] = xy[n_first:]
+        self.size += n
+
+    def evict(self, x_min):
+        '''Drop points with x at or below `x_min`'''
+
+        n = np.searchsorted(self.view()[:, 0], x_min, side='right')
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def grow(self, n):
+        '''Increase capacity to hold at least `n` points'''
+
+        current = self.view().copy()
+        self.capacity = max(n, self.capacity * 2)
+        self.xy = np.zeros((2 * self.capacity, 2))
+        self.xy[:self.size] = current
+        self.xy[self.capacity:self.capacity + self.size] = current
+        self.start = 0
+
+
+class EnvelopeBuffer(SeriesBuffer):
+    '''Min/max envelope of (x, y) points
+    Points are grouped into bins `bin_width` wide along x, and each bin is
+    stored as two points at its start: its minimum and maximum. Drawn as a
+    line, this covers the same pixels as the raw data when bins are a pixel
+    wide. Bins are completed as points arrive; the most recent bin is added
+    once a point falls beyond it.
+    '''
+
+    def __init__(self, bin_width, capacity=1024):
+        SeriesBuffer.__init__(self, capacity)
+        self.bin_width = bin_width
+        self.bin = None             # Bin still receiving points
+        self.bin_min = 0
+        self.bin_max = 0
+
+    def extend(self, xy):
+        '''Add (N, 2) array of points'''
+
+        if not len(xy): return
+
+        # Points are in order of x, so each bin is one run of points
+        bins = np.floor(xy[:, 0] / self.bin_width).astype(np.int64)
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        bins = bins[starts]
+        mins = np.minimum.reduceat(xy[:, 1], starts)
+        maxs = np.maximum.reduceat(xy[:, 1], starts)
+
+        # Merge with open bin
+        if self.bin is not None:
+            if bins[0] == self.bin:
+                mins[0] = min(mins[0], self.bin_min)
+                maxs[0] = max(maxs[0], self.bin_max)
+            else:
+                bins = np.concatenate([[self.bin], bins])
+                mins = np.concatenate([[self.bin_min], mins])
+                maxs = np.concatenate([[self.bin_max], maxs])
+
+        # Store completed bins; last one stays open
+        envelope = np.empty((2 * (len(bins) - 1), 2))
+        envelope[:, 0] = np.repeat(bins[:-1] * self.bin_width, 2)
+        envelope[0::2, 1] = mins[:-1]
+        envelope[1::2, 1] = maxs[:-1]
+        SeriesBuffer.extend(self, envelope)
+        self.bin, self.bin_min, self.bin_max = bins[-1], mins[-1], maxs[-1]
+
+    def clear(self):
+        SeriesBuffer.clear(self)
+        self.bin = None
+
+    def set_bin_width(self, bin_width):
+        '''Change bin width; envelope kept so far is binned again'''
+
+        points = self.view().copy()
+        if self.bin is not None:
+            x = self.bin * self.bin_width
+            points = np.concatenate([points, [[x, self.bin_min], [x, self.bin_max]]])
+        self.clear()
+        self.bin_width = bin_width
+        self.extend(points)
+
+
 class LiveDataView(ttk.Frame):
-    def __init__(self, parent, x_history=30, scale_x=1, scale_y = 1, data_types={'default': 'line'}, **ax_kwargs):
+    '''Live plot of named series
+    New data is drawn at most `fps` times per second, however often it
+    arrives. With `blit`, the figure is only fully redrawn when the x-axis
+    scrolls (in steps of `scroll_step` of the window); in between, the cached
+    background is restored and only the series are drawn.
+
+    With `lod`, line series are stored as a min/max envelope (see
+    `EnvelopeBuffer`) with `lod` bins across the window, or one bin per pixel
+    of the axes if `lod` is True (updated when the plot is resized). The
+    number of points drawn then depends on the plot width rather than the
+    amount of data.
+    '''
+
+    def __init__(self, parent, x_history=30, scale_x=1, scale_y = 1, data_types={'default': 'line'},
+                 blit=True, fps=20, scroll_step=0.1, lod=False, **ax_kwargs):
         self.parent = parent
         self.x_history = x_history * scale_x
         self.scale_x = scale_x
         self.scale_y = scale_y
+        self.blit = blit
+        self.frame_interval = int(1000 / fps)
+        self.scroll_step = scroll_step * self.x_history
+        self.lod = lod
 
         # Create matplotlib figure
         self.fig_preview = Figure()
         self.ax_preview = self.fig_preview.add_subplot(111)
         self.data = {}
+        self.buffers = {}
         for name, plot_type in data_types.items():
             if plot_type in ['line', 'plot']:
                 data, = self.ax_preview.plot(0, 0)
             elif plot_type == 'scatter':
                 data = self.ax_preview.scatter(0, 0)
+            data.set_animated(blit)
             self.data[name] = data
+            if lod and plot_type != 'scatter':
+                self.buffers[name] = EnvelopeBuffer(self.lod_bin_width())
+            else:
+                self.buffers[name] = SeriesBuffer()
         self.ax_preview.set(**ax_kwargs)
         self.ax_preview.set_xlim((-self.x_history, 0))
 
+        # Rendering state
+        self.x_last = 0             # Most recent x
+        self.stale = set()          # Series with data not drawn yet
+        self.background = None
+        self.needs_blit = False
+
         # Add to tkinter
         self.canvas_preview = FigureCanvasTkAgg(self.fig_preview, self.parent)
+        self.canvas_preview.mpl_connect('draw_event', self.on_draw)
+        self.canvas_preview.mpl_connect('resize_event', self.on_resize)
+        self.rebin()    # Canvas sets figure size
         self.canvas_preview.draw()
         self.canvas_preview.get_tk_widget().grid(row=0, column=0, sticky='wens')
+        self.render()
 
     def update_view(self, xy, name='default'):
-        # Update data
-        # Need to determine the type of plot it is.
+        # Update data; view is updated on next frame
         new_xy = xy * np.array([self.scale_x, self.scale_y])
+        self.update_data(name, new_xy[np.newaxis])
+
+    def update_view_many(self, series):
+        '''Add many points at once
+        `series` maps names to (N, 2) arrays of points in order of x. An array
+        alone is added to 'default'. View is updated once, on next frame.
+        '''
+
+        if not isinstance(series, dict):
+            series = {'default': series}
+        scale = np.array([self.scale_x, self.scale_y])
+        for name, xy in series.items():
+            if len(xy):
+                self.update_data(name, np.asarray(xy, dtype=float) * scale)
+
+    def update_data(self, name, xy):
+        # Only keep data for window defined by `x_history`
+        # Data is added to buffer in place; artist is given a view of it.
+        buffer = self.buffers[name]
+        x_min = xy[-1, 0] - self.x_history
+        buffer.evict(x_min)
+        buffer.extend(xy)
+        buffer.evict(x_min)
+        self.x_last = max(self.x_last, xy[-1, 0])
+        self.stale.add(name)
+
+    def draw_data(self, name):
+        # Need to determine the type of plot it is.
+        current = self.buffers[name].view()
         data_type = type(self.data[name])
         if data_type == matplotlib.lines.Line2D:
             # Line plot
-            current = self.data[name].get_xydata()
-            updated = self.update_data(current, new_xy)
-            self.data[name].set_data(updated.T)
+            self.data[name].set_data(current[:, 0], current[:, 1])
         elif data_type == matplotlib.collections.PathCollection:
             # Scatter plot
-            current = self.data[name].get_offsets()
-            updated = self.update_data(current, new_xy)
-            self.data[name].set_offsets(updated)
+            self.data[name].set_offsets(current)
 
-        # Update view
-        new_xlim = new_xy[0] + np.array([-self.x_history, 0])
-        self.ax_preview.set_xlim(new_xlim)
-        self.canvas_preview.draw_idle()
+    def get_xlim(self):
+        '''Window ending at most recent x (next step when blitting)'''
 
-    def update_data(self, current, xy):
-        # Only keep data for window defined by `x_history`
-        # Should keep down on resource usage.
-        new_ix = current[:, 0] > xy[0] - self.x_history
-        return np.concatenate([current[new_ix, :], [xy]], axis=0)
+        x_max = self.x_last
+        if self.blit and self.scroll_step:
+            x_max = np.ceil(x_max / self.scroll_step) * self.scroll_step
+        return (x_max - self.x_history, x_max)
+
+    def render(self):
+        '''Draw new data at fixed frame rate'''
+
+        if self.stale:
+            for name in self.stale:
+                self.draw_data(name)
+            self.stale = set()
+
+            xlim = self.get_xlim()
+            if not self.blit:
+                self.ax_preview.set_xlim(xlim)
+                self.canvas_preview.draw_idle()
+            elif xlim != tuple(self.ax_preview.get_xlim()):
+                # Full redraw caches background with new axis
+                self.ax_preview.set_xlim(xlim)
+                self.canvas_preview.draw()
+            self.needs_blit = self.blit
+
+        if self.needs_blit and self.background is not None:
+            self.blit_data()
+        self.parent.after(self.frame_interval, self.render)
+
+    def lod_bin_width(self):
+        '''Envelope bin width for `lod`'''
+
+        n_bins = self.ax_preview.bbox.width if self.lod is True else self.lod
+        return self.x_history / max(int(n_bins), 1)
+
+    def rebin(self):
+        '''Bin envelopes to current `lod` bin width'''
+
+        if not self.lod: return
+        bin_width = self.lod_bin_width()
+        for name, buffer in self.buffers.items():
+            if isinstance(buffer, EnvelopeBuffer) and buffer.bin_width != bin_width:
+                buffer.set_bin_width(bin_width)
+                self.stale.add(name)
+
+    def on_resize(self, event):
+        # Axes width changed, so does one bin per pixel
+        if self.lod is True: self.rebin()
+
+    def on_draw(self, event):
+        # Figure was redrawn (eg, new axis or resized); series aren't included
+        if self.blit:
+            self.background = self.canvas_preview.copy_from_bbox(self.ax_preview.bbox)
+            self.needs_blit = True
+
+    def blit_data(self):
+        '''Draw series over cached background'''
+
+        self.canvas_preview.restore_region(self.background)
+        for data in self.data.values():
+            self.ax_preview.draw_artist(data)
+        self.canvas_preview.blit(self.ax_preview.bbox)
+        self.needs_blit = False
 
     def clear_data(self):
         blank = np.zeros((1, 2))
         for name, data in self.data.items():
+            self.buffers[name].clear()
             data_type = type(self.data[name])
             if data_type == matplotlib.lines.Line2D:
                 # Need at least 2 data points for some reason...
                 self.data[name].set_data(np.concatenate([blank, blank]))
             elif data_type == matplotlib.collections.PathCollection:
                 self.data[name].set_offsets(blank)
+        self.stale = set()
+        self.x_last = 0
 
         # Update view
         self.ax_preview.set_xlim([-self.x_history, 0])
         self.canvas_preview.draw_idle()
 
 
+class PeriEventView(ttk.Frame):
+    '''Raster and peri-event histogram
+    Events are aligned to triggers of `n_types` types within `pre` ms before 
+    and `post` ms after each trigger. Add data with `update` as it arrives: 
+    only pairs involving new events or triggers are binned, so the cost of 
+    an update does not grow with the length of the session. Histograms are 
+    shown as event rates (per s) for each trigger type.
+    '''
+
+    def __init__(self, parent, n_types=3, pre=2000, post=4000, bin_width=100, labels=None,
+                 refresh=500, figsize=(8, 3)):
+        self.parent = parent
+        self.n_types = n_types
+        self.labels = labels or ['{}'.format(t) for t in range(n_types)]
+        self.refresh = refresh
+        self.last_draw = 0
+        self.stale = False
+
+        # Create matplotlib figure
+        self.fig = Figure(figsize=figsize)
+        self.ax_raster = self.fig.add_subplot(211)
+        self.ax_hist = self.fig.add_subplot(212, sharex=self.ax_raster)
+        self.ax_raster.set(ylabel='Trial')
+        self.ax_hist.set(xlabel='Time from CS (ms)', ylabel='Rate (s$^{-1}$)')
+        for ax in [self.ax_raster, self.ax_hist]:
+            ax.axvline(0, color='k', linewidth=0.5)
+        self.raster_plots = [
+            self.ax_raster.scatter([], [], marker='|', s=20, color='C{}'.format(t), label=label)
+            for t, label in enumerate(self.labels)
+        ]
+        self.hist_plots = [
+            self.ax_hist.plot([], [], drawstyle='steps-mid', color='C{}'.format(t))[0]
+            for t in range(n_types)
+        ]
+        self.ax_raster.legend(loc='upper right', fontsize='small')
+
+        # Add to tkinter
+        self.canvas = FigureCanvasTkAgg(self.fig, self.parent)
+        self.canvas.get_tk_widget().grid(row=0, column=0, sticky='wens')
+
+        self.reset(pre, post, bin_width)
+
+    def reset(self, pre=None, post=None, bin_width=None):
+        '''Clear data; optionally change window'''
+
+        self.pre = pre if pre is not None else self.pre
+        self.post = post if post is not None else self.post
+        self.bin_width = bin_width if bin_width is not None else self.bin_width
+        self.n_bins = int(np.ceil((self.pre + self.post) / float(self.bin_width)))
+        self.bin_centers = -self.pre + (np.arange(self.n_bins) + 0.5) * self.bin_width
+
+        self.triggers = SeriesBuffer(256)       # Rows of [ts, type]
+        self.events = SeriesBuffer()            # Rows of [ts, 0]
+        self.rasters = [SeriesBuffer() for _ in range(self.n_types)]
+        self.counts = np.zeros((self.n_types, self.n_bins), dtype=np.int64)
+        self.n_trials = np.zeros(self.n_types, dtype=np.int64)
+
+        self.ax_hist.set_xlim(-self.pre, self.post)
+        self.stale = True
+        self.draw(force=True)
+
+    def update(self, triggers, events):
+        '''Add new data
+        `triggers` is an (N, 2) array of [ts, type]; `events` is an array of 
+        timestamps. Both must be later than previous data. Triggers of types 
+        outside `n_types` are ignored.
+        '''
+
+        n_old_events = len(self.events)
+        n_old_triggers = len(self.triggers)
+        if len(triggers):
+            triggers = np.asarray(triggers, dtype=float)
+            triggers = triggers[(triggers[:, 1] >= 0) & (triggers[:, 1] < self.n_types)]
+        if len(triggers):
+            self.triggers.extend(triggers)
+            self.n_trials += np.bincount(triggers[:, 1].astype(int), minlength=self.n_types)
+        if len(events):
+            events = np.asarray(events, dtype=float)
+            self.events.extend(np.column_stack([events, np.zeros(len(events))]))
+        if not (len(triggers) or len(events)): return
+
+        all_triggers = self.triggers.view()
+        all_events = self.events.view()[:, 0]
+
+        # New events with all triggers close enough, then earlier events with
+        # new triggers. Each pair is counted once.
+        new_events = all_events[n_old_events:]
+        ix_first = np.searchsorted(all_triggers[:, 0], new_events[0] - self.post, side='right') if len(new_events) else len(all_triggers)
+        pairs = [
+            self.pair(new_events, all_triggers[ix_first:], n_old_events, ix_first),
+            self.pair(all_events[:n_old_events], all_triggers[n_old_triggers:], 0, n_old_triggers),
+        ]
+        ix_event = np.concatenate([p[0] for p in pairs])
+        ix_trigger = np.concatenate([p[1] for p in pairs])
+        if not ix_event.size:
+            self.stale = True
+            return
+
+        offsets = all_events[ix_event] - all_triggers[ix_trigger, 0]
+        types = all_triggers[ix_trigger, 1].astype(int)
+        bins = ((offsets + self.pre) // self.bin_width).astype(int)
+        self.counts += np.bincount(
+            types * self.n_bins + bins, minlength=self.n_types * self.n_bins
+        ).reshape(self.n_types, self.n_bins)
+        for t in range(self.n_types):
+            is_type = types == t
+            if is_type.any():
+                self.rasters[t].extend(np.column_stack([offsets[is_type], ix_trigger[is_type]]))
+        self.stale = True
+
+    def pair(self, events, triggers, ix_events, ix_triggers):
+        '''Indices of events within window of each trigger
+        `ix_events` and `ix_triggers` are positions of arrays in all data.
+        '''
+
+        lo = np.searchsorted(events, triggers[:, 0] - self.pre, side='left')
+        hi = np.searchsorted(events, triggers[:, 0] + self.post, side='left')
+        counts = hi - lo
+        n = counts.sum()
+        ix_trigger = np.repeat(np.arange(len(triggers)), counts)
+        ix_event = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        return ix_event + ix_events, ix_trigger + ix_triggers
+
+    def draw(self, force=False):
+        '''Redraw if data changed, at most every `refresh` ms'''
+
+        now = time.time()
+        if not self.stale or (not force and (now - self.last_draw) * 1000 < self.refresh):
+            return
+
+        rate = self.counts / np.maximum(self.n_trials, 1)[:, None] / (self.bin_width / 1000.)
+        for t in range(self.n_types):
+            self.raster_plots[t].set_offsets(self.rasters[t].view())
+            self.hist_plots[t].set_data(self.bin_centers, rate[t])
+        self.ax_raster.set_ylim(-0.5, max(len(self.triggers), 1) - 0.5)
+        self.ax_hist.set_ylim(0, max(rate.max() * 1.1, 1))
+        self.canvas.draw_idle()
+        self.last_draw = now
+        self.stale = False
+
+
 class Sample(ttk.Frame):
-    def __init__(self, parent):
+    def __init__(self, parent, rate=10):
         self.parent = parent
+        self.rate = rate
 
         self.live_view = ttk.Frame(self.parent)
         self.live_view.grid()
-        self.live_view_ = LiveDataView(self.live_view, x_history=10, ylim=(-1, 1))
+        self.live_view_ = LiveDataView(self.live_view, x_history=10, ylim=(-1.5, 1.5))
 
-        self.xy = np.array([0.0, 0.0])
+        self.var_rate = tk.StringVar()
+        ttk.Label(self.parent, textvariable=self.var_rate).grid()
+
+        self.x = 0.0
+        self.n_points = 0
+        self.start_time = time.time()
         self.go_live()
 
     def go_live(self):
-        self.xy[0] = self.xy[0] + 0.1
-        self.xy[1] = np.sin(self.xy[0])
+        # Add all points sampled at `rate` since last call
+        now = time.time()
+        n = int((now - self.start_time) * self.rate) - self.n_points
+        x = self.x + np.arange(1, n + 1) / float(self.rate)
+        y = np.sin(x) + np.random.normal(0, 0.1, n)
+        self.live_view_.update_view_many(np.column_stack([x, y]))
+        if n: self.x = x[-1]
+        self.n_points += n
 
-        self.live_view_.update_view(self.xy)
-        self.parent.after(100, self.go_live)
+        self.var_rate.set('{:.0f} points/s'.format(self.n_points / max(now - self.start_time, 1e-3)))
+        self.parent.after(10, self.go_live)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=10000, help='Points per second')
+    args = parser.parse_args()
+
     root = tk.Tk()
-    Sample(root)
+    Sample(root, rate=args.rate)
     root.mainloop()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+'''
+Serial port discovery
+
+Listing ports with `serial.tools.list_ports` reads descriptors of every
+device and can take a noticeable time on machines with many USB devices.
+`PortWatcher` keeps an inventory of ports up to date from a background thread
+so GUIs can show the cached list right away. Only a cheap listing of device
+nodes (`/dev/serial/by-id` and USB serial nodes in `/dev`, plus virtual
+Arduinos) is polled; ports are fully listed again when that listing changes
+(or on `refresh`), and `on_change` is only called when the inventory differs.
+Where there are no device nodes to poll (Windows), ports are fully listed on
+every poll, still off the GUI thread.
+
+Device names such as /dev/ttyACM0 depend on the order boards are plugged in.
+Each port also gets a stable ID (its name in `/dev/serial/by-id`, or USB
+serial number where there is none), and the ID last used by each rig is kept
+in `known_ports_file`, so the rig's board can be found again after it moves.
+
+Print ports as they change:
+    python port_watch.py [--interval 1]
+'''
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import serial.tools.list_ports
+import serial_stream
+
+
+by_id_dir = '/dev/serial/by-id'
+device_patterns = ['/dev/ttyACM*', '/dev/ttyUSB*', '/dev/cu.usb*']
+known_ports_file = os.path.join(os.path.expanduser('~'), '.arduino-ports.json')
+
+
+def node_listing():
+    '''Device nodes of serial ports, or None if there are none to poll'''
+
+    if not os.path.isdir('/dev'):
+        return None
+    nodes = []
+    if os.path.isdir(by_id_dir):
+        nodes += sorted(os.listdir(by_id_dir))
+    for pattern in device_patterns:
+        nodes += sorted(glob.glob(pattern))
+    nodes += [device for device, _ in serial_stream.virtual_ports()]
+    return nodes
+
+
+def list_ports():
+    '''Available serial ports as `(device, description, device_id)`
+    Includes ports of virtual Arduinos (identified by their link).
+    '''
+
+    by_id = {}
+    if os.path.isdir(by_id_dir):
+        for name in os.listdir(by_id_dir):
+            by_id[os.path.realpath(os.path.join(by_id_dir, name))] = name
+
+    ports = []
+    for port in serial.tools.list_ports.comports():
+        device_id = by_id.get(os.path.realpath(port.device))
+        if not device_id and port.serial_number:
+            device_id = 'USB {:04X}:{:04X} {}'.format(port.vid or 0, port.pid or 0, port.serial_number)
+        ports.append((port.device, port.description, device_id or port.device))
+    for device, description in serial_stream.virtual_ports():
+        ports.append((device, description, device))
+    return ports
+
+
+class PortWatcher(threading.Thread):
+    '''Inventory of serial ports kept up to date in background
+    `ports` holds `(device, description)` of available ports (empty until
+    first scan) and `ids` the stable ID of each device. `on_change` is called
+    with the watcher, from its thread, whenever ports change (including after
+    first scan). Device nodes are polled every `interval` s.
+    '''
+
+    def __init__(self, interval=1., on_change=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.interval = interval
+        self.on_change = on_change
+        self.ports = []
+        self.ids = {}
+        self.n_scans = 0        # Full listings of ports
+        self.listing = None
+        self.scanned = threading.Event()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.full_scan = True
+
+    def run(self):
+        while not self.stopped:
+            listing = node_listing()
+            if self.full_scan or listing is None or listing != self.listing:
+                self.full_scan = False
+                self.listing = listing
+                self.scan()
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def scan(self):
+        '''List ports and notify if they changed'''
+
+        ports = list_ports()
+        self.n_scans += 1
+        changed = [port[:2] for port in ports] != self.ports or not self.scanned.is_set()
+        self.ids = dict((device, device_id) for device, _, device_id in ports)
+        self.ports = [port[:2] for port in ports]
+        self.scanned.set()
+        if changed and self.on_change:
+            self.on_change(self)
+
+    def refresh(self):
+        '''List ports again now'''
+
+        self.full_scan = True
+        self.wake.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+
+    def find(self, device_id):
+        '''Device currently having stable ID `device_id` (None if absent)'''
+
+        for device, other_id in self.ids.items():
+            if other_id == device_id:
+                return device
+        return None
+
+
+def load_known_ports(filename=None):
+    '''Stable IDs of ports last used, by rig'''
+
+    try:
+        with open(filename or known_ports_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def last_used(rig, filename=None):
+    '''Stable ID of port `rig` was last used with (None if unknown)'''
+
+    return load_known_ports(filename).get(rig)
+
+
+def remember(rig, device_id, filename=None):
+    '''Store stable ID of port used by `rig`'''
+
+    filename = filename or known_ports_file
+    known = load_known_ports(filename)
+    if known.get(rig) == device_id:
+        return
+    known[rig] = device_id
+    try:
+        with open(filename, 'w') as f:
+            json.dump(known, f, indent=2, sort_keys=True)
+    except IOError as err:
+        print('Could not save port of {}: {}'.format(rig, err))
+
+
+def resolve(port):
+    '''Device for `port`, which can be a device or a stable ID'''
+
+    if os.path.exists(port):
+        return port
+    for device, _, device_id in list_ports():
+        if device_id == port:
+            return device
+    return port
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print serial ports as they change')
+    parser.add_argument('--interval', type=float, default=1., help='Time (s) between polls')
+    args = parser.parse_args()
+
+    def print_ports(watcher):
+        print('{} ({} ports)'.format(time.strftime('%H:%M:%S'), len(watcher.ports)))
+        for device, description in watcher.ports:
+            print('  {:<30}{:<40}{}'.format(device, description, watcher.ids.get(device)))
+
+    watcher = PortWatcher(args.interval, on_change=print_ports)
+    watcher.start()
+    try:
+        while watcher.is_alive():
+            watcher.join(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,14 +11,21 @@ GUI as "triplet" for recording and calculations.
 Example input:
 D10000,50,271828
 
+Parameters are echoed back with a checksum (see Behavior::SendParams). After
+a session, 'P' restarts the sketch to wait for parameters again.
+
 */
 
 
+#include <Behavior.h>
+
 #define CODEEND 48
 #define CODEPARAMSEND 271828
 #define CODEPARAMS 68
 #define CODESTART 69
 #define DELIM ","         // Delimiter used for serial outputs
+#define BAUD 9600         // Initial baud rate; host can raise it (CODEBAUD)
+#define MAXBAUD 2000000   // Fastest baud rate offered to host
 
 // Pins
 const int pin_track_a = 2;
@@ -35,6 +42,9 @@ unsigned long track_period;
 
 // Other variables
 volatile int track_change = 0;   // Rotations within tracking epochs
+unsigned long baud = BAUD;
+
+Behavior behav;
 
 
 void TrackMovement() {
@@ -52,7 +62,8 @@ void EndSession(unsigned long ts) {
   Serial.print(DELIM);
   Serial.println("0");
 
-  while (1);
+  // Host can start next session without resetting Arduino
+  behav.WaitForRestart(Serial);
 }
 
 
@@ -69,7 +80,8 @@ int GetParams() {
   session_dur = parameters[0];
   track_period = parameters[1];
   last_num = parameters[2];
-  
+  behav.SendParams(Serial, parameters, param_num);
+
   if (last_num != CODEPARAMSEND) return 1;
   else return 0;
 }
@@ -89,12 +101,21 @@ void LookForSignal(int waiting_for, unsigned long ts) {
         case CODEEND:
           EndSession(ts);
           break;
+        case CODEBAUD:
+          if (waiting_for == 1) baud = behav.ChangeBaud(Serial, baud);
+          break;
+        case CODEBAUDCHECK:
+          Serial.println("Baud OK");
+          break;
         case CODEPARAMS:
           if (waiting_for == 1) return;   // GetParams
           break;
         case CODESTART:
           if (waiting_for == 2) return;   // Start session
           break;
+        case CODEPARAMMODE:
+          if (waiting_for) behav.Restart();   // Upload parameters again
+          break;
         }
     }
 
@@ -104,7 +125,7 @@ void LookForSignal(int waiting_for, unsigned long ts) {
 
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD);
   randomSeed(analogRead(0));
 
   // Set pins
@@ -112,16 +133,16 @@ void setup() {
   pinMode(pin_track_b, INPUT);
 
   // Wait for parameters
+  behav.SendMaxBaud(Serial, MAXBAUD);
   int exit_code;
   while (1) {
     Serial.println("Waiting for parameters...");
     LookForSignal(1, 0);
     exit_code = GetParams();
-    if (! exit_code) {
-      break;
-    }
+    if (! exit_code) break;         // Host checks echoed parameters
     else {
       Serial.print("Error parsing parameters. Exit code ");
+      Serial.println(exit_code);
     }
   }
   Serial.println("Paremeters processed");
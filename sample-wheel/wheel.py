@@ -17,7 +17,6 @@ import tkinter.font as tkFont
 import tkinter.messagebox as tkMessageBox
 import tkinter.filedialog as tkFileDialog
 from tkinter.scrolledtext import ScrolledText
-from queue import Queue
 from PIL import ImageTk
 import serial
 import serial.tools.list_ports
@@ -35,9 +34,15 @@ from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import style
 # from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 import seaborn as sns
-import arduino
 import pdb
 
+# Shared modules are in parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import arduino
+import serial_stream
+import data_writer
+import journal
+
 
 # Header to print with Arduino outputs
 arduino_head = '  [a]: '
@@ -59,7 +64,13 @@ arduino_events = {
 }
 
 # Events to count
-counter_ev
+events = ['wheel']
+
+# Processing of incoming data on GUI thread
+drain_budget = 20       # ms of processing before yielding to Tk
+drain_batch = 4096      # Records taken from buffer at a time
+poll_rate = 5           # ms between checks for data from reader
+display_rate = 200      # ms between updates of counters
 
 # Path to this file
 source_path = os.path.dirname(sys.argv[0])
@@ -78,9 +89,12 @@ class InputManager(tk.Frame):
         self.var_stop = tk.BooleanVar()
 
         # Counters
+        # Counts are plain integers while acquiring; Tk variables are only
+        # written for display (see `update_counters`)
         self.var_counter_wheel = tk.IntVar()
         counter_vars = [self.var_counter_wheel]
         self.counter = {ev: var_count for ev, var_count in zip(events, counter_vars)}
+        self.counts = dict.fromkeys(events, 0)
 
         # Lay out GUI
 
@@ -211,8 +225,11 @@ class InputManager(tk.Frame):
 
         ###### SESSION VARIABLES ######
         self.parameters = {}
-        self.ser = serial.Serial(timeout=1, baudrate=9600)
-        self.q_serial = Queue()
+        self.ser = serial.Serial(timeout=1, baudrate=serial_stream.base_baud)
+        self.q_serial = serial_stream.RingBuffer()
+        self.in_session = False
+        self.drain_pending = None
+        self.drain_stats = {'ticks': 0, 'items': 0, 'overruns': 0}
 
         self.update_serial()
 
@@ -329,32 +346,44 @@ class InputManager(tk.Frame):
         self.grp_exp['weight'] = int(self.entry_weight.get()) if self.entry_weight.get() else 0
 
         # *** Create file structure ***
-        session_length = self.parameters['session_dur']
-        nstepframes = 2 * session_length / float(self.entry_track_period.get())
-        chunk_size = (2, 1)
-
+        # Dataset grows as data arrives; expected rate (per s) sets chunk size
+        track_rate = 1000. / max(self.parameters['track_period'], 1)
+        streams = {'wheel': ('int32', track_rate)}
         self.grp_behav = self.grp_exp.create_group('behavior')
-        self.grp_behav.create_dataset(name='wheel', dtype='int32', shape=(2, int(nstepframes) * 1.1), chunks=chunk_size)
+        data_writer.create_datasets(self.grp_behav, streams)
 
         # Reset counters
-        for counter in self.counter.values(): counter.set(0)
+        self.counts = dict.fromkeys(events, 0)
+        self.update_counters()
 
         # Store session parameters into behavior group
-        for key, value in self.parameters.items():
+        attrs = dict(self.parameters, baud_rate=self.ser.baudrate)
+        for key, value in attrs.items():
             self.grp_behav.attrs[key] = value
 
-        # Clear Queues
-        for q in [self.q_serial]:
-            with q.mutex:
-                q.queue.clear()
+        # Write data to file from separate thread
+        self.writer = data_writer.DataWriter(self.grp_behav, arduino_events)
+        self.writer.start()
+
+        # Journal raw records so session can be recovered if GUI or file fails
+        self.journal = journal.Journal(
+            journal.journal_path(self.data_file.filename, self.grp_exp.name),
+            journal.session_metadata(self.grp_exp.name, arduino_events, streams, attrs=attrs),
+        )
+
+        # Clear buffer; reader only fills it (Tk is not thread-safe) and main
+        # loop polls it
+        self.q_serial.clear()
+        self.drain_stats = dict.fromkeys(self.drain_stats, 0)
 
         # Create thread to scan serial
         suppress = [
             # code_wheel if self.var_suppress_print_movement.get() else None
         ]
         thread_scan = threading.Thread(
-            target=scan_serial,
-            args=(self.q_serial, self.ser, self.var_print_arduino.get(), suppress, code_end)
+            target=serial_stream.scan_serial,
+            args=(self.q_serial, self.ser, self.var_print_arduino.get(), suppress, code_end),
+            kwargs={'journal': self.journal, 'print_head': arduino_head},
         )
         thread_scan.daemon = True    # Don't remember why this is here
 
@@ -367,15 +396,15 @@ class InputManager(tk.Frame):
         self.grp_behav.attrs['start_time'] = self.start_time.strftime('%H:%M:%S')
 
         # Update GUI
+        self.in_session = True
+        self.drain_pending = self.parent.after(poll_rate, self.drain_serial)
         self.update_session()
 
     def update_session(self):
-        # Checks Queue for incoming data from arduino. Data arrives as comma-separated values with the first element
-        # ('code') defining the type of data.
+        # Runs every `display_rate` ms during session to handle Stop button and update counters. Data from arduino is
+        # processed by `drain_serial`.
 
-        # Rate to update GUI
-        # Should be faster than data coming in, ie tracking rate
-        refresh_rate = 10
+        if not self.in_session: return
 
         # End on 'Stop' button (by user)
         if self.var_stop.get():
@@ -383,24 +412,54 @@ class InputManager(tk.Frame):
             self.ser.write('0'.encode())
             print('User triggered stop, sending signal to Arduino...')
 
-        # Watch incoming queue
-        # Data has format: [code, ts, extra values]
-        # Empty queue before leaving. Otherwise, a backlog will grow.
-        while not self.q_serial.empty():
-            code, ts, data = self.q_serial.get()
+        self.update_counters()
+        self.parent.after(display_rate, self.update_session)
+
+    def drain_serial(self):
+        # Runs every `poll_rate` ms during session and takes records from ring buffer until empty. Data arrives as rows
+        # of [code, ts, data] with the first element ('code') defining the type of data. Yields to Tk after
+        # `drain_budget` ms and continues on next pass of event loop.
+
+        self.drain_pending = None
+        if not self.in_session: return
 
-            # End session
-            if code == code_end:
-                arduino_end = ts
+        deadline = time.time() + drain_budget / 1000.
+        n_items = 0
+        overrun = False
+        while not self.q_serial.empty():
+            records = self.q_serial.get(drain_batch)
+            n_items += len(records)
+            self.writer.put(records)    # Saved to HDF5 file by writer thread
+
+            # Count data
+            codes = records[:, 0]
+            for code, name in arduino_events.items():
+                self.counts[name] += int(np.count_nonzero(codes == code))
+
+            # End session (reader stops at end code, so it is last)
+            is_end = codes == code_end
+            if is_end.any():
+                arduino_end = int(records[is_end, 1][0])
                 print('Arduino ended, finalizing data...')
+                self.update_counters()
                 self.stop_session(arduino_end=arduino_end)
                 return
 
-            # Record data
-            self.grp_behav[arduino_events[code]][:, self.counter[arduino_events[code]].get()] = [ts, data]
-            self.counter[arduino_events[code]].set(self.counter[arduino_events[code]].get() + 1)
+            if time.time() >= deadline:
+                self.drain_stats['overruns'] += 1
+                overrun = True
+                break
+
+        if n_items:
+            self.drain_stats['ticks'] += 1
+            self.drain_stats['items'] += n_items
+        self.drain_pending = self.parent.after(1 if overrun else poll_rate, self.drain_serial)
 
-        self.parent.after(refresh_rate, self.update_session)
+    def update_counters(self):
+        '''Show counts on GUI'''
+
+        for ev, n in self.counts.items():
+            self.counter[ev].set(n)
 
     def stop_session(self, frame_cutoff=None, arduino_end=None):
         '''Finalize session
@@ -409,20 +468,29 @@ class InputManager(tk.Frame):
 
         end_time = datetime.now().strftime('%H:%M:%S')
         print('Session ended at ' + end_time)
+        print('Processed data {ticks} times ({items} records, {overruns} overruns)'.format(**self.drain_stats))
+        self.in_session = False
+        if self.drain_pending is not None:
+            self.parent.after_cancel(self.drain_pending)
+            self.drain_pending = None
         self.gui_util('stop')
         self.close_serial()
 
         # Finalize data
         print('Finalizing behavioral data')
+        self.writer.close()
         self.grp_behav.attrs['end_time'] = end_time
         self.grp_behav.attrs['arduino_end'] = arduino_end
-        for ev in arduino_events.values():
-            self.grp_behav[ev].resize((2, self.counter[ev].get()))
         self.grp_exp.attrs['notes'] = self.scrolled_notes.get(1.0, 'end')
 
         # Close HDF5 file object
         print('Closing {}'.format(self.data_file.filename))
         self.data_file.close()
+
+        # Journal no longer needed once data is saved
+        self.journal.close(remove=not self.writer.error)
+        if self.writer.error:
+            print('Raw data kept in {}'.format(self.journal.filename))
         
         # Clear self.parameters
         self.parameters = {}
@@ -430,33 +498,6 @@ class InputManager(tk.Frame):
         print('All done!')
 
 
-def scan_serial(q_serial, ser, print_arduino=False, suppress=[], code_end=0):
-    '''Check serial for data
-    Continually check serial connection for data sent from Arduino. Send data 
-    through Queue to communicate with main GUI. Stop when `code_end` is 
-    received from serial.
-    '''
-
-    if print_arduino: print('  Scanning Arduino outputs.')
-    while 1:
-        input_arduino = ser.readline().decode()
-        if not input_arduino: continue
-
-        try:
-            input_split = [int(x) for x in input_arduino.split(',')]
-        except ValueError:
-            # If not all comma-separated values are int castable
-            if print_arduino: sys.stdout.write(arduino_head + input_arduino)
-        else:
-            if print_arduino and input_split[0] not in suppress:
-                # Only print from serial if code is not in list of codes to suppress
-                sys.stdout.write(arduino_head + input_arduino)
-            if input_arduino: q_serial.put(input_split)
-            if input_split[0] == code_end:
-                if print_arduino: print('  Scan complete.')
-                return
-
-
 def main():
     # GUI
     root = tk.Tk()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+'''
+Asynchronous serial reader
+
+Reads Arduino records on an asyncio event loop instead of a thread per port.
+The port's file descriptor is watched with `loop.add_reader`, so one loop can
+serve many rigs and wakes up as soon as data arrives. Batches of parsed
+records, (N, 3) arrays of [code, ts, data], come out of an async iterator:
+
+    async with SerialReader(ser, data_format) as reader:
+        async for records in reader:
+            ...
+
+Iteration stops after the end code. Waiting for data can be given a timeout,
+and cancelling the task iterating over the reader leaves the port open and
+the reader usable. If records are not taken out fast enough, reading pauses
+(data waits in the OS buffer) until they are.
+
+Needs Python 3 and a POSIX serial port (pyserial's `fileno`).
+
+Print records from open port:
+    python serial_async.py PORT [--format binary] [--timeout 5]
+'''
+
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import numpy as np
+import serial
+import serial_stream
+import clock_sync
+
+
+class SerialReader(object):
+    '''Async iterator of record batches from open serial `ser`
+    `data_format` is announced by Arduino in its opening message. Waiting for
+    a batch raises `asyncio.TimeoutError` after `timeout` s (None to wait
+    forever). Reading pauses while `max_pending` batches are waiting. Records
+    are appended to `journal` (if given) as they are read, and other lines are
+    passed to `on_message`. Batches are stamped with the host time they were
+    read and passed through `clock` (a `clock_sync.ClockSync`, if given).
+    '''
+
+    def __init__(self, ser, data_format='ascii', code_end=0, timeout=None, max_pending=64,
+                 journal=None, on_message=None, loop=None, clock=None):
+        self.ser = ser
+        self.fd = ser.fileno()
+        self.parser = serial_stream.make_parser(data_format)
+        self.code_end = code_end
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.journal = journal
+        self.on_message = on_message
+        self.clock = clock
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.pending = collections.deque()
+        self.waiter = None
+        self.reading = False
+        self.ended = False
+        self.error = None
+        self.n_pauses = 0       # Times reading paused for slow consumer
+        self.resume()
+
+    @property
+    def depth(self):
+        '''Records read but not yet taken'''
+        return sum(len(records) for records in self.pending)
+
+    def resume(self):
+        '''Watch port for data'''
+
+        if not self.reading and not self.ended and self.error is None:
+            self.loop.add_reader(self.fd, self._read)
+            self.reading = True
+
+    def pause(self):
+        '''Stop watching port'''
+
+        if self.reading:
+            self.loop.remove_reader(self.fd)
+            self.reading = False
+
+    def close(self):
+        '''Stop reading; iteration ends after records already read'''
+
+        self.pause()
+        self.ended = True
+        self._wake()
+
+    def _read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self._fail(err)
+            return
+        if not data:
+            self._fail(IOError('Serial port closed'))
+            return
+        read_ns = clock_sync.now_ns()
+
+        records, messages = self.parser.feed(data)
+        if self.clock: records = self.clock.receive(records, read_ns)
+        if self.on_message:
+            for msg in messages: self.on_message(msg)
+
+        # Stop at end code; anything after it is not part of session
+        is_end = records[:, 0] == self.code_end
+        if is_end.any():
+            records = records[:np.argmax(is_end) + 1]
+            self.close()
+        if len(records):
+            if self.journal: self.journal.write(records)
+            self.pending.append(records)
+            if len(self.pending) >= self.max_pending:
+                self.pause()
+                self.n_pauses += 1
+        self._wake()
+
+    def _fail(self, err):
+        self.pause()
+        self.error = err
+        self._wake()
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.pending:
+            if self.error is not None:
+                raise self.error
+            if self.ended:
+                raise StopAsyncIteration
+            self.waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, self.timeout)
+            finally:
+                self.waiter = None
+
+        # Everything waiting is returned as one batch
+        if len(self.pending) == 1:
+            records = self.pending.popleft()
+        else:
+            records = np.concatenate(self.pending)
+            self.pending.clear()
+        self.resume()
+        return records
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+async def print_records(port, data_format, timeout):
+    ser = serial.Serial(port, serial_stream.base_baud)
+    try:
+        on_message = lambda msg: sys.stdout.write(msg)
+        async with SerialReader(ser, data_format, timeout=timeout, on_message=on_message) as reader:
+            async for records in reader:
+                sys.stdout.write(serial_stream.format_records(records))
+    finally:
+        ser.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print records from Arduino')
+    parser.add_argument('port')
+    parser.add_argument('--format', choices=[serial_stream.format_ascii, serial_stream.format_binary],
+                        default=serial_stream.format_ascii)
+    parser.add_argument('--timeout', type=float, help='Stop if nothing arrives for this long (s)')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(print_records(args.port, args.format, args.timeout))
+    except asyncio.TimeoutError:
+        print('No data for {} s'.format(args.timeout))
+
+
+if __name__ == '__main__':
+    main()
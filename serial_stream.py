@@ -0,0 +1,822 @@
+#!/usr/bin/env python
+
+'''
+Serial stream
+
+Reads data from Arduino in batches. Records are sent as comma-separated
+"triplets" (`code,ts,data`) terminated by a newline. Instead of reading and
+parsing one line at a time, everything waiting in the serial buffer is read at
+once and all complete lines are parsed together into an (N, 3) array. Any
+incomplete line at the end of a read is kept until the next read.
+
+Lines that are not purely numeric (eg, status messages from Arduino) are
+returned separately so they can still be printed.
+
+Firmware using the Behavior library can instead send records as packed binary
+frames (see `Behavior::SendPacked`). The format is announced in the opening
+message; firmware that does not announce a format sends ASCII.
+
+Parsed records are passed from the thread reading serial (`scan_serial`) to 
+the GUI through a `RingBuffer`, which stores records in a preallocated array.
+
+Serial connections open at `base_baud`. Firmware that announces a maximum 
+baud rate in its opening message can be moved to a faster rate with 
+`negotiate_baud` before parameters are sent.
+
+`Connector` opens a port and uploads parameters from a worker thread so GUIs 
+stay responsive (and several rigs can connect at once) while Arduino resets.
+
+Opening a port resets most Arduinos (DTR), so ports can instead be held open 
+between sessions: `code_param_mode` restarts the firmware without a reset and 
+the next parameters are uploaded within milliseconds. Firmware echoes 
+parameters with a checksum, which is compared with what was sent 
+(`check_echo`).
+'''
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import warnings
+import numpy as np
+import serial
+import serial.tools.list_ports
+import clock_sync
+
+
+# Data formats
+format_ascii = 'ascii'
+format_binary = 'binary'
+
+# Baud rates
+# Connections always start at `base_baud` (Arduino resets when port opens). 
+# Faster rates are tried in order; these are exact at 16 MHz except 115200.
+base_baud = 9600
+baud_rates = [2000000, 1000000, 500000, 250000, 115200]
+code_baud = 'B'
+code_baud_check = 'C'
+baud_check_timeout = 1.0    # Matches BAUD_CHECK_TIMEOUT in Behavior.h
+
+# Last line of opening message
+handshake_end = 'Waiting for parameters'
+
+# Restart firmware to wait for parameters (CODEPARAMMODE in Behavior.h)
+code_param_mode = 'P'
+
+# Virtual Arduinos (see virtual_arduino.py) link their ports here
+virtual_port_dir = os.path.join(tempfile.gettempdir(), 'virtual-arduino')
+
+# Binary frame layout (matches Behavior.h)
+frame_sync = b'\xa5\x5a'
+frame_dtype = np.dtype([
+    ('sync', 'u1', 2),
+    ('code', 'u1'),
+    ('ts', '<u4'),
+    ('data', '<i4'),
+    ('checksum', 'u1'),
+])
+frame_size = frame_dtype.itemsize
+
+# Byte values used to classify lines
+_newline = ord('\n')
+_return = ord('\r')
+_comma = ord(',')
+_minus = ord('-')
+_zero = ord('0')
+_nine = ord('9')
+
+
+class LineParser(object):
+    '''Parse a byte stream of comma-separated records
+    Bytes are added with `feed`, which returns records from all lines that
+    have been completed so far.
+    '''
+
+    def __init__(self, n_fields=3, dtype=np.int64):
+        self.n_fields = n_fields
+        self.dtype = dtype
+        self.partial = b''
+
+    def feed(self, raw):
+        '''Add bytes to stream
+        Returns `(records, messages)`. `records` is an (N, n_fields) array of
+        numeric lines in the order they arrived. `messages` is a list of
+        decoded lines that could not be parsed as records.
+        '''
+
+        buf = self.partial + raw
+        end = buf.rfind(b'\n') + 1
+        self.partial = buf[end:]
+        return parse_lines(buf[:end], self.n_fields, self.dtype)
+
+    def clear(self):
+        self.partial = b''
+
+
+class BinaryDecoder(object):
+    '''Decode a byte stream of packed binary frames
+    Same interface as `LineParser`. Text sent between frames (eg, status 
+    messages) is returned as messages once its line is complete; frames can 
+    arrive in the middle of a line.
+    '''
+
+    def __init__(self, n_fields=3, dtype=np.int64):
+        self.n_fields = n_fields
+        self.dtype = dtype
+        self.partial = b''
+        self.text = b''         # Text of incomplete line
+        self.n_bad_frames = 0
+
+    def feed(self, raw):
+        '''Add bytes to stream
+        Returns `(records, messages)` like `LineParser.feed`.
+        '''
+
+        buf = self.partial + raw
+        frames, starts, n_bad = find_frames(buf)
+        self.n_bad_frames += n_bad
+
+        # Text between frames
+        # Frames are sent whole, so only text after last frame can be partial.
+        text_end = starts[-1] + frame_size if starts.size else 0
+        text = _between_frames(buf[:text_end], starts)
+
+        # Keep possible partial frame at end of buffer
+        tail = buf[text_end:]
+        sync_ix = tail.find(frame_sync[:1], max(0, len(tail) - frame_size + 1))
+        if sync_ix < 0: sync_ix = len(tail)
+        text += tail[:sync_ix]
+        self.partial = tail[sync_ix:]
+
+        # Keep text after last newline until its line is complete
+        lines = (self.text + text).split(b'\n')
+        self.text = lines.pop()
+
+        records = np.empty((frames.size, self.n_fields), dtype=self.dtype)
+        records[:, 0] = frames['code']
+        records[:, 1] = frames['ts']
+        records[:, 2] = frames['data']
+        messages = [line.decode('utf-8', 'replace') + '\n' for line in lines]
+        return records, messages
+
+    def clear(self):
+        self.partial = b''
+        self.text = b''
+
+
+def find_frames(buf):
+    '''Find valid binary frames in buffer
+    Returns `(frames, starts, n_bad)`: structured array of frames, their 
+    positions in `buf` and the number of sync sequences that failed checksum. 
+    When frames are back-to-back (the usual case) they are read directly from 
+    `buf` without copying.
+    '''
+
+    chars = np.frombuffer(buf, dtype=np.uint8)
+    n = chars.size - frame_size + 1
+    empty = np.empty(0, dtype=frame_dtype)
+    if n <= 0:
+        return empty, np.empty(0, dtype=np.intp), 0
+
+    # Candidate frames start with sync bytes
+    candidates = np.flatnonzero(
+        (chars[:n] == frame_sync[0]) & (chars[1:n + 1] == frame_sync[1])
+    )
+    if not candidates.size:
+        return empty, candidates, 0
+
+    # Validate checksum
+    rows = chars[candidates[:, None] + np.arange(frame_size)]
+    checksum = rows[:, 2:-1].sum(axis=1, dtype=np.uint32) & 0xFF
+    is_valid = checksum == rows[:, -1]
+    starts = candidates[is_valid]
+    if not starts.size:
+        return empty, starts, candidates.size
+
+    # Sync bytes can also appear inside a frame. Resolve overlaps in order.
+    if np.any(np.diff(starts) < frame_size):
+        keep = []
+        next_free = 0
+        for start in starts.tolist():
+            if start >= next_free:
+                keep.append(start)
+                next_free = start + frame_size
+        starts = np.array(keep, dtype=np.intp)
+    n_bad = np.count_nonzero(~is_valid & ~_inside_frames(candidates, starts))
+
+    if starts[-1] - starts[0] == (starts.size - 1) * frame_size:
+        frames = np.frombuffer(buf, dtype=frame_dtype, count=starts.size, offset=starts[0])
+    else:
+        frames = chars[starts[:, None] + np.arange(frame_size)].copy().view(frame_dtype)[:, 0]
+    return frames, starts, n_bad
+
+
+def _inside_frames(positions, starts):
+    '''Whether each position falls inside a frame'''
+
+    ix = np.searchsorted(starts, positions, side='right') - 1
+    return (ix >= 0) & (positions < starts[np.maximum(ix, 0)] + frame_size)
+
+
+def _between_frames(buf, starts):
+    '''Bytes in `buf` not covered by frames starting at `starts`'''
+
+    if not starts.size:
+        return buf
+    ends = starts + frame_size
+    gaps = zip([0] + ends[:-1].tolist(), starts.tolist())
+    return b''.join(buf[start:end] for start, end in gaps if end > start)
+
+
+def detect_format(handshake):
+    '''Determine data format from Arduino opening message'''
+
+    for line in handshake.splitlines():
+        if line.strip() == 'Data format: ' + format_binary:
+            return format_binary
+    return format_ascii
+
+
+def detect_max_baud(handshake):
+    '''Determine fastest baud rate from Arduino opening message
+    Returns None if Arduino does not support changing baud rate.
+    '''
+
+    for line in handshake.splitlines():
+        if line.startswith('Max baud: '):
+            try:
+                return int(line.split(':')[1])
+            except ValueError:
+                pass
+    return None
+
+
+def negotiate_baud(ser, max_baud, rates=baud_rates, n_checks=3, verbose=False):
+    '''Move serial connection to fastest working baud rate
+    Only use with firmware that announces its maximum baud rate (see 
+    `detect_max_baud`); older firmware treats digits as commands. For each 
+    rate up to `max_baud`, Arduino acknowledges the request at the current 
+    rate, both ends switch, and host confirms at the new rate. If confirmation 
+    fails, both ends fall back to the previous rate and the next rate is 
+    tried.
+
+    Returns baud rate in use, or None if Arduino could not be confirmed at 
+    any rate (connection should be reset).
+    '''
+
+    base = ser.baudrate
+    timeout = ser.timeout
+    for rate in rates:
+        if rate > max_baud or rate <= base: continue
+
+        ser.reset_input_buffer()
+        ser.write('{}{}\n'.format(code_baud, rate).encode())
+        ack = ser.readline().decode('utf-8', 'replace').strip()
+        if ack == 'Baud {}'.format(rate):
+            ser.baudrate = rate
+            if _check_baud(ser, n_checks):
+                ser.timeout = timeout
+                return rate
+
+        # Arduino restores previous rate if not confirmed in time
+        if verbose: print('Baud rate {} failed'.format(rate))
+        ser.baudrate = base
+        time.sleep(baud_check_timeout)
+        if not _check_baud(ser, 1):
+            ser.timeout = timeout
+            return None
+
+    ser.timeout = timeout
+    return base
+
+
+def _check_baud(ser, n_checks):
+    '''Confirm Arduino responds at current baud rate
+    All checks are sent within Arduino's confirmation window.
+    '''
+
+    ser.timeout = baud_check_timeout / (n_checks + 1)
+    for _ in range(n_checks):
+        ser.reset_input_buffer()
+        ser.write(code_baud_check.encode())
+        if ser.readline().strip() == b'Baud OK':
+            return True
+    return False
+
+
+def params_message(values, code_params='D', delim='+'):
+    '''Message to upload parameters `values`
+    Ends with a newline so Arduino's `parseInt` returns the last value 
+    without waiting for its timeout (1 s).
+    '''
+    return code_params + delim.join(str(v) for v in values) + '\n'
+
+
+def params_checksum(values):
+    '''Checksum of parameters as computed by `Behavior::SendParams`'''
+    return sum(int(v) for v in values) % 2**32
+
+
+def check_echo(response, values):
+    '''Compare parameters echoed by Arduino with `values` sent
+    `response` is text read from Arduino after parameters were sent. Returns 
+    None if echo and checksum match, otherwise an error message.
+    '''
+
+    echo = checksum = None
+    for line in response.splitlines():
+        if line.startswith('Params: '):
+            echo = line[len('Params: '):].strip()
+        elif line.startswith('Checksum: '):
+            checksum = line[len('Checksum: '):].strip()
+    if echo is None or checksum is None:
+        return 'parameters not echoed'
+
+    try:
+        echoed = [int(v) for v in echo.split('+')]
+        checksum = int(checksum)
+    except ValueError:
+        return 'could not read echoed parameters'
+    sent = [int(v) % 2**32 for v in values]
+    if len(echoed) != len(sent):
+        return '{} parameters echoed, {} sent'.format(len(echoed), len(sent))
+    for p, (echoed_value, sent_value) in enumerate(zip(echoed, sent)):
+        if echoed_value != sent_value:
+            return 'parameter {} echoed as {} (sent {})'.format(p, echoed_value, sent_value)
+    if checksum != params_checksum(sent):
+        return 'checksum {} does not match {}'.format(checksum, params_checksum(sent))
+    return None
+
+
+class Connector(threading.Thread):
+    '''Open serial connection and upload parameters without blocking
+    Steps run in a worker thread; `state` is the current one:
+    - 'opening': open `port` on `ser` at `base_baud`
+    - 'restarting' (before 'opening', if `port` is already open on `ser`): 
+      restart firmware with `code_param_mode`, skipping to 'baud' if Arduino 
+      answers within `restart_timeout` s. Otherwise (eg, a line was lost), 
+      the port is reopened with DTR deasserted, so Arduino is not reset, and 
+      firmware is restarted once more; if it still does not answer, the 
+      connector fails and the port must be closed to reset Arduino.
+    - 'resetting': wait `delay` s for Arduino to reset
+    - 'handshake': read opening message (sets `data_format`) up to line with 
+      `handshake_end`
+    - 'baud': move to fastest baud rate Arduino supports
+    - 'uploading': send `message`
+    - 'acknowledging': read lines for up to `timeout` s. If `values` (the 
+      parameters in `message`) are given, their echo is checked first (see 
+      `check_echo`). Lines are then passed to `ack`, which returns True once 
+      parameters are accepted, an error message if they are rejected, or 
+      None to keep reading (by default, any line is accepted).
+    - 'done' or 'error' (with `error` describing failure)
+
+    Poll `state` (eg, with Tk's `after`) or pass `on_done`, which is called 
+    with the connector from the worker thread. The port is left open on 
+    error. Lines from Arduino are printed with `print_head` if given.
+    '''
+
+    def __init__(self, ser, port, message, delay=3, timeout=10, ack=None, verbose=False,
+                 print_head=None, on_done=None, values=None, restart_timeout=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.ser = ser
+        self.port = port
+        self.message = message
+        self.delay = delay
+        self.timeout = timeout
+        self.ack = ack or (lambda line: True)
+        self.verbose = verbose
+        self.print_head = print_head
+        self.on_done = on_done
+        self.values = values
+        self.restart_timeout = restart_timeout
+
+        self.state = 'opening'
+        self.error = None
+        self.data_format = format_ascii
+        self.handshake = ''
+
+    @property
+    def finished(self):
+        return self.state in ['done', 'error']
+
+    def run(self):
+        try:
+            self.error = self.connect()
+        except (serial.SerialException, IOError, OSError) as err:
+            self.error = str(err)
+        self.state = 'error' if self.error else 'done'
+        if self.on_done: self.on_done(self)
+
+    def connect(self):
+        '''Run steps; returns error message if Arduino did not respond'''
+
+        restarted = False
+        if self.ser.is_open and self.ser.port == self.port:
+            # Held open since last session
+            self.state = 'restarting'
+            restarted = self.restart()
+            if not restarted:
+                # Reopen without asserting DTR, so Arduino is not reset
+                if self.verbose: print('Arduino did not restart, reopening port')
+                self.state = 'opening'
+                self.ser.close()
+                self.ser.dtr = False
+                self.ser.baudrate = base_baud
+                self.ser.open()
+                self.state = 'restarting'
+                restarted = self.restart()
+                if not restarted:
+                    return 'Arduino did not restart; close port to reset it'
+        if not restarted:
+            self.state = 'opening'
+            if self.ser.is_open: self.ser.close()
+            self.ser.port = self.port
+            self.ser.baudrate = base_baud
+            self.ser.dtr = True                 # Reset Arduino on open
+            self.ser.open()
+
+            self.state = 'resetting'
+            time.sleep(self.delay)
+            if self.verbose: print('Connection to Arduino opened')
+            self.state = 'handshake'
+            self.read_handshake()
+        self.data_format = detect_format(self.handshake)
+        if self.verbose: print('Data format: {}'.format(self.data_format))
+
+        self.state = 'baud'
+        max_baud = detect_max_baud(self.handshake)
+        if max_baud and negotiate_baud(self.ser, max_baud, verbose=self.verbose) is None:
+            return 'Arduino did not respond at any baud rate'
+        if self.verbose: print('Baud rate: {}'.format(self.ser.baudrate))
+
+        self.state = 'uploading'
+        if self.verbose: print('Sending parameters as `{}`'.format(self.message.strip()))
+        try:
+            self.ser.write(self.message.encode())
+        except serial.SerialTimeoutException:
+            return 'write timeout'
+
+        # Blocking reads with serial timeout; no busy waiting
+        self.state = 'acknowledging'
+        deadline = time.time() + self.timeout
+        response = ''
+        verified = self.values is None
+        while time.time() < deadline:
+            line = self.readline()
+            if not line: continue
+            if not verified:
+                response += line
+                if not line.startswith('Checksum: '): continue
+                error = check_echo(response, self.values)
+                if error: return error
+                verified = True
+                if self.verbose: print('Parameters verified')
+                continue
+            result = self.ack(line)
+            if result is True:
+                while self.ser.in_waiting: self.readline()
+                return None
+            elif result is not None:
+                return result
+        return 'start signal not found' if verified else 'parameters not echoed'
+
+    def restart(self):
+        '''Restart firmware on open port; returns False if it does not answer'''
+
+        self.ser.reset_input_buffer()
+        self.ser.write(code_param_mode.encode())
+        self.ser.flush()
+        self.ser.baudrate = base_baud           # Firmware starts over at base rate
+
+        timeout = self.ser.timeout
+        self.ser.timeout = self.restart_timeout
+        try:
+            self.read_handshake(self.restart_timeout)
+        finally:
+            self.ser.timeout = timeout
+        return handshake_end in self.handshake
+
+    def read_handshake(self, timeout=None):
+        '''Read opening message, which announces data format (ASCII if not 
+        announced). It ends when Arduino asks for parameters or stops sending 
+        (or after `timeout` s, if Arduino is still busy with a session).
+        '''
+
+        self.handshake = ''
+        deadline = time.time() + timeout if timeout else None
+        while 1:
+            line = self.readline()
+            self.handshake += line
+            if not line or handshake_end in line: break
+            if deadline and time.time() > deadline: break
+
+    def readline(self):
+        line = self.ser.readline().decode('utf-8', 'replace')
+        if self.print_head and line: sys.stdout.write(self.print_head + line)
+        return line
+
+
+def list_ports():
+    '''Available serial ports as `(device, description)`
+    Includes ports of virtual Arduinos.
+    '''
+
+    ports = [(port.device, port.description) for port in serial.tools.list_ports.comports()]
+    return ports + virtual_ports()
+
+
+def virtual_ports():
+    '''Ports of running virtual Arduinos as `(device, description)`'''
+
+    ports = []
+    if os.path.isdir(virtual_port_dir):
+        for name in sorted(os.listdir(virtual_port_dir)):
+            link = os.path.join(virtual_port_dir, name)
+            if os.path.exists(link):
+                ports.append((link, 'Virtual Arduino ({})'.format(name)))
+    return ports
+
+
+def make_parser(data_format=format_ascii):
+    '''Create parser for data format'''
+
+    if data_format == format_binary:
+        return BinaryDecoder()
+    return LineParser()
+
+
+class RingBuffer(object):
+    '''Single-producer/single-consumer buffer of records
+    Records are copied into a preallocated array. One thread calls `put` and 
+    one thread calls `get`; each only moves its own index, so no lock is 
+    needed. Indices only increase, and the number of records waiting is their 
+    difference.
+
+    If `notify` is set, `put` calls it (from the producer thread) when records 
+    arrive and the consumer is waiting for them, i.e. once per burst rather 
+    than once per `put`. The consumer calls `rearm` when it runs out of records.
+    `notify` has to be safe to call from another thread (eg, setting a 
+    `threading.Event`); Tk consumers poll the buffer from their main loop 
+    instead.
+
+    A producer that stops on an error calls `fail`, which keeps it in `error` 
+    and notifies the consumer.
+    '''
+
+    def __init__(self, capacity=2**20, n_fields=3, dtype=np.int64, notify=None):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, n_fields), dtype=dtype)
+        self.ix_write = 0
+        self.ix_read = 0
+        self.n_waits = 0    # Times `put` waited for space
+        self.notify = notify
+        self.notified = False
+        self.error = None
+
+    def __len__(self):
+        return self.ix_write - self.ix_read
+
+    def empty(self):
+        return self.ix_write == self.ix_read
+
+    @property
+    def fill_level(self):
+        '''Fraction of buffer in use'''
+        return float(len(self)) / self.capacity
+
+    def put(self, records, wait=0.001):
+        '''Add records (producer)
+        Waits for space if buffer is full rather than overwriting records.
+        '''
+
+        n = len(records)
+        start = 0
+        while start < n:
+            space = self.capacity - len(self)
+            if not space:
+                self.n_waits += 1
+                time.sleep(wait)
+                continue
+            count = min(space, n - start)
+            self._copy_in(records[start:start + count])
+            self.ix_write += count     # Publish only after data is copied
+            start += count
+
+        if n and self.notify is not None and not self.notified:
+            self.notified = True
+            self.notify()
+
+    def get(self, max_count=None):
+        '''Remove waiting records (consumer)
+        Returns a copy of up to `max_count` records (all if None).
+        '''
+
+        count = len(self)
+        if max_count is not None: count = min(count, max_count)
+        pos = self.ix_read % self.capacity
+        end = pos + count
+        if end <= self.capacity:
+            records = self.data[pos:end].copy()
+        else:
+            records = np.concatenate([self.data[pos:], self.data[:end - self.capacity]])
+        self.ix_read += count
+        return records
+
+    def rearm(self):
+        '''Wait for `notify` on next `put` (consumer)
+        Returns False if records arrived in the meantime; the consumer should 
+        keep reading, as no notification will come for them.
+        '''
+
+        self.notified = False
+        return self.empty()
+
+    def fail(self, error):
+        '''Producer stopped on `error` (producer)
+        Records put before it can still be taken.
+        '''
+
+        self.error = error
+        self.notified = True
+        if self.notify is not None: self.notify()
+
+    def clear(self):
+        '''Discard all records; only call when neither thread is active'''
+        self.ix_read = self.ix_write
+        self.notified = False
+        self.error = None
+
+    def _copy_in(self, records):
+        pos = self.ix_write % self.capacity
+        end = pos + len(records)
+        if end <= self.capacity:
+            self.data[pos:end] = records
+        else:
+            split = self.capacity - pos
+            self.data[pos:] = records[:split]
+            self.data[:end - self.capacity] = records[split:]
+
+
+def parse_lines(buf, n_fields=3, dtype=np.int64):
+    '''Parse complete lines
+    `buf` holds newline-terminated lines. Lines are classified with vectorized
+    operations: a line is a record if it only contains digits, minus signs and
+    `n_fields - 1` commas. Numeric lines are converted in a single pass.
+    '''
+
+    empty = np.empty((0, n_fields), dtype=dtype)
+    if not buf:
+        return empty, []
+
+    chars = np.frombuffer(buf, dtype=np.uint8)
+    is_newline = chars == _newline
+    is_comma = chars == _comma
+    n_lines = np.count_nonzero(is_newline)
+
+    # Line index for each character (newline belongs to its own line)
+    line_ix = np.cumsum(is_newline) - is_newline
+
+    is_valid = (
+        ((chars >= _zero) & (chars <= _nine)) |
+        is_comma | is_newline | (chars == _return) | (chars == _minus)
+    )
+    n_commas = np.bincount(line_ix[is_comma], minlength=n_lines)
+    n_invalid = np.bincount(line_ix[~is_valid], minlength=n_lines)
+    is_record = (n_commas == n_fields - 1) & (n_invalid == 0)
+
+    records = empty
+    if is_record.any():
+        text = chars[is_record[line_ix]].tobytes()
+        text = text.replace(b'\r', b'').replace(b'\n', b',')[:-1]
+        n_records = np.count_nonzero(is_record)
+        try:
+            with warnings.catch_warnings():
+                # Malformed fields (eg, '1,,2') either raise or stop parsing 
+                # early depending on NumPy version
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(text.decode(), dtype=dtype, sep=',')
+        except ValueError:
+            values = np.empty(0, dtype=dtype)
+        if values.size == n_records * n_fields:
+            records = values.reshape(n_records, n_fields)
+        else:
+            records, is_record = _parse_slow(buf, is_record, n_fields, dtype)
+
+    messages = []
+    if not is_record.all():
+        lines = buf.split(b'\n')[:-1]
+        messages = [
+            line.decode('utf-8', 'replace') + '\n'
+            for line, rec in zip(lines, is_record) if not rec
+        ]
+
+    return records, messages
+
+
+def _parse_slow(buf, is_record, n_fields, dtype):
+    '''Parse candidate records one line at a time
+    Fallback for the rare batch where a line passes classification but cannot
+    be converted.
+    '''
+
+    is_record = is_record.copy()
+    rows = []
+    for ix, line in enumerate(buf.split(b'\n')[:-1]):
+        if not is_record[ix]: continue
+        try:
+            rows.append([int(x) for x in line.split(b',')])
+        except ValueError:
+            is_record[ix] = False
+    records = np.array(rows, dtype=dtype).reshape(-1, n_fields)
+    return records, is_record
+
+
+def read_available(ser):
+    '''Read everything waiting in serial buffer
+    Blocks for up to the serial timeout if nothing is waiting.
+    '''
+
+    return ser.read(max(1, ser.in_waiting))
+
+
+def format_records(records, delim=','):
+    '''Format records as they were sent by Arduino (for printing)'''
+
+    return ''.join(delim.join(str(x) for x in row) + '\n' for row in records.tolist())
+
+
+def scan_serial(q_serial, ser, print_arduino=False, suppress=[], code_end=0, data_format=format_ascii,
+                journal=None, clock=None, latency=None, stop=None, print_head='  [a]: '):
+    '''Check serial for data
+    Continually check serial connection for data sent from Arduino. Everything
+    waiting on serial is read at once and complete lines are parsed into an
+    (N, 3) array. Send each batch through ring buffer `q_serial` to GUI.
+    Stop when `code_end` is received from serial, or once `stop` (a
+    `threading.Event`, if given) is set. If serial fails (eg, Arduino is
+    unplugged), the error is passed to `q_serial.fail` and reading stops.
+
+    `data_format` is announced by Arduino in opening message: 'ascii' for
+    comma-separated lines or 'binary' for packed frames. Records are also
+    appended to `journal` (if given) before being sent to GUI. Each batch is
+    stamped with the host time it was read and passed through `clock` (a
+    `clock_sync.ClockSync`, if given), which takes out sync replies. Time
+    spent reading and parsing is added to `latency` (a `latency.Latency`, if
+    given), which is told of batches put in the ring buffer.
+
+    With `print_arduino`, messages and records (except codes in `suppress`)
+    are printed after `print_head`.
+    '''
+
+    parser = make_parser(data_format)
+    suppress = [code for code in suppress if code is not None]
+    while stop is None or not stop.is_set():
+        try:
+            input_arduino = read_available(ser)
+        except (serial.SerialException, IOError, OSError) as err:
+            q_serial.fail(err)
+            return
+        if not input_arduino: continue
+        read_ns = clock_sync.now_ns()
+
+        records, messages = parser.feed(input_arduino)
+        if latency: parsed_ns = clock_sync.now_ns()
+        if clock: records = clock.receive(records, read_ns)
+        if latency and len(records):
+            latency.add('parse', parsed_ns - read_ns, len(records))
+            if clock: latency.add_read(records[:, 1], read_ns, clock)
+
+        # Stop at end code; anything after it is not part of session
+        is_end = records[:, 0] == code_end
+        ended = is_end.any()
+        if ended: records = records[:np.argmax(is_end) + 1]
+
+        if print_arduino:
+            # Lines that are not all int castable are always printed. Records
+            # are only printed if code is not in list of codes to suppress.
+            for msg in messages: sys.stdout.write(print_head + msg)
+            printed = records[~np.isin(records[:, 0], suppress)]
+            for line in format_records(printed).splitlines(True):
+                sys.stdout.write(print_head + line)
+        if len(records):
+            if journal: journal.write(records)
+            if latency: latency.queued(q_serial.ix_write, len(records), read_ns, parsed_ns)
+            q_serial.put(records)
+        if ended:
+            if print_arduino: print('  Scan complete.')
+            return
+
+
+def pack_frames(records):
+    '''Pack records into binary frames as sent by Arduino'''
+
+    frames = np.zeros(len(records), dtype=frame_dtype)
+    frames['sync'] = np.frombuffer(frame_sync, dtype=np.uint8)
+    frames['code'] = records[:, 0]
+    frames['ts'] = records[:, 1]
+    frames['data'] = records[:, 2]
+    chars = frames.view(np.uint8).reshape(-1, frame_size)
+    frames['checksum'] = chars[:, 2:-1].sum(axis=1, dtype=np.uint32) & 0xFF
+    return frames.tobytes()
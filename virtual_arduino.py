@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+
+'''
+Virtual Arduino
+
+Emulates a rig on a pseudo-terminal so the Python side can be run and load
+tested without hardware. Speaks the same serial protocol as the firmware:
+
+- 'go-no-go': go-no-go_arduino.ino. Opening message announces data format and
+  maximum baud rate, 39 parameters follow 'D', session starts with 'E' and
+  records are sent as ASCII lines or binary frames.
+- 'wheel': track_wheel.ino. Parameters (session_dur, track_period) follow 'D'
+  and end with 271828. Records are ASCII.
+
+Parameters are echoed back with a checksum. '0' stops the session, and 'P'
+(outside of a session) restarts the firmware to wait for parameters again.
+Sync pings ('S') during a session are answered with the current timestamp;
+the device clock runs `clock_drift` ppm fast (negative: slow).
+Baud rate changes ('B', 'C') are acknowledged, though they have no effect on
+a pseudo-terminal.
+
+Like an Arduino, the device resets when the port is opened: the opening
+message is sent shortly after the host connects, and the device waits for a
+new connection once the host closes the port. Detecting the host relies on
+Linux pseudo-terminal behavior.
+
+Licks arrive at `lick_rate` (Poisson), each with a waveform sampled
+`form_rate` times per second for `form_window` ms around the lick (the
+firmware sends a sample on every loop while the sensor is near threshold).
+The wheel moves in a fraction `move_prob` of tracking periods. Records are
+written every `tick` ms, with up to `jitter` ms of extra random delay.
+
+Ports are linked into `serial_stream.virtual_port_dir`, where
+`serial_stream.list_ports` finds them for the GUIs.
+
+Usage:
+    python virtual_arduino.py [--firmware go-no-go] [--lick-rate 5] ...
+'''
+
+import argparse
+import errno
+import os
+import pty
+import select
+import threading
+import time
+import tty
+import numpy as np
+import serial_stream
+import clock_sync
+
+
+firmwares = ['go-no-go', 'wheel']
+code_last_param = 271828
+boot_delay = 0.5        # Time (s) from port opening to opening message
+restart_delay = 0.02    # Time (s) from restart command to opening message
+parse_timeout = 1.0     # Like Arduino's Stream.parseInt
+
+# Go/no-go parameters in order sent by GUI
+gonogo_params = [
+    'session_type', 'pre_session', 'post_session', 'session_dur',
+    'cs0_num', 'cs1_num', 'cs2_num', 'iti_distro', 'mean_iti', 'min_iti',
+    'max_iti', 'pre_stim', 'post_stim', 'cs0_dur', 'cs0_freq', 'cs0_pulse',
+    'us0_dur', 'us0_delay', 'cs1_dur', 'cs1_freq', 'cs1_pulse', 'us1_dur',
+    'us1_delay', 'cs2_dur', 'cs2_freq', 'cs2_pulse', 'us2_dur', 'us2_delay',
+    'consumption_dur', 'vac_dur', 'trial_signal_offset', 'trial_signal_dur',
+    'trial_signal_freq', 'grace_dur', 'response_dur', 'timeout_dur',
+    'image_all', 'image_ttl_dur', 'track_period',
+]
+wheel_params = ['session_dur', 'track_period', 'last_param']
+
+# Output codes (go-no-go)
+code_end = 0
+code_lick = 1
+code_lick_form = 9
+code_movement = 2
+code_trial_start = 3
+code_trial_signal = 4
+code_cs_start = 5
+code_us_start = 6
+code_response = 7
+code_next_trial = 8
+code_wheel = 7
+
+# Session types
+session_classical_conditioning = 0
+session_go_nogo = 1
+session_free_licking = 2
+
+block_dur = 10000       # Records are generated in blocks of this length (ms)
+lick_dur = 40           # Time (ms) tongue is on spout
+
+
+class HostClosed(Exception):
+    pass
+
+
+class Restart(Exception):
+    pass
+
+
+class VirtualArduino(threading.Thread):
+    '''Device on a pseudo-terminal
+    Start thread and connect to `port` (or `link`, if set).
+    '''
+
+    def __init__(self, firmware='go-no-go', data_format=serial_stream.format_ascii,
+                 max_baud=2000000, lick_rate=5., form_rate=1000., form_window=60,
+                 move_prob=0.5, tick=5., jitter=0., link=None, seed=None, verbose=False, clock_drift=0.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        if firmware not in firmwares:
+            raise ValueError('Unknown firmware {}'.format(firmware))
+        self.firmware = firmware
+        self.data_format = data_format if firmware == 'go-no-go' else serial_stream.format_ascii
+        self.max_baud = max_baud
+        self.lick_rate = lick_rate
+        self.form_rate = form_rate
+        self.form_window = form_window
+        self.move_prob = move_prob
+        self.tick = tick
+        self.jitter = jitter
+        self.clock_drift = clock_drift
+        self.verbose = verbose
+        self.rng = np.random.RandomState(seed)
+
+        self.fd, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        os.close(slave)         # Host holds the only slave descriptor once connected
+
+        self.link = link
+        if self.link:
+            if os.path.lexists(self.link): os.remove(self.link)
+            os.symlink(self.port, self.link)
+
+        self.inbuf = bytearray()
+        self.parameters = {}
+        self.n_sessions = 0
+        self.n_records = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                if not self.wait_for_host(): break
+                delay = boot_delay
+                while 1:
+                    try:
+                        self.boot(delay)
+                    except Restart:
+                        if self.verbose: print('Restarted by host on {}'.format(self.port))
+                        delay = restart_delay
+                    except HostClosed:
+                        if self.verbose: print('Host disconnected from {}'.format(self.port))
+                        break
+        finally:
+            os.close(self.fd)
+            if self.link and os.path.lexists(self.link):
+                os.remove(self.link)
+
+    def stop(self):
+        '''Stop device and remove port'''
+        self.stopped.set()
+        self.join()
+
+    # Pseudo-terminal
+    def wait_for_host(self, poll=0.05):
+        '''Wait for host to open port; returns False if stopped'''
+
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.fd], [], [], poll)
+            if not readable:
+                return True
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as err:
+                # No slave open
+                if err.errno != errno.EIO: raise
+                time.sleep(poll)
+            else:
+                self.inbuf.extend(data)
+                return True
+        return False
+
+    def read(self, timeout=0.):
+        '''Read available input into buffer'''
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if self.stopped.is_set():
+            raise HostClosed()
+        if readable:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                raise HostClosed()
+            self.inbuf.extend(data)
+
+    def write(self, data):
+        try:
+            os.write(self.fd, data)
+        except OSError:
+            raise HostClosed()
+
+    def println(self, line=''):
+        self.write((line + '\r\n').encode())
+
+    def read_byte(self, timeout=None):
+        '''Next input byte, or None if none arrives in `timeout`'''
+
+        end = time.time() + (timeout if timeout is not None else float('inf'))
+        while not self.inbuf:
+            remaining = end - time.time()
+            if remaining <= 0: return None
+            self.read(min(remaining, 0.1))
+        byte = self.inbuf[0]
+        del self.inbuf[0]
+        return byte
+
+    def parse_int(self):
+        '''Read integer like `Stream.parseInt`: skip leading characters, stop
+        at first non-digit (left in buffer), 0 on timeout
+        '''
+
+        end = time.time() + parse_timeout
+        digits = bytearray()
+        while time.time() < end or self.inbuf:
+            if not self.inbuf:
+                self.read(0.01)
+                continue
+            char = self.inbuf[0]
+            if chr(char).isdigit() or (char == ord('-') and not digits):
+                digits.append(char)
+                del self.inbuf[0]
+            elif digits:
+                break
+            else:
+                del self.inbuf[0]
+        try:
+            return int(digits.decode())
+        except ValueError:
+            return 0
+
+    # Firmware
+    def boot(self, delay=boot_delay):
+        '''Run firmware from reset until host disconnects or restarts it'''
+
+        time.sleep(delay)
+        del self.inbuf[:]
+        if self.firmware == 'go-no-go':
+            self.println('Go/no-go & Classical conditioning tasks')
+            self.println('Data format: {}'.format(self.data_format))
+        if self.max_baud: self.println('Max baud: {}'.format(self.max_baud))
+
+        while 1:
+            self.println('Waiting for parameters...')
+            self.look_for_signal(ord('D'), 0)
+            exit_code = self.get_params()
+            if not exit_code:
+                self.println('Parameters processed')
+                break
+            else:
+                self.println('Error parsing parameters. Exit code {}'.format(exit_code))
+
+        self.println("Waiting for start signal ('E')")
+        self.look_for_signal(ord('E'), 0)
+        self.println('Session started')
+        self.n_sessions += 1
+        self.run_session()
+
+        self.wait_for_restart()
+
+    def look_for_signal(self, signal, ts):
+        '''Handle commands until `signal` is received'''
+
+        while 1:
+            reading = self.read_byte()
+            if reading == signal:
+                return
+            elif reading == ord('0'):
+                if self.firmware == 'go-no-go': self.println('End by serial command')
+                self.send(np.array([[code_end, ts, 0]]))
+                self.wait_for_restart()
+            elif reading == ord(serial_stream.code_param_mode):
+                raise Restart()
+            elif reading == ord(serial_stream.code_baud):
+                baud = self.parse_int()
+                if baud: self.println('Baud {}'.format(baud))
+            elif reading == ord(serial_stream.code_baud_check):
+                self.println('Baud OK')
+
+    def get_params(self):
+        '''Read parameters; returns exit code'''
+
+        names = gonogo_params if self.firmware == 'go-no-go' else wheel_params
+        values = [self.parse_int() % 2**32 for _ in names]     # Stored as unsigned long
+        self.parameters = dict(zip(names, values))
+        if self.verbose: print('Parameters: {}'.format(self.parameters))
+        self.println('Params: ' + '+'.join(str(v) for v in values))
+        self.println('Checksum: {}'.format(serial_stream.params_checksum(values)))
+        if self.firmware == 'wheel' and self.parameters['last_param'] != code_last_param:
+            return 1
+        return 0
+
+    def wait_for_restart(self):
+        '''Firmware waits after session until host restarts it'''
+
+        while 1:
+            if self.read_byte() == ord(serial_stream.code_param_mode):
+                raise Restart()
+
+    def send(self, records):
+        '''Send (N, 3) records'''
+
+        if not len(records): return
+        if self.data_format == serial_stream.format_binary:
+            self.write(serial_stream.pack_frames(records))
+        else:
+            self.write(serial_stream.format_records(records).replace('\n', '\r\n').encode())
+        self.n_records += len(records)
+
+    def run_session(self):
+        '''Stream records in real time until session ends or '0' is received'''
+
+        schedule = self.schedule()
+        self.send(schedule['start'])
+
+        start = time.time()
+        clock_rate = 1 + self.clock_drift * 1e-6
+        n_sync = 0
+        block_start = 0
+        block, ts_send = self.generate(schedule, block_start, block_start + block_dur)
+        ix = 0
+        while 1:
+            delay = self.tick + self.rng.uniform(0, self.jitter)
+            self.read(delay / 1000.)
+            ts = int((time.time() - start) * 1000 * clock_rate)
+
+            # Answer sync pings
+            for _ in range(self.inbuf.count(ord(clock_sync.code_sync_ping))):
+                n_sync += 1
+                self.send(np.array([[clock_sync.code_sync, ts, n_sync]]))
+
+            # Stop by command
+            if ord('0') in self.inbuf:
+                if self.firmware == 'go-no-go': self.println('End by serial command')
+                self.send(np.array([[code_end, ts, 0]]))
+                return
+            del self.inbuf[:]
+
+            # Send records due by current time
+            while 1:
+                ix_end = np.searchsorted(ts_send, min(ts, schedule['end']), side='right')
+                self.send(block[ix:ix_end])
+                ix = ix_end
+                if ix < len(block) or block_start + block_dur > ts: break
+                block_start += block_dur
+                block, ts_send = self.generate(schedule, block_start, block_start + block_dur)
+                ix = 0
+
+            if ts >= schedule['end']:
+                self.send(np.array([[code_end, ts, 0]]))
+                return
+
+    # Synthetic data
+    def schedule(self):
+        '''Lick onsets, trial events and end of session
+        Trial events are rows of `[ts_send, code, ts, data]` as the 
+        announcement of the next trial is sent before it happens. `start` 
+        holds records sent at start of session.
+        '''
+
+        p = self.parameters
+        no_records = np.empty((0, 3), dtype=np.int64)
+        if self.firmware == 'wheel':
+            end = p['session_dur']
+        elif p['session_type'] == session_free_licking:
+            end = p['pre_session'] + p['session_dur'] + p['post_session']
+        else:
+            cs_types, trial_starts, end = self.trial_times()
+
+        # Licks
+        if self.firmware == 'wheel' or not self.lick_rate:
+            licks = np.empty(0, dtype=np.int64)
+        else:
+            # Poisson with refractory period so licks do not overlap
+            interval = 1000. / self.lick_rate
+            refractory = min(lick_dur * 1.5, interval / 2)
+            n = int(end / interval * 1.2) + 10
+            licks = np.cumsum(refractory + self.rng.exponential(interval - refractory, size=n)).astype(np.int64)
+            licks = np.unique(licks[(licks > 0) & (licks < end)])
+
+        if self.firmware == 'wheel' or p['session_type'] == session_free_licking:
+            trials = np.empty((0, 4), dtype=np.int64)
+            start = no_records
+        else:
+            trials = self.trials(cs_types, trial_starts, licks)
+            start = np.array([[code_next_trial, trial_starts[0], cs_types[0]]]) if len(cs_types) else no_records
+
+        return {'licks': licks, 'trials': trials, 'start': start, 'end': end}
+
+    def trial_times(self):
+        '''CS types, trial start times and end of session'''
+
+        p = self.parameters
+        n_cs = [p['cs0_num'], p['cs1_num']]
+        if p['session_type'] == session_classical_conditioning: n_cs.append(p['cs2_num'])
+        cs_types = self.rng.permutation(np.repeat(np.arange(len(n_cs)), n_cs))
+        trial_dur = p['pre_stim'] + p['post_stim']
+
+        trial_starts = []
+        ts_next = p['pre_session'] + self.iti()
+        for _ in cs_types:
+            trial_starts.append(ts_next)
+            # Next trial is timed from start of previous one
+            ts_next += self.iti()
+        ts_last = trial_starts[-1] if trial_starts else 0
+        end = max(ts_last + trial_dur, ts_last + p['post_session'])
+        return cs_types, np.array(trial_starts, dtype=np.int64), end
+
+    def trials(self, cs_types, trial_starts, licks):
+        '''Trial events as rows of `[ts_send, code, ts, data]`'''
+
+        p = self.parameters
+        trial_dur = p['pre_stim'] + p['post_stim']
+        records = []
+        for cs, ts_start in zip(cs_types, trial_starts):
+            ts_stim = ts_start + p['pre_stim']
+            records.append([code_trial_start, ts_start, cs])
+            if p['trial_signal_dur'] > 0:
+                records.append([code_trial_signal, ts_stim - p['trial_signal_offset'], cs])
+            records.append([code_cs_start, ts_stim, cs])
+
+            # Reward first lick in response window
+            window_start = ts_stim + p['grace_dur']
+            window_end = window_start + p['response_dur']
+            response = licks[(licks >= window_start) & (licks < window_end)]
+            if response.size:
+                records.append([code_us_start, response[0], cs])
+                records.append([code_response, response[0], cs * 2 + 1])
+            else:
+                records.append([code_response, window_end, cs * 2])
+
+        rows = [[ts, code, ts, data] for code, ts, data in records]
+
+        # Next trial is announced at end of each trial
+        for ix, ts_start in enumerate(trial_starts):
+            if ix + 1 < len(trial_starts):
+                ts_next, cs_next = trial_starts[ix + 1], cs_types[ix + 1]
+            else:
+                ts_next, cs_next = ts_start + p['mean_iti'], 0
+            rows.append([ts_start + trial_dur, code_next_trial, ts_next, cs_next])
+        return np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+    def iti(self):
+        p = self.parameters
+        if p['iti_distro'] == 1:
+            return self.rng.randint(p['min_iti'], max(p['max_iti'], p['min_iti'] + 1))
+        elif p['iti_distro'] == 2:
+            return int(np.clip(self.rng.exponential(p['mean_iti']), p['min_iti'], p['max_iti']))
+        return p['mean_iti']
+
+    def generate(self, schedule, t0, t1):
+        '''Records to be sent in [t0, t1)
+        Returns `(records, ts_send)` sorted by `ts_send`.
+        '''
+
+        p = self.parameters
+        blocks = []
+
+        # Wheel
+        period = max(p['track_period'], 1)
+        ts_track = np.arange((t0 // period + 1) * period, t1, period)
+        ts_track = ts_track[self.rng.uniform(size=ts_track.size) < self.move_prob]
+        move = self.rng.randint(1, 5, size=ts_track.size) * self.rng.choice([-1, 1], size=ts_track.size)
+        code = code_wheel if self.firmware == 'wheel' else code_movement
+        blocks.append(np.column_stack([np.full(ts_track.size, code), ts_track, move]))
+
+        # Licks
+        licks = schedule['licks']
+        onsets = licks[(licks >= t0) & (licks < t1)]
+        offsets = licks[(licks + lick_dur >= t0) & (licks + lick_dur < t1)] + lick_dur
+        blocks.append(np.column_stack([np.full(onsets.size, code_lick), onsets, np.ones(onsets.size)]))
+        blocks.append(np.column_stack([np.full(offsets.size, code_lick), offsets, np.zeros(offsets.size)]))
+
+        # Lick waveform
+        if self.form_rate and licks.size:
+            near = licks[(licks + self.form_window >= t0) & (licks - self.form_window < t1)]
+            offsets_form = np.arange(-self.form_window / 2., self.form_window / 2., 1000. / self.form_rate)
+            ts_form = (near[:, None] + offsets_form).ravel().astype(np.int64)
+            shape = np.exp(-(offsets_form / (self.form_window / 4.)) ** 2)
+            form = 880 - 700 * np.tile(shape, near.size) + self.rng.randint(-15, 15, size=ts_form.size)
+            keep = (ts_form >= t0) & (ts_form < t1)
+            blocks.append(np.column_stack([np.full(keep.sum(), code_lick_form), ts_form[keep], form[keep]]))
+
+        records = np.concatenate(blocks).astype(np.int64)
+        records = np.column_stack([records[:, 1], records])
+
+        # Trials
+        trials = schedule['trials']
+        records = np.concatenate([records, trials[(trials[:, 0] >= t0) & (trials[:, 0] < t1)]])
+
+        records = records[np.argsort(records[:, 0], kind='mergesort')]
+        return records[:, 1:], records[:, 0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate Arduino on a pseudo-terminal')
+    parser.add_argument('--firmware', choices=firmwares, default='go-no-go')
+    parser.add_argument('--format', choices=[serial_stream.format_ascii, serial_stream.format_binary],
+                        default=serial_stream.format_ascii, help='Data format (go-no-go only)')
+    parser.add_argument('--max-baud', type=int, default=2000000, help='Maximum baud rate announced (0: none)')
+    parser.add_argument('--lick-rate', type=float, default=5., help='Mean lick rate (Hz)')
+    parser.add_argument('--form-rate', type=float, default=1000., help='Lick waveform samples per second')
+    parser.add_argument('--form-window', type=float, default=60, help='Lick waveform around each lick (ms)')
+    parser.add_argument('--move-prob', type=float, default=0.5, help='Fraction of tracking periods with movement')
+    parser.add_argument('--tick', type=float, default=5., help='Time between writes (ms)')
+    parser.add_argument('--jitter', type=float, default=0., help='Maximum extra delay of writes (ms)')
+    parser.add_argument('--clock-drift', type=float, default=0., help='Device clock error (ppm)')
+    parser.add_argument('--link', help='Symlink to port (default: in {})'.format(serial_stream.virtual_port_dir))
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if not args.link:
+        if not os.path.isdir(serial_stream.virtual_port_dir): os.makedirs(serial_stream.virtual_port_dir)
+        args.link = os.path.join(serial_stream.virtual_port_dir, '{}-{}'.format(args.firmware, os.getpid()))
+
+    device = VirtualArduino(
+        args.firmware, args.format, args.max_baud, args.lick_rate, args.form_rate,
+        args.form_window, args.move_prob, args.tick, args.jitter, args.link, args.seed,
+        args.verbose, args.clock_drift,
+    )
+    device.start()
+    print('Virtual Arduino ({}) on {} -> {}'.format(args.firmware, args.link, device.port))
+    try:
+        while device.is_alive():
+            device.join(1)
+    except KeyboardInterrupt:
+        device.stop()
+
+
+if __name__ == '__main__':
+    main()